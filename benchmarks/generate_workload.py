@@ -0,0 +1,236 @@
+"""Generate a synthetic workload of cc_meta aspect outputs, to benchmark the python tools.
+
+The workload directory looks like a (tiny) workspace after a build with the cc_meta aspect:
+
+    workspace/                      Packages with empty BUILD files and sources.
+    workspace/bazel-out/bin/...     The outputs of the aspect for each target (see cc_meta.bzl),
+                                    except the ones produced by the python tools themselves,
+                                    which are left for the benchmarks to produce from depfiles.
+    workload.json                   The manifest of targets, their files and outputs, which the
+                                    stub bazel (see stub_bazel.py) uses to answer queries.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+
+_WORKLOAD_MANIFEST = "workload.json"
+_BIN_DIR = os.path.join("bazel-out", "bin")
+_SYSTEM_HEADERS = [
+    "/usr/include/c++/12/vector",
+    "/usr/include/c++/12/string",
+    "/usr/include/c++/12/memory",
+    "/usr/include/c++/12/map",
+    "/usr/include/stdio.h",
+    "/usr/include/stdlib.h",
+]
+
+
+def _make_target(index, n_packages, args, rng):
+    package = "pkg{}".format(index % n_packages)
+    name = "t{}".format(index)
+    headers = [
+        "{}/{}_h{}.h".format(package, name, k) for k in range(args.headers_per_target)
+    ]
+    sources = [
+        "{}/{}_s{}.cc".format(package, name, k) for k in range(args.sources_per_target)
+    ]
+    # Deps only point to targets with lower indices, which makes the graph a DAG.
+    deps = sorted(rng.sample(range(index), min(index, args.fan_out)))
+    return {
+        "label": "@@//{}:{}".format(package, name),
+        "package": package,
+        "name": name,
+        "headers": headers,
+        "sources": sources,
+        "deps": deps,
+    }
+
+
+def _write_file(file_name, content):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, "w") as file:
+        file.write(content)
+
+
+def _write_json(file_name, content):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, "w") as file:
+        json.dump(content, file, indent=2)
+
+
+def _write_depfile(file_name, source_file, includes):
+    # Same layout as the compilers' -MF outputs, with escaped line breaks.
+    lines = ["{}.o: {}".format(os.path.splitext(source_file)[0], source_file)]
+    lines.extend(includes)
+    _write_file(file_name, " \\\n  ".join(lines) + "\n")
+
+
+def generate_workload(args):
+    rng = random.Random(args.seed)
+    workspace_dir = os.path.join(args.output_dir, "workspace")
+    n_packages = max(1, args.targets // args.targets_per_package)
+    targets = [_make_target(i, n_packages, args, rng) for i in range(args.targets)]
+
+    # Transitive headers, bounded, to make the deep include lists.
+    transitive_headers = []
+    for target in targets:
+        deep_headers = dict.fromkeys(target["headers"])
+        for dep in target["deps"]:
+            deep_headers.update(dict.fromkeys(transitive_headers[dep]))
+        transitive_headers.append(list(deep_headers)[: args.max_deep_includes])
+
+    for index, target in enumerate(targets):
+        package_dir = os.path.join(workspace_dir, target["package"])
+        if not os.path.exists(os.path.join(package_dir, "BUILD.bazel")):
+            _write_file(os.path.join(package_dir, "BUILD.bazel"), "")
+        for file_name in target["headers"] + target["sources"]:
+            _write_file(os.path.join(workspace_dir, file_name), "")
+
+        out_dir = os.path.join(_BIN_DIR, target["package"])
+        out_prefix = os.path.join(out_dir, target["name"] + "_cc_meta_")
+        target["outputs"] = {
+            kind: out_prefix + suffix
+            for kind, suffix in [
+                ("compile_commands", "compile_commands.json"),
+                ("imports", "imports.json"),
+                ("all_imports", "all_imports.json"),
+                ("exports", "exports.json"),
+                ("exports_txt", "exports.txt"),
+                ("deps_issues", "deps_issues.json"),
+            ]
+        }
+
+        # Exports, with the usual set of paths per header (see cc_meta.bzl).
+        exports = []
+        for header in target["headers"]:
+            exports.append(header)
+            exports.append(header.split("/", 1)[1])
+        exports = sorted(set(exports))
+        _write_json(
+            os.path.join(workspace_dir, target["outputs"]["exports"]),
+            [
+                {
+                    "alwaysused": False,
+                    "deps": [targets[dep]["label"] for dep in target["deps"]],
+                    "exports": exports,
+                    "files": target["headers"] + target["sources"],
+                    "target": target["label"],
+                }
+            ],
+        )
+        _write_file(
+            os.path.join(workspace_dir, target["outputs"]["exports_txt"]),
+            "\n".join(["{}\t0".format(target["label"])] + exports) + "\n",
+        )
+
+        # Compile commands, with a realistic number of (mostly shared) arguments.
+        common_args = [
+            "/usr/bin/gcc",
+            "-U_FORTIFY_SOURCE",
+            "-fstack-protector",
+            "-Wall",
+        ]
+        common_args += ["-iquote", ".", "-iquote", "bazel-out/bin"]
+        common_args += [
+            "-isystem{}".format(os.path.join("external", "dep{}".format(k), "include"))
+            for k in range(args.include_dirs)
+        ]
+        compile_commands = []
+        for file_name in target["sources"] + target["headers"]:
+            arguments = list(common_args)
+            if file_name.endswith(".h"):
+                arguments += ["-x", "c++-header"]
+            arguments += ["-c", file_name]
+            compile_commands.append(
+                {"arguments": arguments, "directory": "", "file": file_name}
+            )
+        _write_json(
+            os.path.join(workspace_dir, target["outputs"]["compile_commands"]),
+            compile_commands,
+        )
+
+        # Depfiles, direct includes from some deps (a few missing or unused) and the own headers.
+        target["depfiles"] = []
+        unused_deps = {
+            dep for dep in target["deps"] if rng.random() < args.unused_dep_ratio
+        }
+        for file_name in target["sources"] + target["headers"]:
+            direct_includes = []
+            for dep in target["deps"]:
+                if dep in unused_deps:
+                    continue
+                direct_includes.append(rng.choice(targets[dep]["headers"]))
+            if target["deps"] and rng.random() < args.missing_dep_ratio:
+                transitive_dep = targets[rng.choice(target["deps"])]
+                if transitive_dep["deps"]:
+                    direct_includes.append(
+                        rng.choice(targets[transitive_dep["deps"][0]]["headers"])
+                    )
+            if file_name in target["sources"]:
+                direct_includes.extend(target["headers"])
+            direct_includes = list(dict.fromkeys(direct_includes))
+            deep_includes = list(
+                dict.fromkeys(
+                    direct_includes + transitive_headers[index] + _SYSTEM_HEADERS
+                )
+            )
+            depfile_prefix = os.path.join(
+                out_dir,
+                os.path.basename(file_name) + ".cc_meta_{}_for_" + target["name"],
+            )
+            depfile = depfile_prefix.format("includes")
+            all_depfile = depfile_prefix.format("all_includes")
+            _write_depfile(
+                os.path.join(workspace_dir, depfile), file_name, direct_includes
+            )
+            _write_depfile(
+                os.path.join(workspace_dir, all_depfile), file_name, deep_includes
+            )
+            target["depfiles"].append(
+                {"includes": depfile, "all_includes": all_depfile}
+            )
+
+    _write_json(
+        os.path.join(args.output_dir, _WORKLOAD_MANIFEST),
+        {
+            "parameters": vars(args),
+            "workspace_dir": os.path.abspath(workspace_dir),
+            "targets": targets,
+        },
+    )
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="GenerateWorkload",
+        description="Generate synthetic cc_meta aspect outputs for benchmarks.",
+    )
+    parser.add_argument("output_dir", help="Directory to generate the workload into.")
+    parser.add_argument("--targets", type=int, default=1000)
+    parser.add_argument("--targets_per_package", type=int, default=10)
+    parser.add_argument("--fan_out", type=int, default=5, help="Deps per target.")
+    parser.add_argument("--headers_per_target", type=int, default=4)
+    parser.add_argument("--sources_per_target", type=int, default=3)
+    parser.add_argument(
+        "--include_dirs",
+        type=int,
+        default=20,
+        help="External include directories in compile commands.",
+    )
+    parser.add_argument(
+        "--max_deep_includes",
+        type=int,
+        default=400,
+        help="Bound on the transitive includes of each file.",
+    )
+    parser.add_argument("--unused_dep_ratio", type=float, default=0.05)
+    parser.add_argument("--missing_dep_ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    generate_workload(_parse_args(sys.argv[1:]))
@@ -0,0 +1,474 @@
+"""Time and memory-profile the python stages of cc_meta on a synthetic workload.
+
+The stages run on the outputs made by generate_workload.py, in the order of a real refresh:
+
+    combine_includes_lists      Depfiles to the imports files of each target (in-process).
+    check_direct_deps_exports   Imports and deps exports to the deps issues of each target
+                                (in-process).
+    refresh_merge               Parsing and merging all aspect outputs (in-process).
+    refresh                     The whole refresh tool, with the stub bazel (subprocess).
+    fix_deps                    The fix_deps tool on all sources, with the stub bazel and
+                                buildozer, without and with its label cache (subprocess).
+    refresh_ndjson              The refresh tool writing line-delimited databases (subprocess).
+    fix_deps_one                The fix_deps tool on the sources of a single target, with the
+                                databases of the last refresh stage (subprocess).
+    refresh_compile_commands    The refresh tool in compile-commands mode (subprocess).
+    refresh_deps                The refresh tool in deps mode (subprocess).
+    refresh_header_report       The refresh tool also writing the header hotspot report (subprocess).
+    refresh_deps_usage          The refresh tool also writing the deps usage database (subprocess).
+    deps_graph_report           The build-graph report, with the databases of the last refresh stage
+                                (subprocess).
+    lookup_server               Providers, owners and issues lookups of all headers, sources and
+                                targets, through the lookup server (subprocess), on one connection.
+
+In-process stages are timed on their own, and run once more under tracemalloc to get their peak
+python memory. Subprocess stages report the peak resident memory of the process instead. The
+results are written as json, to be kept and compared across changes.
+"""
+
+import argparse
+import datetime
+import functools
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+_BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+_CC_META_DIR = os.path.join(os.path.dirname(_BENCHMARKS_DIR), "cc_meta")
+sys.path.insert(0, _CC_META_DIR)
+sys.path.insert(0, _BENCHMARKS_DIR)
+
+import check_direct_deps_exports  # noqa: E402
+import combine_includes_lists  # noqa: E402
+import generate_workload  # noqa: E402
+import lookup_server  # noqa: E402
+import stub_bazel  # noqa: E402
+
+_RESULTS_VERSION = 1
+_STAGES = [
+    "combine_includes_lists",
+    "check_direct_deps_exports",
+    "refresh_merge",
+    "refresh",
+    "fix_deps",
+    "fix_deps_warm",
+    "refresh_ndjson",
+    "fix_deps_one",
+    "refresh_compile_commands",
+    "refresh_deps",
+    "refresh_header_report",
+    "refresh_deps_usage",
+    "deps_graph_report",
+    "lookup_server",
+]
+
+
+def _load_workload(workload_dir):
+    with open(os.path.join(workload_dir, "workload.json"), "r") as f:
+        return json.load(f)
+
+
+def _install_stubs(workload_dir):
+    """Write the bazel and buildozer stubs, and the refresh tool as Bazel would expand it."""
+    bin_dir = os.path.join(workload_dir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in ["bazel", "buildozer"]:
+        tool_file_name = os.path.join(bin_dir, tool)
+        with open(tool_file_name, "w") as tool_file:
+            tool_file.write(
+                '#!/bin/sh\nexec "{}" "{}" {} "$@"\n'.format(
+                    sys.executable, os.path.join(_BENCHMARKS_DIR, "stub_bazel.py"), tool
+                )
+            )
+        os.chmod(tool_file_name, 0o755)
+
+    # See refresh_cc_meta in cc_meta.bzl.
+    with open(os.path.join(_CC_META_DIR, "refresh.py"), "r") as template_file:
+        refresh_script = template_file.read()
+    refresh_script = refresh_script.replace(
+        "        {target_patterns}", "        '//...',"
+    )
+    refresh_script = refresh_script.replace(
+        "{cc_meta_aspect}", '"--aspects=//:defs.bzl%default_cc_meta_aspect"'
+    )
+    refresh_file_name = os.path.join(bin_dir, "refresh.py")
+    with open(refresh_file_name, "w") as refresh_file:
+        refresh_file.write(refresh_script)
+    return bin_dir
+
+
+def _stub_env(workload_dir, bin_dir, workspace_dir):
+    env = dict(os.environ)
+    env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+    env[stub_bazel.WORKLOAD_ENV_VAR] = os.path.abspath(workload_dir)
+    env["BUILD_WORKSPACE_DIRECTORY"] = workspace_dir
+    # The shared modules of the tools, like the py_library deps of the refresh_cc_meta rule.
+    env["PYTHONPATH"] = os.pathsep.join(
+        [_CC_META_DIR] + [p for p in [env.get("PYTHONPATH")] if p]
+    )
+    return env
+
+
+def _count_stub_calls(workload_dir):
+    stub_calls = {}
+    try:
+        with open(os.path.join(workload_dir, stub_bazel._STUB_CALLS_FILE), "r") as f:
+            for line in f:
+                stub_call = json.loads(line)
+                tool = "{} {}".format(stub_call["tool"], stub_call["command"]).strip()
+                stub_calls[tool] = stub_calls.get(tool, 0) + 1
+    except OSError:
+        pass
+    return stub_calls
+
+
+def _reset_stub_calls(workload_dir):
+    try:
+        os.remove(os.path.join(workload_dir, stub_bazel._STUB_CALLS_FILE))
+    except OSError:
+        pass
+
+
+def _run_combine_includes_lists(workload):
+    records = 0
+    for target in workload["targets"]:
+        for depfile_kind, output_kind in [
+            ("includes", "imports"),
+            ("all_includes", "all_imports"),
+        ]:
+            depfiles = [d[depfile_kind] for d in target["depfiles"]]
+            combine_includes_lists.main(
+                depfiles + [target["outputs"][output_kind], target["label"]]
+            )
+            records += len(depfiles)
+    return records
+
+
+def _run_check_direct_deps_exports(workload):
+    targets = workload["targets"]
+    for target in targets:
+        deps_exports = [
+            targets[dep]["outputs"]["exports_txt"] for dep in target["deps"]
+        ]
+        check_direct_deps_exports.main(
+            deps_exports
+            + [
+                target["outputs"]["exports_txt"],
+                target["outputs"]["imports"],
+                target["outputs"]["deps_issues"],
+            ]
+        )
+    return len(targets)
+
+
+def _load_refresh_module(bin_dir):
+    spec = importlib.util.spec_from_file_location(
+        "cc_meta_refresh", os.path.join(bin_dir, "refresh.py")
+    )
+    refresh = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(refresh)
+    return refresh
+
+
+def _run_refresh_merge(workload, refresh):
+    merger = refresh._CcMetaMerger(workload["workspace_dir"])
+    loader = refresh._OutputFilesLoader(merger, 1, False, None)
+    records = 0
+    for target in workload["targets"]:
+        for kind in ["compile_commands", "all_imports", "exports", "deps_issues"]:
+            loader.add_output_file(target["outputs"][kind])
+            records += 1
+    loader.close()
+    merger.finish()
+    return records
+
+
+def _measure_lookup_server(workload, env, repeat):
+    lookups = []
+    for target in workload["targets"]:
+        lookups.append(("issues", target["label"]))
+        lookups.extend(("owners", src) for src in target["sources"])
+        lookups.extend(("providers", hdr) for hdr in target["headers"])
+        # A partial include path, to look up exports by suffix.
+        lookups.append(("providers", os.path.basename(target["headers"][0])))
+    socket_path = os.path.join(env["BUILD_WORKSPACE_DIRECTORY"], ".cc_meta_lookup.sock")
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server_process = subprocess.Popen(
+        [sys.executable, os.path.join(_CC_META_DIR, "lookup_server.py")],
+        env=env,
+        cwd=env["BUILD_WORKSPACE_DIRECTORY"],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        start_time = time.perf_counter()
+        while not os.path.exists(socket_path):
+            if server_process.poll() is not None:
+                raise RuntimeError("The lookup server exited early.")
+            time.sleep(0.01)
+        startup_time = time.perf_counter() - start_time
+        client = lookup_server.LookupClient(socket_path)
+        wall_times = []
+        errors = 0
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            for query, key in lookups:
+                errors += "error" in client.lookup(query, key)
+            wall_times.append(time.perf_counter() - start_time)
+        client.close()
+    finally:
+        server_process.terminate()
+        server_process.wait()
+    return {
+        "wall_times": wall_times,
+        "records": len(lookups),
+        "startup_time": startup_time,
+        "mean_lookup_latency": min(wall_times) / len(lookups),
+        "errors": errors,
+    }
+
+
+def _measure_in_process(run_stage, repeat):
+    wall_times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        records = run_stage()
+        wall_times.append(time.perf_counter() - start_time)
+    tracemalloc.start()
+    run_stage()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "wall_times": wall_times,
+        "records": records,
+        "peak_python_memory_bytes": peak_memory,
+    }
+
+
+# Subprocesses are started from a small launcher process, because a forked process inherits the
+# peak memory of its parent (here, the benchmarks with the whole workload loaded) in its rusage.
+_SUBPROCESS_LAUNCHER = """
+import os, subprocess, sys, time
+start_time = time.perf_counter()
+process = subprocess.Popen(sys.argv[1:], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+_, status, rusage = os.wait4(process.pid, 0)
+wall_time = time.perf_counter() - start_time
+returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+# ru_maxrss is in kilobytes on Linux.
+print(wall_time, returncode, rusage.ru_maxrss * 1024)
+"""
+
+
+def _measure_subprocess(args, env, repeat, before_run=None):
+    wall_times = []
+    max_rss = 0
+    returncode = 0
+    for _ in range(repeat):
+        if before_run is not None:
+            before_run()
+        launcher_process = subprocess.run(
+            [sys.executable, "-c", _SUBPROCESS_LAUNCHER] + args,
+            env=env,
+            cwd=env["BUILD_WORKSPACE_DIRECTORY"],
+            capture_output=True,
+            encoding="utf-8",
+            check=True,
+        )
+        wall_time, run_returncode, run_max_rss = launcher_process.stdout.split()
+        wall_times.append(float(wall_time))
+        returncode = returncode or int(run_returncode)
+        max_rss = max(max_rss, int(run_max_rss))
+    return {
+        "wall_times": wall_times,
+        "peak_rss_bytes": max_rss,
+        "returncode": returncode,
+    }
+
+
+def _summarize(result):
+    wall_times = result["wall_times"]
+    result["min_wall_time"] = min(wall_times)
+    result["median_wall_time"] = statistics.median(wall_times)
+    return result
+
+
+def run_benchmarks(workload_dir, stages, repeat):
+    workload = _load_workload(workload_dir)
+    workspace_dir = workload["workspace_dir"]
+    bin_dir = _install_stubs(workload_dir)
+    env = _stub_env(workload_dir, bin_dir, workspace_dir)
+    all_sources = []
+    for target in workload["targets"]:
+        all_sources.extend(target["sources"])
+
+    def remove_label_cache():
+        try:
+            os.remove(
+                os.path.join(workspace_dir, "bazel-out", "cc_meta_labels_cache.json")
+            )
+        except OSError:
+            pass
+
+    results = {}
+    initial_cwd = os.getcwd()
+    os.chdir(workspace_dir)
+    try:
+        for stage in stages:
+            _reset_stub_calls(workload_dir)
+            print("Running stage {}...".format(stage), file=sys.stderr)
+            if stage == "combine_includes_lists":
+                result = _measure_in_process(
+                    lambda: _run_combine_includes_lists(workload), repeat
+                )
+            elif stage == "check_direct_deps_exports":
+                result = _measure_in_process(
+                    lambda: _run_check_direct_deps_exports(workload), repeat
+                )
+            elif stage == "refresh_merge":
+                refresh = _load_refresh_module(bin_dir)
+                result = _measure_in_process(
+                    functools.partial(_run_refresh_merge, workload, refresh), repeat
+                )
+            elif stage == "refresh":
+                result = _measure_subprocess(
+                    [sys.executable, os.path.join(bin_dir, "refresh.py")], env, repeat
+                )
+            elif stage == "fix_deps":
+                result = _measure_subprocess(
+                    [sys.executable, os.path.join(_CC_META_DIR, "fix_deps.py"), "-n"]
+                    + all_sources,
+                    env,
+                    repeat,
+                    before_run=remove_label_cache,
+                )
+            elif stage == "refresh_ndjson":
+                result = _measure_subprocess(
+                    [
+                        sys.executable,
+                        os.path.join(bin_dir, "refresh.py"),
+                        "--cc_meta_ndjson",
+                    ],
+                    env,
+                    repeat,
+                )
+            elif stage == "fix_deps_one":
+                result = _measure_subprocess(
+                    [sys.executable, os.path.join(_CC_META_DIR, "fix_deps.py"), "-n"]
+                    + workload["targets"][-1]["sources"],
+                    env,
+                    repeat,
+                )
+            elif stage in ["refresh_compile_commands", "refresh_deps"]:
+                result = _measure_subprocess(
+                    [
+                        sys.executable,
+                        os.path.join(bin_dir, "refresh.py"),
+                        "--cc_meta_mode=" + stage[len("refresh_") :],
+                    ],
+                    env,
+                    repeat,
+                )
+            elif stage == "refresh_header_report":
+                result = _measure_subprocess(
+                    [
+                        sys.executable,
+                        os.path.join(bin_dir, "refresh.py"),
+                        "--cc_meta_header_report=header_report.json",
+                    ],
+                    env,
+                    repeat,
+                )
+            elif stage == "refresh_deps_usage":
+                result = _measure_subprocess(
+                    [
+                        sys.executable,
+                        os.path.join(bin_dir, "refresh.py"),
+                        "--cc_meta_deps_usage",
+                    ],
+                    env,
+                    repeat,
+                )
+            elif stage == "deps_graph_report":
+                result = _measure_subprocess(
+                    [
+                        sys.executable,
+                        os.path.join(_CC_META_DIR, "deps_graph_report.py"),
+                    ],
+                    env,
+                    repeat,
+                )
+            elif stage == "lookup_server":
+                result = _measure_lookup_server(workload, env, repeat)
+            elif stage == "fix_deps_warm":
+                result = _measure_subprocess(
+                    [sys.executable, os.path.join(_CC_META_DIR, "fix_deps.py"), "-n"]
+                    + all_sources,
+                    env,
+                    repeat,
+                )
+            result["stub_calls"] = _count_stub_calls(workload_dir)
+            results[stage] = _summarize(result)
+    finally:
+        os.chdir(initial_cwd)
+
+    return {
+        "version": _RESULTS_VERSION,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "workload": workload["parameters"],
+        "repeat": repeat,
+        "stages": results,
+    }
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="RunBenchmarks",
+        description="Benchmark the python stages of cc_meta on a synthetic workload.",
+        epilog="Arguments after '--' are passed to generate_workload.py when the workload "
+        "directory does not exist yet.",
+    )
+    parser.add_argument(
+        "workload_dir", help="Workload directory (see generate_workload.py)."
+    )
+    parser.add_argument(
+        "-o", "--output", default="", help="Json file to write the results to."
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-s", "--stage", action="append", choices=_STAGES, default=[])
+    parser.add_argument("--regenerate", action="store_true")
+    if "--" in argv:
+        split_index = argv.index("--")
+        return parser.parse_args(argv[:split_index]), argv[split_index + 1 :]
+    return parser.parse_args(argv), []
+
+
+if __name__ == "__main__":
+    args, generator_argv = _parse_args(sys.argv[1:])
+    if args.regenerate and os.path.exists(args.workload_dir):
+        shutil.rmtree(args.workload_dir)
+    if not os.path.exists(os.path.join(args.workload_dir, "workload.json")):
+        generate_workload.generate_workload(
+            generate_workload._parse_args([args.workload_dir] + generator_argv)
+        )
+
+    results = run_benchmarks(
+        args.workload_dir,
+        [s for s in _STAGES if s in args.stage] or _STAGES,
+        args.repeat,
+    )
+    results_str = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(results_str + "\n")
+    else:
+        print(results_str)
@@ -0,0 +1,188 @@
+"""Stub of the bazel and buildozer executables, answering from a synthetic workload.
+
+This lets the refresh and fix_deps tools run offline on a workload made by
+generate_workload.py (the benchmark harness puts `bazel` and `buildozer` wrappers calling this
+script on the PATH). Only the commands that the tools use are supported:
+
+    bazel info workspace|execution_root
+    bazel cquery ...                              All targets of the workload.
+    bazel query [--query_file=FILE] QUERY         set(...) and same_pkg_direct_rdeps(set(...)).
+    bazel build --build_event_json_file=FILE ...  Build events listing the outputs of the targets
+                                                  in --target_pattern_file (labels, '//...',
+                                                  'package/...' or 'package:all' patterns).
+    buildozer ... -f FILE                         Counts the commands, changes nothing.
+
+Every call is appended to stub_calls.jsonl in the workload directory, such that the benchmarks
+can count subprocesses.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+
+WORKLOAD_ENV_VAR = "CC_META_BENCH_WORKLOAD"
+_STUB_CALLS_FILE = "stub_calls.jsonl"
+
+
+# Outputs of each output group of the aspect (see _cc_meta_output_groups in cc_meta.bzl).
+_OUTPUT_GROUP_KINDS = {
+    "cc_meta": ["compile_commands", "imports", "all_imports", "exports", "deps_issues"],
+    "cc_meta_compile_commands": ["compile_commands", "exports"],
+    "cc_meta_deps": ["exports", "deps_issues"],
+}
+
+
+def _load_workload():
+    with open(os.path.join(os.environ[WORKLOAD_ENV_VAR], "workload.json"), "r") as f:
+        return json.load(f)
+
+
+def _get_option(args, option):
+    for arg in args:
+        if arg.startswith(option + "="):
+            return arg[len(option) + 1 :]
+    return None
+
+
+def _apparent_label(label):
+    return label[1:] if label.startswith("@@//") else label
+
+
+def _query(workload, args):
+    query_file_name = _get_option(args, "--query_file")
+    if query_file_name is not None:
+        with open(query_file_name, "r") as query_file:
+            query = query_file.read()
+    else:
+        query = [arg for arg in args if not arg.startswith("--")][0]
+    words = re.findall(r'"([^"]+)"', query) or [query]
+    labels = {_apparent_label(t["label"]) for t in workload["targets"]}
+
+    if query.startswith("same_pkg_direct_rdeps"):
+        owners = {}
+        for target in workload["targets"]:
+            for file_name in target["headers"] + target["sources"]:
+                owners.setdefault(file_name, _apparent_label(target["label"]))
+        found = [owners[w] for w in words if w in owners]
+        print("\n".join(sorted(set(found))))
+        return 0 if len(found) == len(words) else 3
+
+    found = [_apparent_label(w) for w in words if _apparent_label(w) in labels]
+    print("\n".join(sorted(set(found))))
+    return 0 if len(found) == len(words) else 3
+
+
+def _matches_target_patterns(target, target_patterns):
+    label = _apparent_label(target["label"])
+    for target_pattern in target_patterns:
+        target_pattern = _apparent_label(target_pattern)
+        if target_pattern in ["//...", "//...:all", label]:
+            return True
+        if target_pattern == "//{}:all".format(target["package"]):
+            return True
+        if target_pattern.endswith("/...") and (target["package"] + "/").startswith(
+            target_pattern[len("//") : -len("...")]
+        ):
+            return True
+    return False
+
+
+def _build(workload, args):
+    workspace_dir = workload["workspace_dir"]
+    target_patterns = ["//..."]
+    target_pattern_file_name = _get_option(args, "--target_pattern_file")
+    if target_pattern_file_name is not None:
+        with open(target_pattern_file_name, "r") as target_pattern_file:
+            target_patterns = target_pattern_file.read().split()
+    output_group = _get_option(args, "--output_groups") or "cc_meta"
+    output_kinds = _OUTPUT_GROUP_KINDS[output_group]
+    with open(_get_option(args, "--build_event_json_file"), "w") as bep_file:
+
+        def write_event(event):
+            bep_file.write(json.dumps(event) + "\n")
+
+        write_event({"id": {"started": {}}, "started": {}})
+        for i, target in enumerate(workload["targets"]):
+            if not _matches_target_patterns(target, target_patterns):
+                continue
+            files = [target["outputs"][kind] for kind in output_kinds]
+            write_event(
+                {
+                    "id": {"namedSet": {"id": str(i)}},
+                    "namedSetOfFiles": {
+                        "files": [
+                            {
+                                "name": f,
+                                "uri": "file://" + os.path.join(workspace_dir, f),
+                            }
+                            for f in files
+                        ]
+                    },
+                }
+            )
+            write_event(
+                {
+                    "id": {
+                        "targetCompleted": {
+                            "label": _apparent_label(target["label"]),
+                            "aspect": "//:defs.bzl%default_cc_meta_aspect",
+                        }
+                    },
+                    "completed": {
+                        "success": True,
+                        "outputGroup": [
+                            {"name": output_group, "fileSets": [{"id": str(i)}]}
+                        ],
+                    },
+                }
+            )
+        write_event({"id": {"buildFinished": {}}, "lastMessage": True})
+    return 0
+
+
+def _bazel(workload, args):
+    command = args[0]
+    command_args = args[1:]
+    if command == "info":
+        print(workload["workspace_dir"])
+        return 0
+    if command == "cquery":
+        for target in workload["targets"]:
+            print("{} (0123abc)".format(_apparent_label(target["label"])))
+        return 0
+    if command == "query":
+        return _query(workload, command_args)
+    if command == "build":
+        return _build(workload, command_args)
+    print("Unsupported stub bazel command: {}".format(command), file=sys.stderr)
+    return 2
+
+
+def _buildozer(args):
+    commands_file_name = args[args.index("-f") + 1]
+    with open(commands_file_name, "r") as commands_file:
+        n_commands = sum(1 for line in commands_file if line.strip())
+    print("{} commands".format(n_commands), file=sys.stderr)
+    return 0
+
+
+def main(tool, args):
+    start_time = time.perf_counter()
+    if tool == "buildozer":
+        returncode = _buildozer(args)
+    else:
+        returncode = _bazel(_load_workload(), args)
+    stub_call = {
+        "tool": tool,
+        "command": args[0] if tool == "bazel" and args else "",
+        "duration": time.perf_counter() - start_time,
+    }
+    with open(os.path.join(os.environ[WORKLOAD_ENV_VAR], _STUB_CALLS_FILE), "a") as f:
+        f.write(json.dumps(stub_call) + "\n")
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1], sys.argv[2:]))
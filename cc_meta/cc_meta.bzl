@@ -15,6 +15,7 @@ CcMetaInfo = provider(
         "deps_issues_json": "issues with target dependencies",
         "direct_exports": "include paths of public headers",
         "direct_exports_json": "include paths of public headers",
+        "direct_exports_txt": "sorted include paths of public headers (line-oriented, see check_direct_deps_exports.py)",
         "direct_imports_json": "direct includes json file",
     },
 )
@@ -22,17 +23,22 @@ CcMetaInfo = provider(
 CcMetaDeviationsInfo = provider(
     "Deviations for targets to be treated differently (see make_cc_meta_deviations).",
     fields = {
+        "decoded_deviations": "Dictionary with structure { target_label: dict }, decoded once for all targets",
         "deviations": "Dictionary with structure { target_label: json-string }",
     },
 )
 
 def _make_cc_meta_deviations_impl(ctx):
     dealiased_deviations = {}
+    decoded_deviations = {}
     for key, values in ctx.attr.deviations.items():
+        decoded_values = json.decode(values)
         if hasattr(key, "label"):
             dealiased_deviations.update({key.label: values})
+            decoded_deviations.update({key.label: decoded_values})
         dealiased_deviations.update({key: values})
-    return CcMetaDeviationsInfo(deviations = dealiased_deviations)
+        decoded_deviations.update({key: decoded_values})
+    return CcMetaDeviationsInfo(deviations = dealiased_deviations, decoded_deviations = decoded_deviations)
 
 _make_cc_meta_deviations = rule(
     implementation = _make_cc_meta_deviations_impl,
@@ -44,8 +50,8 @@ _make_cc_meta_deviations = rule(
 
 # These deviations collect a few shadow dependencies inserted by Bazel.
 _CC_META_DEFAULT_DEVIATIONS = {
-    Label("@rules_cc//:link_extra_lib"): json.encode({"alwaysused": True, "skip": True}),
-    Label("@rules_cc//:empty_lib"): json.encode({"alwaysused": True, "skip": True}),
+    Label("@rules_cc//:link_extra_lib"): {"alwaysused": True, "skip": True},
+    Label("@rules_cc//:empty_lib"): {"alwaysused": True, "skip": True},
 }
 
 def make_cc_meta_deviations(name, deviations = {}, **kwargs):
@@ -175,6 +181,45 @@ def _get_action_from_lang_spec(opts):
                 result = opt_as_action
     return result
 
+# The python tools of the aspect can run as persistent workers (see run_persistent_worker in
+# cc_meta_worker.py), to pay the interpreter startup once instead of once per target.
+# They are not multiplexed, each worker handles one request at a time, so Bazel starts as many
+# workers as actions it runs in parallel (see --worker_max_instances).
+# Use --strategy=CcMetaCombineIncludes=sandboxed (or local) to opt out of it.
+_CC_META_WORKER_EXECUTION_REQUIREMENTS = {
+    "requires-worker-protocol": "json",
+    "supports-workers": "1",
+}
+
+def _run_cc_meta_tool(ctx, mnemonic, executable, arguments, inputs, outputs, repeated_options = {}):
+    # Arguments always go through a flagfile, which is what workers need to receive
+    # them in work requests (the tools expand it themselves otherwise).
+    tool_args = ctx.actions.args()
+    for option, values in repeated_options.items():
+        tool_args.add_all(values, before_each = option)
+    tool_args.add_all(arguments)
+    tool_args.use_param_file("--flagfile=%s", use_always = True)
+    tool_args.set_param_file_format("multiline")
+    ctx.actions.run(
+        mnemonic = mnemonic,
+        executable = executable,
+        arguments = [tool_args],
+        inputs = inputs,
+        outputs = outputs,
+        execution_requirements = _CC_META_WORKER_EXECUTION_REQUIREMENTS,
+    )
+
+def _cc_meta_output_groups(comb_incl_file, comb_all_incl_file, comb_cmd_file, pub_hdrs_file, deps_issues_file):
+    # Bazel only runs the actions needed for the requested output groups (see --cc_meta_mode in refresh.py).
+    return OutputGroupInfo(
+        # Compile commands, and exports to map files to targets, without any preprocessing.
+        cc_meta_compile_commands = depset([comb_cmd_file, pub_hdrs_file]),
+        # Dependency issues, which only need the direct includes of each file.
+        cc_meta_deps = depset([pub_hdrs_file, deps_issues_file]),
+        # Everything, including the transitive includes used to pick compile commands for headers.
+        cc_meta = depset([comb_incl_file, comb_all_incl_file, comb_cmd_file, pub_hdrs_file, deps_issues_file]),
+    )
+
 def _cc_meta_aspect_impl(target, ctx):
     # Declare all the outputs up-top.
     comb_incl_file = ctx.actions.declare_file(ctx.rule.attr.name + "_cc_meta_imports.json")
@@ -182,6 +227,7 @@ def _cc_meta_aspect_impl(target, ctx):
     comb_cmd_file = ctx.actions.declare_file(ctx.rule.attr.name + "_cc_meta_compile_commands.json")
     deps_issues_file = ctx.actions.declare_file(ctx.rule.attr.name + "_cc_meta_deps_issues.json")
     pub_hdrs_file = ctx.actions.declare_file(ctx.rule.attr.name + "_cc_meta_exports.json")
+    pub_hdrs_txt_file = ctx.actions.declare_file(ctx.rule.attr.name + "_cc_meta_exports.txt")
 
     skipped_tags = ctx.attr._skipped_tags
 
@@ -189,14 +235,14 @@ def _cc_meta_aspect_impl(target, ctx):
     # cc_meta always refers to targets as @@repo//path:name, it only resolves them when hitting buildozer.
     target_qualified_name = "@@{}//{}:{}".format(target.label.repo_name, target.label.package, target.label.name)
 
-    target_deviations = _find_cc_meta_deviation(target, _CC_META_DEFAULT_DEVIATIONS)
+    # Deviations are decoded once by make_cc_meta_deviations, not once per target.
+    target_deviation_rules = _find_cc_meta_deviation(target, _CC_META_DEFAULT_DEVIATIONS)
     for attr_deviations in ctx.attr._target_deviations:
-        if target_deviations:
+        if target_deviation_rules != None:
             break
-        target_deviations = _find_cc_meta_deviation(target, attr_deviations[CcMetaDeviationsInfo].deviations)
-    target_deviation_rules = {}
-    if target_deviations:
-        target_deviation_rules = json.decode(target_deviations)
+        target_deviation_rules = _find_cc_meta_deviation(target, attr_deviations[CcMetaDeviationsInfo].decoded_deviations)
+    if target_deviation_rules == None:
+        target_deviation_rules = {}
 
     # We consider a target as always used if it is marked with 'alwayslink' attribute
     # or if a deviation exists that tells us to do so.
@@ -226,6 +272,28 @@ def _cc_meta_aspect_impl(target, ctx):
     hasskipdev = (("skip" in target_deviation_rules) and target_deviation_rules["skip"])
     target_should_skip = (hasskipdev or hasskiptag)
 
+    # List all files owned by the target, such that tools can map files back to their targets.
+    srcs_files = []
+    if hasattr(ctx.rule.attr, "srcs"):
+        for src in ctx.rule.attr.srcs:
+            srcs_files.extend(src.files.to_list())
+    hdrs_files = []
+    if hasattr(ctx.rule.attr, "hdrs"):
+        for src in ctx.rule.attr.hdrs:
+            hdrs_files.extend(src.files.to_list())
+    owned_files = srcs_files + hdrs_files
+    if hasattr(ctx.rule.attr, "textual_hdrs"):
+        for src in ctx.rule.attr.textual_hdrs:
+            owned_files.extend(src.files.to_list())
+
+    # List the direct dependencies analyzed by cc_meta, such that tools can find the dependents of a target.
+    dep_qualified_names = []
+    if hasattr(ctx.rule.attr, "deps"):
+        for dep in ctx.rule.attr.deps:
+            if not CcMetaInfo in dep:
+                continue
+            dep_qualified_names.append("@@{}//{}:{}".format(dep.label.repo_name, dep.label.package, dep.label.name))
+
     # Assemble the list of expected public header paths used by dependents.
 
     # In theory, we could be faster and stricter to compute the include paths, but Bazel seems
@@ -237,32 +305,69 @@ def _cc_meta_aspect_impl(target, ctx):
     # Somewhere in external_includes or quote_includes, we'll find:
     #  bazel-out/k8-dbg/bin/external/foo_cc_proto~/_virtual_includes/foo_proto
     # But technically "_virtual_includes/foo_proto/bar/foo.pb.h" is also a valid (and very stupid) include path.
+    # The candidate include roots are the same for all headers of the target, so they are
+    # normalized once, and each header only looks up its own (few) ancestor directories among them.
+    target_include_dirs = {
+        paths.normalize(incl_dir): None
+        for incl_dir in target[CcInfo].compilation_context.external_includes.to_list() + target[CcInfo].compilation_context.quote_includes.to_list()
+    }
+    includes_suffixes = []
+    if hasattr(ctx.rule.attr, "includes"):
+        for incl_path in ctx.rule.attr.includes:
+            includes_suffixes.append(paths.join(target.label.package, incl_path.lstrip("/")))
+    hacky_suffixes = list(includes_suffixes)
+    if hasattr(ctx.rule.attr, "strip_include_prefix"):
+        hacky_suffixes.append(ctx.rule.attr.strip_include_prefix.lstrip("/"))
+    virtual_stem = paths.join(target.label.package, "_virtual_includes", target.label.name)
+
+    # Roots of the headers outside and inside of _virtual_includes, with the header paths exported
+    # relative to the root, or whole if the header is somewhere in the root (e.g., "." stems).
+    relative_roots = {False: {}, True: {}}
+    whole_path_roots = {False: {}, True: {}}
+
+    # Stems that are not inside of their include directory (e.g., with '..'), checked as they are.
+    unusual_stems = []
+    for suffix in includes_suffixes:
+        if not suffix:
+            # Everything starts with an empty path.
+            whole_path_roots[False][""] = True
+        elif paths.normalize(suffix) != ".":
+            relative_roots[False][paths.normalize(suffix)] = True
+    for incl_dir in target_include_dirs:
+        stems_by_virtual = {
+            False: [paths.join(incl_dir, s) for s in hacky_suffixes] + [incl_dir],
+            True: [paths.join(incl_dir, virtual_stem)],
+        }
+        for is_virtual, stems in stems_by_virtual.items():
+            for stem in stems:
+                norm_stem = paths.normalize(stem)
+                if norm_stem == ".":
+                    whole_path_roots[is_virtual][incl_dir if incl_dir != "." else ""] = True
+                elif incl_dir == "." or paths.starts_with(norm_stem, incl_dir):
+                    relative_roots[is_virtual][norm_stem] = True
+                else:
+                    unusual_stems.append((is_virtual, incl_dir, norm_stem))
+
     for direct_hdr in target[CcInfo].compilation_context.direct_public_headers + target[CcInfo].compilation_context.direct_textual_headers:
         direct_hdr_path_is_virtual = (direct_hdr.path.count("/_virtual_includes/") > 0)
-        hacky_suffixes = []
-        if hasattr(ctx.rule.attr, "includes") and not direct_hdr_path_is_virtual:
-            for incl_path in ctx.rule.attr.includes:
-                hacky_suffixes.append(paths.join(target.label.package, incl_path.lstrip("/")))
-            for hacky_suffix in hacky_suffixes:
-                if paths.starts_with(direct_hdr.path, hacky_suffix):
-                    potential_header_path = paths.relativize(direct_hdr.path, hacky_suffix)
-                    public_header_paths.append(potential_header_path)
-        if hasattr(ctx.rule.attr, "strip_include_prefix") and not direct_hdr_path_is_virtual:
-            hacky_suffixes.append(ctx.rule.attr.strip_include_prefix.lstrip("/"))
-        for ext_incl in target[CcInfo].compilation_context.external_includes.to_list() + target[CcInfo].compilation_context.quote_includes.to_list():
-            if paths.normalize(ext_incl) != "." and not paths.starts_with(direct_hdr.path, ext_incl):
-                continue
-            potential_stems = []
-            for hacky_suffix in hacky_suffixes:
-                potential_stems.append(paths.join(ext_incl, hacky_suffix))
-            if direct_hdr_path_is_virtual:
-                potential_stems.append(paths.join(ext_incl, target.label.package, "_virtual_includes", target.label.name))
-            else:
-                potential_stems.append(ext_incl)
-            for potential_stem in potential_stems:
-                if paths.normalize(potential_stem) == "." or paths.starts_with(direct_hdr.path, potential_stem):
-                    potential_header_path = paths.relativize(direct_hdr.path, potential_stem)
-                    public_header_paths.append(potential_header_path)
+        hdr_relative_roots = relative_roots[direct_hdr_path_is_virtual]
+        hdr_whole_path_roots = whole_path_roots[direct_hdr_path_is_virtual]
+        hdr_path = paths.normalize(direct_hdr.path)
+
+        # A root that is the header itself also exports its whole path (see paths.relativize).
+        if "" in hdr_whole_path_roots or hdr_path in hdr_whole_path_roots or hdr_path in hdr_relative_roots:
+            public_header_paths.append(hdr_path)
+        hdr_segments = hdr_path.split("/")
+        hdr_ancestor = hdr_segments[0]
+        for i in range(1, len(hdr_segments)):
+            if hdr_ancestor in hdr_whole_path_roots:
+                public_header_paths.append(hdr_path)
+            if hdr_ancestor in hdr_relative_roots:
+                public_header_paths.append("/".join(hdr_segments[i:]))
+            hdr_ancestor += "/" + hdr_segments[i]
+        for stem_is_virtual, incl_dir, norm_stem in unusual_stems:
+            if stem_is_virtual == direct_hdr_path_is_virtual and paths.starts_with(hdr_path, incl_dir) and paths.starts_with(hdr_path, norm_stem):
+                public_header_paths.append(paths.relativize(hdr_path, norm_stem))
 
     if not ctx.rule.kind in ["cc_binary", "cc_library", "cc_test"]:
         # We don't really know if these targets can be analysed, and we cannot remove them as 'unused'.
@@ -270,15 +375,27 @@ def _cc_meta_aspect_impl(target, ctx):
         target_should_skip = True
 
     # The list of exports is ready, no analysis required, write it.
+    unique_public_header_paths = collections.uniq(public_header_paths)
     ctx.actions.write(
         output = pub_hdrs_file,
         content = json.encode_indent([{
             "alwaysused": target_alwaysused,
-            "exports": collections.uniq(public_header_paths),
+            "deps": collections.uniq(dep_qualified_names),
+            "exports": unique_public_header_paths,
+            "files": collections.uniq([f.path for f in owned_files]),
             "target": target_qualified_name,
         }], indent = "  "),
     )
 
+    # Also write the exports in a compact line-oriented format, which is much cheaper to read for
+    # the dependency checks of all the dependents of this target.
+    pub_hdrs_lines = ["{}\t{}".format(target_qualified_name, "1" if target_alwaysused else "0")]
+    pub_hdrs_lines.extend(sorted(unique_public_header_paths))
+    ctx.actions.write(
+        output = pub_hdrs_txt_file,
+        content = "\n".join(pub_hdrs_lines) + "\n",
+    )
+
     # The output for a skipped target is essentially just the list of exports, the rest is empty.
     # Skipping means we should not attempt to parse any of its source files, and so, we cannot
     # create a usable compilation command, nor discover what it tries to include.
@@ -305,26 +422,23 @@ def _cc_meta_aspect_impl(target, ctx):
             }], indent = "  "),
         )
         return [
-            OutputGroupInfo(cc_meta = depset([comb_incl_file, comb_all_incl_file, comb_cmd_file, pub_hdrs_file, deps_issues_file])),
+            _cc_meta_output_groups(comb_incl_file, comb_all_incl_file, comb_cmd_file, pub_hdrs_file, deps_issues_file),
             CcMetaInfo(
                 direct_imports_json = comb_incl_file,
                 compile_commands_json = comb_cmd_file,
                 direct_exports = public_header_paths,
                 direct_exports_json = pub_hdrs_file,
+                direct_exports_txt = pub_hdrs_txt_file,
                 deps_issues_json = deps_issues_file,
             ),
         ]
 
     # Assemble list of buildable files (srcs and hdrs)
-    buildable_files = []
-
-    if hasattr(ctx.rule.attr, "srcs"):
-        for src in ctx.rule.attr.srcs:
-            buildable_files.extend(src.files.to_list())
+    buildable_files = srcs_files + hdrs_files
 
     # Check if it looks like we have an objective-c[++] library.
     is_target_objc = False
-    for f in buildable_files:
+    for f in srcs_files:
         # Any C/C++ source means it's not objective-c[++],
         # any objective-c[++] means that it is, and
         # any other file (header, assembly) could be for either kinds.
@@ -335,10 +449,6 @@ def _cc_meta_aspect_impl(target, ctx):
             is_target_objc = False
             break
 
-    if hasattr(ctx.rule.attr, "hdrs"):
-        for src in ctx.rule.attr.hdrs:
-            buildable_files.extend(src.files.to_list())
-
     # Now, we can get serious and find the C++ toolchain
     cc_toolchain = None
     feature_configuration = None
@@ -352,10 +462,21 @@ def _cc_meta_aspect_impl(target, ctx):
             unsupported_features = ["module_maps"] + ctx.disabled_features,
         )
 
+    # The direct includes of a single preprocessing are the top level headers of its trace (-H).
+    # Headers skipped by their include guard or #pragma once are only in the trace of clang, with
+    # -show-skipped-includes (GCC leaves out the #pragma once ones), and a header included directly
+    # after an earlier header pulled it in would be lost. Other compilers preprocess twice.
+    single_preprocessor_pass = (
+        ctx.attr._single_preprocessor_pass and
+        cc_toolchain != None and
+        cc_toolchain.compiler == "clang"
+    )
+
     # Assemble direct include lists and compile commands for each compilable file.
 
     incl_files = []
     all_incl_files = []
+    incl_trace_files = []
     comp_cmd_list = []
     for f in buildable_files:
         # The following bit emulates Bazel's logic to recognize the language of "cc" sources and headers.
@@ -422,7 +543,55 @@ def _cc_meta_aspect_impl(target, ctx):
             action_name = action_name,
         )
 
-        if not _is_external(ctx):
+        if not _is_external(ctx) and single_preprocessor_pass:
+            # Generate the deep list of includes (see below) and a trace of the included headers
+            # in a single preprocessing, the direct includes are recovered from the trace.
+            f_pkg_rel_path = paths.relativize(f.short_path, target.label.package)
+            all_incl_file = ctx.actions.declare_file(f_pkg_rel_path + ".cc_meta_all_includes_for_" + target.label.name)
+            all_incl_files.append(all_incl_file)
+            incl_trace_file = ctx.actions.declare_file(f_pkg_rel_path + ".cc_meta_includes_trace_for_" + target.label.name)
+            incl_trace_files.append(incl_trace_file)
+
+            cc_trace_compile_variables = cc_common.create_compile_variables(
+                feature_configuration = feature_configuration,
+                cc_toolchain = cc_toolchain,
+                user_compile_flags = user_flags + ["-M", "-MF", all_incl_file.path, "-E", "-MG", "-H", "-Xclang", "-show-skipped-includes"] + rule_flags,
+                source_file = f.path,
+                include_directories = target[CcInfo].compilation_context.includes,
+                quote_include_directories = target[CcInfo].compilation_context.quote_includes,
+                system_include_directories = depset(
+                    transitive = [target[CcInfo].compilation_context.system_includes, target[CcInfo].compilation_context.external_includes],
+                ),
+                framework_include_directories = target[CcInfo].compilation_context.framework_includes,
+                preprocessor_defines = depset(
+                    transitive = [
+                        target[CcInfo].compilation_context.defines,
+                        target[CcInfo].compilation_context.local_defines,
+                    ],
+                ),
+            )
+            cc_trace_command_line = cc_common.get_memory_inefficient_command_line(
+                feature_configuration = feature_configuration,
+                action_name = action_name,
+                variables = cc_trace_compile_variables,
+            )
+            cc_trace_env = cc_common.get_environment_variables(
+                feature_configuration = feature_configuration,
+                action_name = action_name,
+                variables = cc_trace_compile_variables,
+            )
+            ctx.actions.run(
+                mnemonic = "CcGetIncludesTrace",
+                executable = ctx.executable._run_trace_stderr,
+                arguments = [incl_trace_file.path, cc_compiler_path] + cc_trace_command_line,
+                env = cc_trace_env,
+                inputs = depset(
+                    [f],
+                    transitive = [target[CcInfo].compilation_context.headers, cc_toolchain.all_files],
+                ),
+                outputs = [all_incl_file, incl_trace_file],
+            )
+        elif not _is_external(ctx):
             # Generate a shallow list of includes, without system includes, which will later be
             # checked against the exports of direct dependencies.
 
@@ -465,8 +634,8 @@ def _cc_meta_aspect_impl(target, ctx):
                 arguments = [cc_compiler_path] + cc_incl_command_line,
                 env = cc_incl_env,
                 inputs = depset(
-                    [f] + target[CcInfo].compilation_context.headers.to_list(),
-                    transitive = [cc_toolchain.all_files],
+                    [f],
+                    transitive = [target[CcInfo].compilation_context.headers, cc_toolchain.all_files],
                 ),
                 outputs = [incl_file],
             )
@@ -514,8 +683,8 @@ def _cc_meta_aspect_impl(target, ctx):
                 arguments = [cc_compiler_path] + cc_all_incl_command_line,
                 env = cc_all_incl_env,
                 inputs = depset(
-                    [f] + target[CcInfo].compilation_context.headers.to_list(),
-                    transitive = [cc_toolchain.all_files],
+                    [f],
+                    transitive = [target[CcInfo].compilation_context.headers, cc_toolchain.all_files],
                 ),
                 outputs = [all_incl_file],
             )
@@ -562,19 +731,45 @@ def _cc_meta_aspect_impl(target, ctx):
         })
 
     # This action reads the Makefile outputs with includes for each source file into one json output file.
-    ctx.actions.run(
-        executable = ctx.executable._combine_includes_lists,
-        arguments = [f.path for f in incl_files] + [comb_incl_file.path] + [target_qualified_name],
-        inputs = depset(incl_files),
-        outputs = [comb_incl_file],
-    )
+    if single_preprocessor_pass:
+        # Both lists come out of the single preprocessing of each file (see above).
+        _run_cc_meta_tool(
+            ctx,
+            mnemonic = "CcMetaCombineIncludes",
+            executable = ctx.executable._combine_includes_lists,
+            arguments = ["--all_imports_out", comb_all_incl_file.path] + [f.path for f in all_incl_files] + [comb_incl_file.path] + [target_qualified_name],
+            repeated_options = {
+                "--builtin_include_dir": cc_toolchain.built_in_include_directories if cc_toolchain else [],
+                "--header_trace": [f.path for f in incl_trace_files],
+                "--include_dir": depset(transitive = [
+                    target[CcInfo].compilation_context.quote_includes,
+                    target[CcInfo].compilation_context.includes,
+                    target[CcInfo].compilation_context.system_includes,
+                    target[CcInfo].compilation_context.external_includes,
+                    target[CcInfo].compilation_context.framework_includes,
+                ]),
+            },
+            inputs = depset(all_incl_files + incl_trace_files),
+            outputs = [comb_incl_file, comb_all_incl_file],
+        )
+    else:
+        _run_cc_meta_tool(
+            ctx,
+            mnemonic = "CcMetaCombineIncludes",
+            executable = ctx.executable._combine_includes_lists,
+            arguments = [f.path for f in incl_files] + [comb_incl_file.path] + [target_qualified_name],
+            inputs = depset(incl_files),
+            outputs = [comb_incl_file],
+        )
 
-    ctx.actions.run(
-        executable = ctx.executable._combine_includes_lists,
-        arguments = [f.path for f in all_incl_files] + [comb_all_incl_file.path] + [target_qualified_name],
-        inputs = depset(all_incl_files),
-        outputs = [comb_all_incl_file],
-    )
+        _run_cc_meta_tool(
+            ctx,
+            mnemonic = "CcMetaCombineIncludes",
+            executable = ctx.executable._combine_includes_lists,
+            arguments = [f.path for f in all_incl_files] + [comb_all_incl_file.path] + [target_qualified_name],
+            inputs = depset(all_incl_files),
+            outputs = [comb_all_incl_file],
+        )
 
     # Output combined compiler commands list to json output file.
     ctx.actions.write(
@@ -602,10 +797,12 @@ def _cc_meta_aspect_impl(target, ctx):
         # If this target forwards its exports it will find itself for all its includes,
         # so that will make all its deps appear unused, so we just remove them.
         # We should still detect 'not_found' includes, so we still need to run the checker.
-        ctx.actions.run(
+        _run_cc_meta_tool(
+            ctx,
+            mnemonic = "CcMetaCheckDeps",
             executable = ctx.executable._check_direct_deps_exports,
-            arguments = [pub_hdrs_file.path] + [comb_incl_file.path] + [deps_issues_file.path],
-            inputs = depset([pub_hdrs_file] + [comb_incl_file]),
+            arguments = [pub_hdrs_txt_file.path] + [comb_incl_file.path] + [deps_issues_file.path],
+            inputs = depset([pub_hdrs_txt_file] + [comb_incl_file]),
             outputs = [deps_issues_file],
         )
     else:
@@ -615,23 +812,26 @@ def _cc_meta_aspect_impl(target, ctx):
         for dep in ctx.rule.attr.deps:
             if not CcMetaInfo in dep:
                 continue
-            deps_direct_exports.append(dep[CcMetaInfo].direct_exports_json)
+            deps_direct_exports.append(dep[CcMetaInfo].direct_exports_txt)
 
         # Check includes against exports from target itself and its direct dependencies.
-        ctx.actions.run(
+        _run_cc_meta_tool(
+            ctx,
+            mnemonic = "CcMetaCheckDeps",
             executable = ctx.executable._check_direct_deps_exports,
-            arguments = [f.path for f in deps_direct_exports] + [pub_hdrs_file.path] + [comb_incl_file.path] + [deps_issues_file.path],
-            inputs = depset(deps_direct_exports + [pub_hdrs_file] + [comb_incl_file]),
+            arguments = [f.path for f in deps_direct_exports] + [pub_hdrs_txt_file.path] + [comb_incl_file.path] + [deps_issues_file.path],
+            inputs = depset(deps_direct_exports + [pub_hdrs_txt_file] + [comb_incl_file]),
             outputs = [deps_issues_file],
         )
 
     return [
-        OutputGroupInfo(cc_meta = depset([comb_incl_file, comb_all_incl_file, comb_cmd_file, pub_hdrs_file, deps_issues_file])),
+        _cc_meta_output_groups(comb_incl_file, comb_all_incl_file, comb_cmd_file, pub_hdrs_file, deps_issues_file),
         CcMetaInfo(
             direct_imports_json = comb_incl_file,
             compile_commands_json = comb_cmd_file,
             direct_exports = public_header_paths,
             direct_exports_json = pub_hdrs_file,
+            direct_exports_txt = pub_hdrs_txt_file,
             deps_issues_json = deps_issues_file,
         ),
     ]
@@ -640,7 +840,8 @@ _CC_META_DEFAULT_SKIPPED_TAGS = ["cc_meta_skip"]
 
 def cc_meta_aspect_factory(
         deviations = [],
-        skipped_tags = []):
+        skipped_tags = [],
+        single_preprocessor_pass = False):
     """
     Create a C++ metadata aspect to gather information about C++ sources.
 
@@ -654,6 +855,11 @@ def cc_meta_aspect_factory(
     Args:
         deviations: List of targets created by make_cc_meta_deviations.
         skipped_tags: List of string tags to skip.
+        single_preprocessor_pass: Preprocess each file once, with all include paths and a header
+            trace (-H), instead of a second (shallow) pass to find direct includes. This halves
+            the preprocessing work, but direct includes are then recovered from the headers they
+            resolved to, which can differ from how they were written (see combine_includes_lists.py).
+            Only for clang toolchains, other compilers still preprocess twice.
     """
     return aspect(
         implementation = _cc_meta_aspect_impl,
@@ -681,6 +887,16 @@ def cc_meta_aspect_factory(
                 cfg = "exec",
                 doc = "Run a command with stdout to /dev/null.",
             ),
+            "_run_trace_stderr": attr.label(
+                default = Label("@bazel_cc_meta//cc_meta:run_trace_stderr"),
+                executable = True,
+                cfg = "exec",
+                doc = "Run a command with stdout to /dev/null and stderr to a file.",
+            ),
+            "_single_preprocessor_pass": attr.bool(
+                default = single_preprocessor_pass,
+                doc = "Whether to get direct and deep includes from a single preprocessing.",
+            ),
             "_skipped_tags": attr.string_list(
                 default = skipped_tags + _CC_META_DEFAULT_SKIPPED_TAGS,
                 doc = "Tags to identify targets to be skipped.",
@@ -736,5 +952,9 @@ def refresh_cc_meta(
     py_binary(
         name = name,
         srcs = [script_name],
+        deps = kwargs.pop("deps", []) + [
+            Label("//cc_meta:cc_meta_profiler"),
+            Label("//cc_meta:cc_meta_records"),
+        ],
         **kwargs
     )
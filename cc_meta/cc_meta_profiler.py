@@ -0,0 +1,124 @@
+"""
+Profiling of the phases of the cc_meta tools (refresh.py and fix_deps.py).
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+class Profiler:
+    """Records the time spent in each phase of the tool, along with some counters.
+
+    Phases and subprocesses are written as Chrome trace events (see --cc_meta_profile of refresh.py
+    and --profile of fix_deps.py), which can be opened in chrome://tracing or
+    https://ui.perfetto.dev, next to a bazel --profile. Counters (subprocesses, bytes read and
+    written, records) are attached to the phase they were counted in, and a summary table of the
+    phases is printed to stderr at exit.
+    """
+
+    def __init__(self):
+        self.file_name = ""
+        self.trace_events = []
+        self.phases = {}  # Phase name to counters, in order of first appearance.
+        self.current_phase = None
+        # Timestamps are in microseconds since the epoch, like bazel's own trace events.
+        self.epoch_ns = time.time_ns() - time.perf_counter_ns()
+
+    def enable(self, file_name: str):
+        self.file_name = file_name
+        atexit.register(self.finish)
+
+    def _add_trace_event(self, name: str, category: str, start_ns: int, args: dict):
+        self.trace_events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (self.epoch_ns + start_ns) // 1000,
+                "dur": (time.perf_counter_ns() - start_ns) // 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+        )
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        if not self.file_name:
+            yield
+            return
+        outer_phase = self.current_phase
+        self.current_phase = self.phases.setdefault(name, {"time": 0.0})
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.current_phase["time"] += (time.perf_counter_ns() - start_ns) / 1e9
+            self._add_trace_event(name, "phase", start_ns, dict(self.current_phase))
+            self.current_phase = outer_phase
+
+    @contextlib.contextmanager
+    def subprocess(self, name: str, count: int = 1):
+        if not self.file_name:
+            yield
+            return
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.count("subprocesses", count)
+            self.count("subprocess_time", (time.perf_counter_ns() - start_ns) / 1e9)
+            self._add_trace_event(name, "subprocess", start_ns, {"count": count})
+
+    def count(self, counter: str, value=1):
+        if self.current_phase is not None:
+            self.current_phase[counter] = self.current_phase.get(counter, 0) + value
+
+    def count_file(self, counter: str, file_name: str):
+        """Count the size of a file, e.g., as "bytes_read" or "bytes_written"."""
+        if self.current_phase is not None:
+            try:
+                self.count(counter, os.path.getsize(file_name))
+            except OSError:
+                pass
+
+    def finish(self):
+        with open(self.file_name, "w") as profile_file:
+            json.dump(
+                {"traceEvents": self.trace_events, "displayTimeUnit": "ms"},
+                profile_file,
+            )
+        columns = [
+            "time",
+            "subprocesses",
+            "subprocess_time",
+            "bytes_read",
+            "bytes_written",
+            "records",
+        ]
+        name_width = max([len("phase")] + [len(name) for name in self.phases])
+        print(
+            "{}  {}".format(
+                "phase".ljust(name_width), "  ".join(c.rjust(15) for c in columns)
+            ),
+            file=sys.stderr,
+        )
+        for name, counters in self.phases.items():
+            values = []
+            for column in columns:
+                value = counters.get(column, 0)
+                values.append(
+                    "{:.3f}".format(value) if isinstance(value, float) else str(value)
+                )
+            print(
+                "{}  {}".format(
+                    name.ljust(name_width), "  ".join(v.rjust(15) for v in values)
+                ),
+                file=sys.stderr,
+            )
+        print(">>> Profile written to {}".format(self.file_name), file=sys.stderr)
@@ -0,0 +1,93 @@
+"""
+Reading the databases written by the refresh tool, shared by the tools that use them.
+"""
+
+import bisect
+import json
+import os
+import sqlite3
+
+
+def find_records_file(file_name: str):
+    """Use the line-delimited variant of a database if that's what the refresh tool wrote."""
+    if not os.path.exists(file_name) and file_name.endswith(".json"):
+        ndjson_file_name = file_name[: -len(".json")] + ".ndjson"
+        if os.path.exists(ndjson_file_name):
+            return ndjson_file_name
+    return file_name
+
+
+def load_records(file_name: str, loads=json.loads):
+    """Read a database of records by target, from json or line-delimited json."""
+    with open(file_name, "rb") as f:
+        if not file_name.endswith(".ndjson"):
+            return loads(f.read())
+        records = {}
+        for record_line in f:
+            if record_line.strip():
+                record = loads(record_line)
+                records[record["target"]] = record
+    return records
+
+
+def reverse_path(include_path: str):
+    # Include paths with their components reversed (e.g., "bar.h/foo" for "foo/bar.h") sort
+    # together when they share a suffix (see target_exports.sqlite).
+    return "/".join(reversed(include_path.split("/")))
+
+
+class ExportsIndex:
+    """Finds the targets exporting an include path.
+
+    Uses the sqlite index written by the refresh tool (target_exports.sqlite) if given, otherwise
+    indexes the exports of each target in memory.
+    """
+
+    def __init__(self, exports_by_target=None, index_file_name: str = ""):
+        self.index_db = None
+        self.targets_by_export = {}
+        self.sorted_reversed_exports = []  # Sorted (reversed include path, target)
+        if index_file_name:
+            self.index_db = sqlite3.connect(
+                "file:{}?mode=ro".format(index_file_name), uri=True
+            )
+            return
+        for t, e in exports_by_target.items():
+            for incl_path in e["exports"]:
+                self.targets_by_export.setdefault(incl_path, []).append(t)
+                self.sorted_reversed_exports.append((reverse_path(incl_path), t))
+        self.sorted_reversed_exports.sort()
+
+    def find_exact(self, incl_path: str):
+        if self.index_db is None:
+            return sorted(set(self.targets_by_export.get(incl_path, [])))
+        return sorted(
+            row[0]
+            for row in self.index_db.execute(
+                "SELECT DISTINCT target FROM exports WHERE include_path = ?",
+                (incl_path,),
+            )
+        )
+
+    def find_by_suffix(self, incl_path: str):
+        """Find the targets exporting a longer path that ends with the include path.
+
+        E.g., 'a/foo/bar.h' for 'foo/bar.h', but not 'bar.h', which could be any other 'bar.h'.
+        """
+        # All reversed paths starting with 'prefix/' sort between 'prefix/' and 'prefix0'.
+        reversed_path = reverse_path(incl_path)
+        range_begin = reversed_path + "/"
+        range_end = reversed_path + "0"
+        if self.index_db is None:
+            begin_i = bisect.bisect_left(self.sorted_reversed_exports, (range_begin,))
+            end_i = bisect.bisect_left(self.sorted_reversed_exports, (range_end,))
+            return sorted({t for _, t in self.sorted_reversed_exports[begin_i:end_i]})
+        return sorted(
+            {
+                row[0]
+                for row in self.index_db.execute(
+                    "SELECT target FROM exports WHERE reversed_path >= ? AND reversed_path < ?",
+                    (range_begin, range_end),
+                )
+            }
+        )
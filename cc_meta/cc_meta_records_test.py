@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+import cc_meta_records
+import refresh
+
+_EXPORTS = {
+    "//a:a": {"target": "//a:a", "exports": ["a/foo/bar.h", "a/foo/baz.h"]},
+    "//b:b": {"target": "//b:b", "exports": ["bar.h"]},
+    "//c:c": {"target": "//c:c", "exports": ["foo/bar.h"]},
+    "//d:d": {"target": "//d:d", "exports": ["d/foo/bar.h", "d/xfoo/bar.h"]},
+}
+
+
+class ExportsIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        index_file_name = os.path.join(self.tmp_dir.name, "target_exports.sqlite")
+        refresh._write_exports_index(index_file_name, _EXPORTS)
+        self.exports_indexes = [
+            cc_meta_records.ExportsIndex(_EXPORTS),
+            cc_meta_records.ExportsIndex(index_file_name=index_file_name),
+        ]
+
+    def test_find_exact(self):
+        for exports_index in self.exports_indexes:
+            self.assertEqual(exports_index.find_exact("foo/bar.h"), ["//c:c"])
+            self.assertEqual(exports_index.find_exact("oo/bar.h"), [])
+
+    def test_find_by_suffix(self):
+        for exports_index in self.exports_indexes:
+            # Not 'bar.h' (//b:b), nor 'd/xfoo/bar.h', which only end with the same characters.
+            self.assertEqual(
+                exports_index.find_by_suffix("foo/bar.h"), ["//a:a", "//d:d"]
+            )
+            self.assertEqual(
+                exports_index.find_by_suffix("bar.h"), ["//a:a", "//c:c", "//d:d"]
+            )
+            self.assertEqual(exports_index.find_by_suffix("x/foo/bar.h"), [])
+
+
+class RecordsFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.json_file_name = os.path.join(self.tmp_dir.name, "target_exports.json")
+
+    def test_load_ndjson_records(self):
+        ndjson_file_name = os.path.join(self.tmp_dir.name, "target_exports.ndjson")
+        refresh._write_ndjson_records(ndjson_file_name, _EXPORTS)
+        self.assertEqual(
+            cc_meta_records.find_records_file(self.json_file_name), ndjson_file_name
+        )
+        self.assertEqual(cc_meta_records.load_records(ndjson_file_name), _EXPORTS)
+
+
+if __name__ == "__main__":
+    unittest.main()
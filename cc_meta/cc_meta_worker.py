@@ -0,0 +1,71 @@
+"""
+Shared entry point of the python tools run by the aspect (see _run_cc_meta_tool in cc_meta.bzl).
+
+The tools either run once, with their arguments in a flagfile, or as Bazel persistent workers
+(with --persistent_worker) serving work requests with the JSON worker protocol.
+"""
+
+import contextlib
+import io
+import json
+import sys
+import traceback
+
+
+def expand_flagfiles(argv: list):
+    # Bazel passes the arguments in a flagfile (see cc_meta.bzl), one argument per line.
+    expanded_argv = []
+    for arg in argv:
+        if arg.startswith("--flagfile="):
+            with open(arg[len("--flagfile=") :], "r") as flagfile:
+                expanded_argv.extend(flagfile.read().splitlines())
+        else:
+            expanded_argv.append(arg)
+    return expanded_argv
+
+
+def run_persistent_worker(main):
+    """Serve work requests from Bazel with main(argv), one at a time, until stdin is closed.
+
+    Workers are not multiplexed (see cc_meta.bzl), each worker process handles one request at a
+    time, so the output of a request can be captured by redirecting the process's stdout.
+    """
+    worker_stdout = sys.stdout
+    while True:
+        request_line = sys.stdin.readline()
+        if not request_line:
+            return 0
+        if not request_line.strip():
+            continue
+        work_request = json.loads(request_line)
+        request_output = io.StringIO()
+        with contextlib.redirect_stdout(request_output), contextlib.redirect_stderr(
+            request_output
+        ):
+            try:
+                # Bazel puts the contents of the flagfile in the request, expanding is harmless.
+                exit_code = main(expand_flagfiles(work_request.get("arguments", [])))
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except Exception:  # noqa: PIE786
+                # Any failure fails the action, with its traceback as the output of the request,
+                # but not the worker serving the other actions.
+                traceback.print_exc()
+                exit_code = 1
+        worker_stdout.write(
+            json.dumps(
+                {
+                    "exitCode": exit_code,
+                    "output": request_output.getvalue(),
+                    "requestId": work_request.get("requestId", 0),
+                }
+            )
+            + "\n"
+        )
+        worker_stdout.flush()
+
+
+def run_tool(main, argv: list):
+    if "--persistent_worker" in argv:
+        return run_persistent_worker(main)
+    return main(expand_flagfiles(argv))
@@ -2,40 +2,58 @@ import argparse
 import json
 import sys
 
+import cc_meta_worker
+
 
 def read_json_file(file_name):
     with open(file_name, "r") as file:
         return json.load(file)
 
 
-if __name__ == "__main__":
+def read_exports_file(file_name):
+    """Read a list of target exports, from json or from the line-oriented format.
+
+    The line-oriented format (see cc_meta.bzl) has a first line with the target name and
+    whether it is always used ("1" or "0") separated by a tab, followed by one export per line.
+    """
+    if file_name.endswith(".json"):
+        dep_exports = read_json_file(file_name)
+        if isinstance(dep_exports, list):
+            return dep_exports
+        return [dep_exports]
+    with open(file_name, "r") as file:
+        target_name, alwaysused = file.readline().rstrip("\n").split("\t")
+        exports = file.read().splitlines()
+    return [
+        {"alwaysused": alwaysused == "1", "exports": exports, "target": target_name}
+    ]
+
+
+def main(argv):
     parser = argparse.ArgumentParser(
         prog="CheckDirectDepsExports",
         description="Check the include lists for several includes dumps (-MF).",
     )
     parser.add_argument("file_list", nargs="*")
-    args = parser.parse_args()
-    print(args.file_list)
+    args = parser.parse_args(argv)
     if len(args.file_list) < 2:
         print(
             "No target imports and output file provided. Aborting...", file=sys.stderr
         )
-        sys.exit(1)
+        return 1
 
     out_file_name = args.file_list[-1]
     deps_exports = []
     for in_file_name in args.file_list[:-2]:
-        dep_exports = read_json_file(in_file_name)
-        if isinstance(dep_exports, list):
-            deps_exports.extend(dep_exports)
-        else:
-            deps_exports.append(dep_exports)
+        deps_exports.extend(read_exports_file(in_file_name))
 
-    exports_to_deps = []
+    # Index the exports, when several deps export the same path, the first by name gets it.
+    deps_by_export = {}
     for dep_exports in deps_exports:
         for dep_export in dep_exports["exports"]:
-            exports_to_deps.append((dep_export, dep_exports["target"]))
-    exports_to_deps.sort()
+            prior_dep = deps_by_export.get(dep_export)
+            if prior_dep is None or dep_exports["target"] < prior_dep:
+                deps_by_export[dep_export] = dep_exports["target"]
 
     # Expecting only one target, but why not support a list (stored as a list anyway)
     targets_imports = read_json_file(args.file_list[-2])
@@ -44,67 +62,38 @@ if __name__ == "__main__":
     # Fuse by target
     targets_imports_by_target = {}
     for target_imports in targets_imports:
-        if target_imports["target"] not in targets_imports_by_target:
-            targets_imports_by_target.update(
-                {
-                    target_imports["target"]: set(
-                        [(imp, "") for imp in target_imports["imports"]]
-                    )
-                }
-            )
-        else:
-            targets_imports_by_target.update(
-                {
-                    target_imports["target"]: targets_imports_by_target[
-                        target_imports["target"]
-                    ]
-                    | set([(imp, "") for imp in target_imports["imports"]])
-                }
-            )
+        targets_imports_by_target.setdefault(target_imports["target"], set()).update(
+            target_imports["imports"]
+        )
+
+    deps_alwaysused = {}
+    for dep_exports in deps_exports:
+        deps_alwaysused[dep_exports["target"]] = dep_exports["alwaysused"]
+
     targets_deps_issues = []
-    for target_imports_set in targets_imports_by_target.values():
-        target_imports_list = sorted(target_imports_set)
-
-        deps_usage = {}
-        for dep_exports in deps_exports:
-            deps_usage.update(
-                {
-                    dep_exports["target"]: {
-                        "used": dep_exports["alwaysused"]
-                        or dep_exports["target"] == target_imports["target"]
-                    }
-                }
-            )
-
-        imp_i = 0
-        exp_i = 0
-        while imp_i < len(target_imports_list):
-            imp_name = target_imports_list[imp_i][0]
-            while exp_i < len(exports_to_deps) and exports_to_deps[exp_i][0] < imp_name:
-                exp_i = exp_i + 1
-            if exp_i >= len(exports_to_deps):
-                break
-            if imp_name == exports_to_deps[exp_i][0]:
-                target_imports_list[imp_i] = (imp_name, exports_to_deps[exp_i][1])
-                deps_usage[exports_to_deps[exp_i][1]]["used"] = True
-            imp_i = imp_i + 1
+    for target_name, target_imports_set in targets_imports_by_target.items():
+        deps_usage = {
+            dep_name: alwaysused or dep_name == target_name
+            for dep_name, alwaysused in deps_alwaysused.items()
+        }
 
         imp_matches = {}
         imp_not_found = []
-        for imp_path, imp_dep in target_imports_list:
-            if not imp_dep:
+        for imp_path in sorted(target_imports_set):
+            imp_dep = deps_by_export.get(imp_path)
+            if imp_dep is None:
                 imp_not_found.append(imp_path)
             else:
-                imp_matches.update({imp_path: imp_dep})
+                imp_matches[imp_path] = imp_dep
+                deps_usage[imp_dep] = True
 
-        dep_unused = []
-        for dep_name, dep_used in deps_usage.items():
-            if not dep_used["used"]:
-                dep_unused.append(dep_name)
+        dep_unused = [
+            dep_name for dep_name, dep_used in deps_usage.items() if not dep_used
+        ]
 
         targets_deps_issues.append(
             {
-                "target": target_imports["target"],
+                "target": target_name,
                 "matches": imp_matches,
                 "not_found": imp_not_found,
                 "unused": dep_unused,
@@ -113,3 +102,8 @@ if __name__ == "__main__":
 
     with open(out_file_name, "w") as out_file:
         json.dump(targets_deps_issues, out_file, sort_keys=True, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cc_meta_worker.run_tool(main, sys.argv[1:]))
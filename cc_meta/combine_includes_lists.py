@@ -1,7 +1,10 @@
 import argparse
 import json
+import os
 import sys
 
+import cc_meta_worker
+
 
 def make_includes_list(file_name):
     with open(file_name, "r") as file:
@@ -14,29 +17,152 @@ def make_includes_list(file_name):
     return md_includes_list[1], md_includes_list[2:]
 
 
-if __name__ == "__main__":
+def read_header_trace(file_name):
+    """Read the headers included by a source file from its header trace (-H).
+
+    The compilers print one line per included header, prefixed with one dot per level of
+    inclusion, so the direct includes are those with a single dot. Headers skipped because they
+    were already included must also be in the trace (clang's -show-skipped-includes), otherwise
+    they are missing from the direct includes. Returns the direct headers and the set of all the
+    headers in the trace.
+    """
+    direct_headers = []
+    traced_headers = set()
+    with open(file_name, "r") as file:
+        for line in file:
+            dots, _, header_path = line.rstrip("\n").partition(" ")
+            if not dots or dots.strip(".") or not header_path:
+                continue
+            header_path = os.path.normpath(header_path)
+            traced_headers.add(header_path)
+            if dots == ".":
+                direct_headers.append(header_path)
+    return direct_headers, traced_headers
+
+
+def get_unresolved_includes(imp_list, traced_headers, builtin_include_dirs):
+    """List the includes of an includes dump (-MG) that the preprocessor could not find.
+
+    Headers that are not found are not in the header trace, but -MG lists them in the includes
+    dump as they were written, like the shallow pass does (see cc_meta.bzl). Since they could be
+    included from anywhere, they are all reported as direct includes, such that missing
+    dependencies are not lost. Files included with -include are also never in the trace, and
+    are also reported, like in the shallow pass.
+    """
+    unresolved_includes = []
+    for imp_path in imp_list:
+        if os.path.isabs(imp_path) or os.path.normpath(imp_path) in traced_headers:
+            continue
+        if any(
+            _is_under_dir(os.path.normpath(imp_path), d) for d in builtin_include_dirs
+        ):
+            continue
+        unresolved_includes.append(imp_path)
+    return unresolved_includes
+
+
+def _is_under_dir(path, dir_path):
+    return dir_path == "." or path.startswith(dir_path + "/")
+
+
+def get_include_spelling(header_path, source_file, include_dirs, builtin_include_dirs):
+    """Recover how a direct include was (most likely) written from the header it resolved to.
+
+    This emulates what the shallow pass without include paths reports (see cc_meta.bzl): a
+    header found relative to the source file is listed with its path, and any other header
+    with the shortest path that some include directory would resolve to it. Headers from the
+    compiler's built-in directories are system headers and are not listed.
+    """
+    if _is_under_dir(header_path, os.path.dirname(source_file)):
+        return header_path
+    for builtin_include_dir in builtin_include_dirs:
+        if _is_under_dir(header_path, builtin_include_dir):
+            return ""
+    spelling = ""
+    for include_dir in include_dirs:
+        if not _is_under_dir(header_path, include_dir):
+            continue
+        candidate = os.path.relpath(header_path, include_dir)
+        if not spelling or len(candidate) < len(spelling):
+            spelling = candidate
+    if not spelling and not os.path.isabs(header_path):
+        spelling = header_path
+    return spelling
+
+
+def main(argv):
     parser = argparse.ArgumentParser(
         prog="CombineIncludesLists",
         description="Combine the include lists for several includes dumps (-MF).",
     )
     parser.add_argument("file_list", nargs="*")
-    args = parser.parse_args()
-    print(args.file_list)
+    parser.add_argument(
+        "--header_trace",
+        action="append",
+        default=[],
+        help="Header trace (-H) of the preprocessing that produced each includes dump, "
+        "in the same order, to list direct includes from a single (deep) preprocessing.",
+    )
+    parser.add_argument(
+        "--include_dir",
+        action="append",
+        default=[],
+        help="Include directory of the preprocessing, used with --header_trace.",
+    )
+    parser.add_argument(
+        "--builtin_include_dir",
+        action="append",
+        default=[],
+        help="Built-in include directory of the compiler, used with --header_trace.",
+    )
+    parser.add_argument(
+        "--all_imports_out",
+        default="",
+        help="Also write the deep include lists of the includes dumps to this file.",
+    )
+    args = parser.parse_args(argv)
     if len(args.file_list) < 2:
         print(
             "No output file and target name argument provided. Aborting...",
             file=sys.stderr,
         )
-        sys.exit(1)
+        return 1
+    if args.header_trace and len(args.header_trace) != len(args.file_list) - 2:
+        print(
+            "Header traces do not match the includes dumps. Aborting...",
+            file=sys.stderr,
+        )
+        return 1
 
+    include_dirs = [os.path.normpath(d) for d in args.include_dir]
+    builtin_include_dirs = [os.path.normpath(d) for d in args.builtin_include_dir]
     target_name = args.file_list[-1]
     combined_inc_list = []
-    for in_file_name in args.file_list[:-2]:
+    combined_all_inc_list = []
+    for i, in_file_name in enumerate(args.file_list[:-2]):
         src_file, imp_list = make_includes_list(in_file_name)
-        if src_file:
-            combined_inc_list.append(
+        if not src_file:
+            continue
+        if args.all_imports_out:
+            combined_all_inc_list.append(
                 {"source_file": src_file, "target": target_name, "imports": imp_list}
             )
+        if args.header_trace:
+            direct_headers, traced_headers = read_header_trace(args.header_trace[i])
+            direct_imp_list = []
+            for header_path in direct_headers:
+                spelling = get_include_spelling(
+                    header_path, src_file, include_dirs, builtin_include_dirs
+                )
+                if spelling:
+                    direct_imp_list.append(spelling)
+            direct_imp_list.extend(
+                get_unresolved_includes(imp_list, traced_headers, builtin_include_dirs)
+            )
+            imp_list = list(dict.fromkeys(direct_imp_list))
+        combined_inc_list.append(
+            {"source_file": src_file, "target": target_name, "imports": imp_list}
+        )
 
     out_file_name = args.file_list[-2]
     with open(out_file_name, "w") as out_file:
@@ -45,3 +171,15 @@ if __name__ == "__main__":
             out_file,
             indent=2,
         )
+    if args.all_imports_out:
+        with open(args.all_imports_out, "w") as out_file:
+            json.dump(
+                combined_all_inc_list,
+                out_file,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cc_meta_worker.run_tool(main, sys.argv[1:]))
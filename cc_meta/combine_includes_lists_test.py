@@ -0,0 +1,112 @@
+import json
+import os
+import tempfile
+import unittest
+
+import combine_includes_lists
+
+# What gcc 12 writes for 'gcc -Iinc -M -MF all.d -E -MG -H pkg/main.cc' (trimmed), when main.cc
+# includes "foo/a.h" (found in inc/, and including <vector>), "local.h" and "missing/dep.h".
+_ALL_INCLUDES_DUMP = """main.o: pkg/main.cc /usr/include/stdc-predef.h inc/foo/a.h \\
+ /usr/include/c++/12/vector /usr/include/c++/12/bits/stl_algobase.h \\
+ pkg/local.h missing/dep.h
+"""
+
+# Headers that are not found (missing/dep.h) are not in the trace.
+_HEADER_TRACE = """. inc/foo/a.h
+.. /usr/include/c++/12/vector
+... /usr/include/c++/12/bits/stl_algobase.h
+. pkg/local.h
+Multiple include guards may be useful for:
+/usr/include/c++/12/bits/stl_algobase.h
+"""
+
+
+class CombineIncludesListsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def _write_file(self, file_name, content):
+        file_path = os.path.join(self.tmp_dir.name, file_name)
+        with open(file_path, "w") as file:
+            file.write(content)
+        return file_path
+
+    def _read_imports(self, file_path):
+        with open(file_path, "r") as file:
+            return json.load(file)[0]["imports"]
+
+    def test_single_pass_keeps_missing_headers(self):
+        all_incl_file = self._write_file("main.cc.all_includes", _ALL_INCLUDES_DUMP)
+        trace_file = self._write_file("main.cc.includes_trace", _HEADER_TRACE)
+        comb_incl_file = os.path.join(self.tmp_dir.name, "imports.json")
+        comb_all_incl_file = os.path.join(self.tmp_dir.name, "all_imports.json")
+        exit_code = combine_includes_lists.main(
+            [
+                "--header_trace",
+                trace_file,
+                "--include_dir",
+                "inc",
+                "--builtin_include_dir",
+                "/usr/include",
+                "--all_imports_out",
+                comb_all_incl_file,
+                all_incl_file,
+                comb_incl_file,
+                "@@//pkg:main",
+            ]
+        )
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(
+            self._read_imports(comb_incl_file),
+            ["foo/a.h", "pkg/local.h", "missing/dep.h"],
+        )
+        self.assertIn("missing/dep.h", self._read_imports(comb_all_incl_file))
+
+    def test_single_pass_keeps_skipped_direct_includes(self):
+        # main.cc includes "foo/a.h", which includes "foo/guarded.h", and then "foo/guarded.h"
+        # itself: clang -show-skipped-includes lists it again, although its guard skips it.
+        all_incl_file = self._write_file(
+            "main.cc.all_includes",
+            "main.o: pkg/main.cc inc/foo/a.h inc/foo/guarded.h\n",
+        )
+        trace_file = self._write_file(
+            "main.cc.includes_trace",
+            ". inc/foo/a.h\n.. inc/foo/guarded.h\n. inc/foo/guarded.h\n",
+        )
+        comb_incl_file = os.path.join(self.tmp_dir.name, "imports.json")
+        exit_code = combine_includes_lists.main(
+            [
+                "--header_trace",
+                trace_file,
+                "--include_dir",
+                "inc",
+                all_incl_file,
+                comb_incl_file,
+                "@@//pkg:main",
+            ]
+        )
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(
+            self._read_imports(comb_incl_file), ["foo/a.h", "foo/guarded.h"]
+        )
+
+    def test_shallow_includes_dump(self):
+        incl_file = self._write_file(
+            "main.cc.includes",
+            "main.o: pkg/main.cc foo/a.h \\\n pkg/local.h missing/dep.h\n",
+        )
+        comb_incl_file = os.path.join(self.tmp_dir.name, "imports.json")
+        exit_code = combine_includes_lists.main(
+            [incl_file, comb_incl_file, "@@//pkg:main"]
+        )
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(
+            self._read_imports(comb_incl_file),
+            ["foo/a.h", "pkg/local.h", "missing/dep.h"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
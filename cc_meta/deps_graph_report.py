@@ -0,0 +1,279 @@
+"""
+This script reports where removing or narrowing deps would shrink the build graph the most.
+
+The dependency issues only list the direct deps that a target does not use, but the cost of a dep
+is everything it pulls in transitively, for the target and for all that depend on it. Using the
+deps of each target (from target_exports.json) and the include paths it uses from each of them
+(from target_deps_usage.json, see the --cc_meta_deps_usage option of the refresh tool), this
+computes, for each dep of each target, how much the transitive closure of the target would shrink:
+
+ - if the dep were removed, when the target does not use it, or
+ - if the dep were replaced by another target exporting all the include paths used from it.
+
+Savings are ranked by the shrink of the closure times the number of targets that would see it
+(the target and its transitive dependents), an upper bound of the number of targets that would no
+longer be needed when building them.
+
+Closures are bitsets (python integers) over target ids numbered in topological order, computed in
+one pass from the leaves up, and freed as soon as all dependents of a target are done.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import cc_meta_records
+
+
+if hasattr(int, "bit_count"):
+    _popcount = int.bit_count
+else:
+    # Before python 3.10.
+    def _popcount(bits: int):
+        return bin(bits).count("1")
+
+
+class _DepsGraph:
+    """The deps of all targets, by integer ids such that deps always come before dependents."""
+
+    def __init__(self, exports_by_target: dict):
+        self.names = []
+        self.deps = []  # Target id to the ids of its deps
+        ids = {}
+        # Iterative depth-first search, numbering targets after all their deps (post-order).
+        for root_name in sorted(exports_by_target):
+            if root_name in ids:
+                continue
+            ids[root_name] = None
+            stack = [(root_name, iter(exports_by_target[root_name].get("deps", [])))]
+            while stack:
+                name, deps_iter = stack[-1]
+                for dep_name in deps_iter:
+                    if dep_name not in ids:
+                        ids[dep_name] = None
+                        dep_exports = exports_by_target.get(dep_name, {})
+                        stack.append((dep_name, iter(dep_exports.get("deps", []))))
+                        break
+                else:
+                    stack.pop()
+                    ids[name] = len(self.names)
+                    self.names.append(name)
+                    self.deps.append(
+                        sorted(
+                            {
+                                ids[d]
+                                for d in exports_by_target.get(name, {}).get("deps", [])
+                                if ids[d] is not None
+                            }
+                        )
+                    )
+        self.ids = ids
+
+    def count_dependents(self):
+        """Count the transitive dependents of each target, with one pass from the roots down."""
+        dependents = [[] for _ in self.names]
+        remaining_deps = [len(target_deps) for target_deps in self.deps]
+        for target_id, target_deps in enumerate(self.deps):
+            for dep_id in target_deps:
+                dependents[dep_id].append(target_id)
+        ancestors = [0] * len(self.names)
+        dependents_count = [0] * len(self.names)
+        for target_id in reversed(range(len(self.names))):
+            target_ancestors = 1 << target_id
+            for dependent_id in dependents[target_id]:
+                target_ancestors |= ancestors[dependent_id]
+                remaining_deps[dependent_id] -= 1
+                if remaining_deps[dependent_id] == 0:
+                    ancestors[dependent_id] = 0
+            dependents_count[target_id] = _popcount(target_ancestors) - 1
+            if remaining_deps[target_id]:
+                ancestors[target_id] = target_ancestors
+        return dependents_count
+
+
+def _find_replacements(
+    graph: _DepsGraph, exports_by_target: dict, deps_usage_by_target: dict
+):
+    """Find the other targets exporting all the include paths that each target uses from each dep."""
+    providers = {}
+    for target_name, target_exports in exports_by_target.items():
+        for incl_path in target_exports["exports"]:
+            providers.setdefault(incl_path, set()).add(target_name)
+    replacements = {}  # (target id, dep id) to ids of replacement targets
+    for target_name, deps_usage in deps_usage_by_target.items():
+        target_id = graph.ids.get(target_name)
+        if target_id is None:
+            continue
+        for dep_name, incl_paths in deps_usage.items():
+            dep_id = graph.ids.get(dep_name)
+            if dep_id is None or not incl_paths:
+                continue
+            candidates = set.intersection(
+                *[providers.get(incl_path, set()) for incl_path in incl_paths]
+            )
+            candidates -= {target_name, dep_name}
+            if candidates:
+                replacements[(target_id, dep_id)] = sorted(
+                    graph.ids[c] for c in candidates
+                )
+    return replacements
+
+
+def analyze_deps_graph(exports_by_target: dict, deps_usage_by_target: dict):
+    """List the closure shrink for removing unused deps and replacing used deps, ranked by savings."""
+    graph = _DepsGraph(exports_by_target)
+    names = graph.names
+    replacements = _find_replacements(graph, exports_by_target, deps_usage_by_target)
+    dependents_count = graph.count_dependents()
+
+    # Replacement targets keep their closure until the end, the others only until all their
+    # dependents are done.
+    pinned = set()
+    for replacement_ids in replacements.values():
+        pinned.update(replacement_ids)
+    remaining_dependents = [0] * len(names)
+    for target_deps in graph.deps:
+        for dep_id in target_deps:
+            remaining_dependents[dep_id] += 1
+
+    closures = [0] * len(names)
+    closure_sizes = [0] * len(names)
+    deferred = []  # (target id, dep id, replacement id, closure without the dep)
+    findings = []
+
+    def add_finding(target_id, dep_id, rest_closure, replacement_id=None):
+        new_closure = rest_closure
+        if replacement_id is not None:
+            new_closure |= closures[replacement_id]
+        shrink = closure_sizes[target_id] - _popcount(new_closure)
+        if shrink <= 0:
+            return
+        finding = {
+            "target": names[target_id],
+            "dep": names[dep_id],
+            "closure_size": closure_sizes[target_id],
+            "shrink": shrink,
+            "dependents": dependents_count[target_id],
+            "savings": shrink * (1 + dependents_count[target_id]),
+        }
+        if replacement_id is not None:
+            finding["replacement"] = names[replacement_id]
+        findings.append(finding)
+
+    for target_id, target_deps in enumerate(graph.deps):
+        target_name = names[target_id]
+        dep_closures = [closures[dep_id] for dep_id in target_deps]
+        # Closures without each dep are the OR of the closures of the deps before and after it.
+        prefix_closures = [1 << target_id]
+        for dep_closure in dep_closures:
+            prefix_closures.append(prefix_closures[-1] | dep_closure)
+        closures[target_id] = prefix_closures[-1]
+        closure_sizes[target_id] = _popcount(closures[target_id])
+
+        target_exports = exports_by_target.get(target_name)
+        deps_usage = deps_usage_by_target.get(target_name)
+        suffix_closure = 0
+        for i in reversed(range(len(target_deps))):
+            dep_id = target_deps[i]
+            rest_closure = prefix_closures[i] | suffix_closure
+            suffix_closure |= dep_closures[i]
+            if target_exports is None or deps_usage is None:
+                continue
+            if names[dep_id] not in deps_usage:
+                if not exports_by_target.get(names[dep_id], {}).get("alwaysused"):
+                    add_finding(target_id, dep_id, rest_closure)
+                continue
+            for replacement_id in replacements.get((target_id, dep_id), []):
+                if replacement_id < target_id:
+                    add_finding(target_id, dep_id, rest_closure, replacement_id)
+                else:
+                    deferred.append((target_id, dep_id, replacement_id, rest_closure))
+
+        for dep_id in target_deps:
+            remaining_dependents[dep_id] -= 1
+            if remaining_dependents[dep_id] == 0 and dep_id not in pinned:
+                closures[dep_id] = 0
+        if remaining_dependents[target_id] == 0 and target_id not in pinned:
+            closures[target_id] = 0
+
+    for target_id, dep_id, replacement_id, rest_closure in deferred:
+        # A replacement that depends on the target would make a cycle.
+        if not (closures[replacement_id] >> target_id) & 1:
+            add_finding(target_id, dep_id, rest_closure, replacement_id)
+
+    findings.sort(key=lambda f: (-f["savings"], f["target"], f["dep"]))
+    return findings
+
+
+def _parse_args(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="CcMetaDepsGraphReport",
+        description="Rank the deps whose removal or replacement would shrink the build graph most.",
+    )
+    parser.add_argument("-e", "--exports", default="target_exports.json")
+    parser.add_argument(
+        "-u",
+        "--usage",
+        default="target_deps_usage.json",
+        help="Include paths used by each target from each dep (written by the refresh tool with "
+        "--cc_meta_deps_usage).",
+    )
+    parser.add_argument(
+        "-o", "--output", default="", help="Write all findings to this json file."
+    )
+    parser.add_argument(
+        "-n", "--top", type=int, default=20, help="Number of findings to print."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = _parse_args(sys.argv[1:])
+
+    # Under `bazel run`, the databases are in the workspace root.
+    if "BUILD_WORKSPACE_DIRECTORY" in os.environ:
+        os.chdir(os.environ["BUILD_WORKSPACE_DIRECTORY"])
+
+    if not os.path.exists(args.usage):
+        print(
+            "ERROR: Could not find {}, run the refresh tool with --cc_meta_deps_usage.".format(
+                args.usage
+            ),
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    exports_by_target = cc_meta_records.load_records(
+        cc_meta_records.find_records_file(args.exports)
+    )
+    with open(args.usage, "r") as f:
+        deps_usage_by_target = json.load(f)
+
+    findings = analyze_deps_graph(exports_by_target, deps_usage_by_target)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(findings, f, indent=2)
+
+    print(
+        ">>> Found {} deps to remove or replace, top {}:".format(
+            len(findings), min(args.top, len(findings))
+        )
+    )
+    for finding in findings[: args.top]:
+        if "replacement" in finding:
+            action = "replace {} with {}".format(finding["dep"], finding["replacement"])
+        else:
+            action = "remove {}".format(finding["dep"])
+        print(
+            "{:>10}  {}: {} (-{} of {} targets, {} dependents)".format(
+                finding["savings"],
+                finding["target"],
+                action,
+                finding["shrink"],
+                finding["closure_size"],
+                finding["dependents"],
+            )
+        )
+    sys.exit(0)
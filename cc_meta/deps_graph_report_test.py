@@ -0,0 +1,65 @@
+import unittest
+
+import deps_graph_report
+
+# //bin:bin -> //app:app, which uses small.h from //lib:big (also exported by //lib:small), does
+# not use //lib:unused, and does not use //lib:always either, which is always used.
+_EXPORTS = {
+    "//bin:bin": {"exports": [], "deps": ["//app:app"]},
+    "//app:app": {
+        "exports": ["app.h"],
+        "deps": ["//lib:big", "//lib:unused", "//lib:always"],
+    },
+    "//lib:big": {
+        "exports": ["small.h", "big.h"],
+        "deps": ["//lib:heavy1", "//lib:heavy2"],
+    },
+    "//lib:small": {"exports": ["small.h"], "deps": []},
+    "//lib:unused": {"exports": ["unused.h"], "deps": ["//lib:heavy3", "//lib:heavy4"]},
+    "//lib:always": {"exports": ["always.h"], "deps": [], "alwaysused": True},
+    "//lib:heavy1": {"exports": ["heavy1.h"], "deps": []},
+    "//lib:heavy2": {"exports": ["heavy2.h"], "deps": []},
+    "//lib:heavy3": {"exports": ["heavy3.h"], "deps": []},
+    "//lib:heavy4": {"exports": ["heavy4.h"], "deps": []},
+}
+
+_DEPS_USAGE = {
+    "//app:app": {"//lib:big": ["small.h"]},
+}
+
+
+class DepsGraphReportTest(unittest.TestCase):
+    def test_ranked_removals_and_replacements(self):
+        findings = deps_graph_report.analyze_deps_graph(_EXPORTS, _DEPS_USAGE)
+        self.assertEqual(
+            findings,
+            [
+                {
+                    "target": "//app:app",
+                    "dep": "//lib:unused",
+                    "closure_size": 8,
+                    "shrink": 3,
+                    "dependents": 1,
+                    "savings": 6,
+                },
+                {
+                    "target": "//app:app",
+                    "dep": "//lib:big",
+                    "closure_size": 8,
+                    "shrink": 2,
+                    "dependents": 1,
+                    "savings": 4,
+                    "replacement": "//lib:small",
+                },
+            ],
+        )
+
+    def test_replacement_depending_on_the_target_is_skipped(self):
+        exports = dict(_EXPORTS)
+        exports["//lib:small"] = {"exports": ["small.h"], "deps": ["//app:app"]}
+        findings = deps_graph_report.analyze_deps_graph(exports, _DEPS_USAGE)
+        self.assertEqual([f["dep"] for f in findings], ["//lib:unused"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,41 +4,376 @@ This script takes dependency issues and fixes them using buildozer.
 
 import argparse
 import json
+import mmap
 import os
 import pathlib
 import subprocess
 import sys
+import tempfile
 
+import cc_meta_profiler
+import cc_meta_records
 
-def _resolve_targets_for_source(source_path: str):
-    target_resolve_process = subprocess.run(
-        ["bazel", "query", "same_pkg_direct_rdeps({})".format(source_path)],
-        capture_output=True,
-    )
-    if target_resolve_process.returncode != 0:
+_profiler = cc_meta_profiler.Profiler()
+
+
+def _resolve_targets_for_sources(source_paths: list):
+    if not source_paths:
+        return []
+    # Put the query in a file, the set of files could be too long for the command line.
+    with tempfile.NamedTemporaryFile(
+        mode="w", prefix="cc_meta_query_", suffix=".txt"
+    ) as query_file:
+        query_file.write(
+            "same_pkg_direct_rdeps(set({}))".format(
+                " ".join(['"{}"'.format(p) for p in source_paths])
+            )
+        )
+        query_file.flush()
+        with _profiler.subprocess("bazel query"):
+            target_resolve_process = subprocess.run(
+                [
+                    "bazel",
+                    "query",
+                    "--query_file={}".format(query_file.name),
+                    "--keep_going",
+                ],
+                capture_output=True,
+            )
+    if target_resolve_process.returncode not in [0, 3]:
         return []
     return [
         t_ln.decode().strip() for t_ln in target_resolve_process.stdout.splitlines()
     ]
 
 
+def _load_owners(owners_file_name: str):
+    try:
+        with open(owners_file_name, "r") as f:
+            return json.load(f)
+    except OSError:
+        return {}
+
+
 _resolved_targets = {}
 
 
-def _resolve_target_name(raw_target: str):
-    if raw_target in _resolved_targets:
-        return _resolved_targets[raw_target]
-    target_resolve_process = subprocess.run(
-        ["bazel", "query", raw_target],
-        capture_output=True,
-    )
+def _query_target_name(raw_target: str):
+    with _profiler.subprocess("bazel query"):
+        target_resolve_process = subprocess.run(
+            ["bazel", "query", raw_target],
+            capture_output=True,
+        )
     resolved_target = raw_target
     if target_resolve_process.returncode == 0:
         resolved_target = target_resolve_process.stdout.decode().strip()
-    _resolved_targets[raw_target] = resolved_target
     return resolved_target
 
 
+# Files that change how labels of external repositories resolve.
+_REPO_MAPPING_FILES = [
+    "MODULE.bazel",
+    "MODULE.bazel.lock",
+    "WORKSPACE",
+    "WORKSPACE.bazel",
+    "WORKSPACE.bzlmod",
+]
+
+
+def _get_file_stamp(file_name: str):
+    try:
+        return os.stat(file_name).st_mtime_ns
+    except OSError:
+        return None
+
+
+class _LabelCache:
+    """Persistent cache of resolved target names.
+
+    Entries for targets of the main repository are invalidated by changes to their package's
+    BUILD file, and the whole cache is invalidated by changes to the repository mapping files.
+    """
+
+    _VERSION = 1
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.repo_mapping_stamp = [_get_file_stamp(f) for f in _REPO_MAPPING_FILES]
+        self.build_file_stamps = {}  # Package to BUILD file stamp
+        self.entries = {}
+        self.modified = False
+        if not file_name:
+            return
+        try:
+            with open(file_name, "r") as f:
+                cached = json.load(f)
+            if (
+                cached["version"] == self._VERSION
+                and cached["repo_mapping_stamp"] == self.repo_mapping_stamp
+            ):
+                self.entries = cached["entries"]
+        except (OSError, ValueError, KeyError):
+            # A missing or stale cache only means we have to query everything.
+            self.entries = {}
+
+    def _get_build_file_stamp(self, raw_target: str):
+        if not raw_target.startswith("@@//"):
+            return None
+        package = raw_target[len("@@//") :].partition(":")[0]
+        if package not in self.build_file_stamps:
+            self.build_file_stamps[package] = [
+                _get_file_stamp(os.path.join(package, build_file_name))
+                for build_file_name in ["BUILD.bazel", "BUILD"]
+            ]
+        return self.build_file_stamps[package]
+
+    def lookup(self, raw_target: str):
+        entry = self.entries.get(raw_target)
+        if entry is None or entry[1] != self._get_build_file_stamp(raw_target):
+            return None
+        return entry[0]
+
+    def store(self, raw_target: str, resolved_target: str):
+        self.entries[raw_target] = [
+            resolved_target,
+            self._get_build_file_stamp(raw_target),
+        ]
+        self.modified = True
+
+    def save(self):
+        if not self.file_name or not self.modified:
+            return
+        # Write to a temporary file first so that an interrupted run never corrupts the cache.
+        tmp_file_name = self.file_name + ".tmp"
+        try:
+            with open(tmp_file_name, "w") as f:
+                json.dump(
+                    {
+                        "version": self._VERSION,
+                        "repo_mapping_stamp": self.repo_mapping_stamp,
+                        "entries": self.entries,
+                    },
+                    f,
+                )
+            os.replace(tmp_file_name, self.file_name)
+        except OSError as e:
+            # E.g., bazel-out does not exist until something was built.
+            print(
+                "WARNING: Could not save the label cache: {}".format(e),
+                file=sys.stderr,
+            )
+
+
+# Not in the workspace, where anyone could commit or plant a cache file, but in bazel-out (through
+# its convenience symlink), next to the refresh cache.
+_LABEL_CACHE_FILE_NAME = os.path.join("bazel-out", "cc_meta_labels_cache.json")
+
+_label_cache = _LabelCache("")
+
+
+def _get_label_key(label: str):
+    # Package and name are the same whichever way the repository is spelled (@@canonical or @apparent).
+    return label.partition("//")[2]
+
+
+def _resolve_target_names(raw_targets: list):
+    """Resolve many target names with a single bazel query (see _resolve_target_name)."""
+    unresolved_targets = set()
+    for raw_target in raw_targets:
+        if not raw_target or raw_target in _resolved_targets:
+            continue
+        cached_target = _label_cache.lookup(raw_target)
+        if cached_target is not None:
+            _resolved_targets[raw_target] = cached_target
+            continue
+        unresolved_targets.add(raw_target)
+    if not unresolved_targets:
+        return
+
+    # Put the query in a file, the set of labels could be too long for the command line.
+    with tempfile.NamedTemporaryFile(
+        mode="w", prefix="cc_meta_query_", suffix=".txt"
+    ) as query_file:
+        query_file.write(
+            "set({})".format(" ".join(['"{}"'.format(t) for t in unresolved_targets]))
+        )
+        query_file.flush()
+        with _profiler.subprocess("bazel query"):
+            target_resolve_process = subprocess.run(
+                [
+                    "bazel",
+                    "query",
+                    "--query_file={}".format(query_file.name),
+                    "--output=label",
+                    # Targets that don't exist will simply be missing from the output.
+                    "--keep_going",
+                ],
+                capture_output=True,
+            )
+    # Exit code 3 means some targets could not be found, the rest is valid.
+    query_is_valid = target_resolve_process.returncode in [0, 3]
+
+    resolved_targets_by_key = {}
+    for t_ln in target_resolve_process.stdout.decode().splitlines():
+        resolved_target = t_ln.strip()
+        resolved_targets_by_key.setdefault(_get_label_key(resolved_target), []).append(
+            resolved_target
+        )
+
+    for raw_target in unresolved_targets:
+        resolved_targets = resolved_targets_by_key.get(_get_label_key(raw_target), [])
+        if len(resolved_targets) > 1:
+            # Same package and name in different repositories, ask about this one alone.
+            resolved_target = _query_target_name(raw_target)
+        elif resolved_targets:
+            resolved_target = resolved_targets[0]
+        else:
+            resolved_target = raw_target
+        _resolved_targets[raw_target] = resolved_target
+        if query_is_valid:
+            _label_cache.store(raw_target, resolved_target)
+
+
+def _resolve_target_name(raw_target: str):
+    if raw_target not in _resolved_targets:
+        _resolve_target_names([raw_target])
+    return _resolved_targets[raw_target]
+
+
+class _TargetRecords:
+    """Records of a database by target name, e.g., the dependency issues of each target.
+
+    Reads either a json object, or line-delimited json records (see refresh --cc_meta_ndjson).
+    With the index of byte offsets of line-delimited records, the file is memory-mapped and only
+    the records that are looked up are parsed.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.records = None
+        self.record_offsets = None
+        self.mapped_records = None
+        if not file_name.endswith(".ndjson"):
+            self._load_all_records(file_name)
+            return
+        try:
+            with open(file_name + ".index", "r") as index_file:
+                self.record_offsets = json.load(index_file)
+            _profiler.count_file("bytes_read", file_name + ".index")
+        except (OSError, ValueError):
+            self._load_all_records(file_name)
+            return
+        with open(file_name, "rb") as records_file:
+            if os.fstat(records_file.fileno()).st_size > 0:
+                self.mapped_records = mmap.mmap(
+                    records_file.fileno(), 0, access=mmap.ACCESS_READ
+                )
+
+    def _load_all_records(self, file_name: str):
+        self.records = cc_meta_records.load_records(file_name)
+        _profiler.count_file("bytes_read", file_name)
+
+    def keys(self):
+        if self.records is not None:
+            return self.records.keys()
+        return self.record_offsets.keys()
+
+    def get(self, target: str):
+        if self.records is not None:
+            return self.records.get(target)
+        offset = self.record_offsets.get(target)
+        if offset is None or self.mapped_records is None:
+            return None
+        end = self.mapped_records.find(b"\n", offset)
+        record_line = self.mapped_records[offset : end if end >= 0 else None]
+        _profiler.count("bytes_read", len(record_line))
+        try:
+            record = json.loads(record_line)
+        except ValueError:
+            # The offset is in the middle of a record (or past the end).
+            record = None
+        if not isinstance(record, dict) or record.get("target") != target:
+            # The index is stale (e.g., written during a refresh), don't trust it.
+            self._load_all_records(self.file_name)
+            return self.records.get(target)
+        return record
+
+    def items(self):
+        for target in list(self.keys()):
+            yield target, self.get(target)
+
+
+def _load_exports_index(index_file_name: str, exports_file_name: str):
+    # Use the sqlite index written by the refresh tool along with the exports file if available
+    # (see _get_exports_index_file_name), otherwise index the exports in memory.
+    if index_file_name and os.path.exists(index_file_name):
+        return cc_meta_records.ExportsIndex(index_file_name=index_file_name)
+    return cc_meta_records.ExportsIndex(
+        _TargetRecords(cc_meta_records.find_records_file(exports_file_name))
+    )
+
+
+def _get_exports_index_file_name(exports_file_name: str, index_file_name: str):
+    if index_file_name:
+        return index_file_name
+    # Only the index written by the same refresh as the exports, i.e., in the same directory.
+    return os.path.join(os.path.dirname(exports_file_name), "target_exports.sqlite")
+
+
+def _find_export_providers(exports_index: cc_meta_records.ExportsIndex, incl_path: str):
+    """Find the targets exporting an include path, or else the suggestions matching on a suffix.
+
+    Only the former can be added automatically, a match on a path suffix may be another header.
+    """
+    providers = exports_index.find_exact(incl_path)
+    if providers:
+        return providers, []
+    return [], exports_index.find_by_suffix(incl_path)
+
+
+def _get_package(target: str):
+    # All targets of a package live in the same BUILD file.
+    return target.rpartition(":")[0]
+
+
+def _run_buildozer_plan(buildozer: str, edit_plan: list, jobs: int):
+    """Apply a list of (command, target) edits with as few buildozer runs as possible.
+
+    Edits are written to buildozer commands files (see 'buildozer -f'), split into up to `jobs`
+    chunks that never share a BUILD file, such that the chunks can safely run in parallel.
+    """
+    if not edit_plan:
+        return
+    edits_by_package = {}
+    for command, target in edit_plan:
+        edits_by_package.setdefault(_get_package(target), []).append(
+            "{}|{}".format(command, target)
+        )
+    chunks = [[] for _ in range(max(1, min(jobs, len(edits_by_package))))]
+    for i, package_edits in enumerate(edits_by_package.values()):
+        chunks[i % len(chunks)].extend(package_edits)
+
+    with tempfile.TemporaryDirectory(
+        prefix="cc_meta_buildozer_"
+    ) as commands_dir, _profiler.subprocess("buildozer", len(chunks)):
+        buildozer_processes = []
+        for i, chunk in enumerate(chunks):
+            commands_file_name = os.path.join(commands_dir, "commands_{}.txt".format(i))
+            with open(commands_file_name, "w") as commands_file:
+                commands_file.write("\n".join(chunk) + "\n")
+            _profiler.count_file("bytes_written", commands_file_name)
+            buildozer_processes.append(
+                subprocess.Popen([buildozer, "-k", "-quiet", "-f", commands_file_name])
+            )
+        returncodes = [p.wait() for p in buildozer_processes]
+
+    # Buildozer returns 3 when there was nothing to change, that's fine too.
+    if any(rc not in [0, 3] for rc in returncodes):
+        print(
+            "Buildozer failed to apply some fixes (see errors above).", file=sys.stderr
+        )
+
+
 def _ensure_cwd_is_workspace_root():
     """Set the current working directory to the root of the workspace."""
     # The `bazel run` command sets `BUILD_WORKSPACE_DIRECTORY` to "the root of the workspace
@@ -65,94 +400,184 @@ if __name__ == "__main__":
     parser.add_argument("-b", "--buildozer", default="buildozer")
     parser.add_argument("-i", "--issues", default="dependency_issues.json")
     parser.add_argument("-e", "--exports", default="target_exports.json")
+    parser.add_argument("-o", "--owners", default="target_owners.json")
+    parser.add_argument(
+        "-x",
+        "--exports_index",
+        default="",
+        help="Sqlite index of the exports (default: target_exports.sqlite next to the exports "
+        "file, if any).",
+    )
     parser.add_argument("-t", "--target", default="")
     parser.add_argument("-n", "--noninteractive", action="store_true")
+    parser.add_argument(
+        "-c",
+        "--label_cache",
+        default=_LABEL_CACHE_FILE_NAME,
+        help="File to cache resolved target names in between runs (default: {}, empty to "
+        "disable).".format(_LABEL_CACHE_FILE_NAME),
+    )
+    parser.add_argument(
+        "-d",
+        "--dry_run",
+        action="store_true",
+        help="Print the buildozer commands instead of running them.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of buildozer processes editing distinct BUILD files in parallel.",
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        default="",
+        help="Write the time spent in each phase, with subprocesses, bytes read and written and "
+        "record counts, to this file as Chrome trace events, and print a summary to stderr.",
+    )
     parser.add_argument("file_list", nargs="*")
     args = parser.parse_args()
 
     _ensure_cwd_is_workspace_root()
 
-    targets_to_fix = set()
-    if args.target:
-        targets_to_fix.update([_resolve_target_name(args.target)])
-    if args.file_list:
-        for fpath in args.file_list:
-            targets_to_fix.update(_resolve_targets_for_source(fpath))
-
-    deps_issues = {}
-    with open(args.issues, "r") as f:
-        deps_issues = json.load(f)
-
-    exports_by_target = {}
-    with open(args.exports, "r") as f:
-        exports_by_target = json.load(f)
-
-    targets_by_export = {}
-    for t, e in exports_by_target.items():
-        for incl_path in e["exports"]:
-            if incl_path not in targets_by_export:
-                targets_by_export.update({incl_path: [t]})
-                continue
-            targets_by_export.update({incl_path: targets_by_export[incl_path] + [t]})
+    if args.profile:
+        _profiler.enable(args.profile)
 
-    for t, di in deps_issues.items():
-        resolved_target = _resolve_target_name(t)
-        if targets_to_fix and resolved_target not in targets_to_fix:
-            continue
-        print("===== Fixing target '{}'".format(resolved_target))
-        buildozer_rm = []
-        for ut in di["unused"]:
-            rut = _resolve_target_name(ut)
-            buildozer_rm.append(rut)
-        if buildozer_rm:
-            buildozer_process = subprocess.run(
-                [
-                    args.buildozer,
-                    "-k",
-                    "-quiet",
-                    "remove deps {}".format(" ".join(buildozer_rm)),
-                    resolved_target,
-                ]
-            )
-        buildozer_add = []
-        for nf in di["not_found"]:
-            if (nf not in targets_by_export) or (not targets_by_export[nf]):
-                print("Could not find target for include '{}'!".format(nf))
-                if not args.noninteractive:
-                    new_target = input("Please enter target name (or enter to skip): ")
-                    if new_target:
-                        buildozer_add.append(new_target)
-                continue
-            if len(targets_by_export[nf]) == 1:
-                buildozer_add.append(_resolve_target_name(targets_by_export[nf][0]))
-                continue
-            resolved_targets = [
-                _resolve_target_name(nt) for nt in targets_by_export[nf]
+    _label_cache = _LabelCache(args.label_cache)
+
+    with _profiler.phase("resolve_targets_to_fix"):
+        targets_to_fix = set()
+        if args.target:
+            targets_to_fix.update([_resolve_target_name(args.target)])
+        if args.file_list:
+            # Find owning targets from the refreshed owners index, only query bazel for unknown files.
+            owners_by_file = _load_owners(args.owners)
+            _profiler.count_file("bytes_read", args.owners)
+            owning_targets = []
+            unknown_files = []
+            for fpath in args.file_list:
+                fpath_owners = owners_by_file.get(os.path.normpath(fpath))
+                if fpath_owners is None:
+                    unknown_files.append(fpath)
+                else:
+                    owning_targets.extend(fpath_owners)
+            _resolve_target_names(owning_targets)
+            targets_to_fix.update([_resolve_target_name(t) for t in owning_targets])
+            targets_to_fix.update(_resolve_targets_for_sources(unknown_files))
+        _profiler.count("records", len(targets_to_fix))
+
+    with _profiler.phase("load_issues"):
+        deps_issues = _TargetRecords(cc_meta_records.find_records_file(args.issues))
+        _profiler.count("records", len(deps_issues.keys()))
+
+        exports_index = _load_exports_index(
+            _get_exports_index_file_name(args.exports, args.exports_index),
+            args.exports,
+        )
+
+    with _profiler.phase("resolve_labels"):
+        # Only the issues of the targets to fix are needed (and read, from an indexed database).
+        issues_targets = list(deps_issues.keys())
+        if targets_to_fix:
+            targets_to_fix_keys = {_get_label_key(t) for t in targets_to_fix}
+            issues_targets = [
+                t for t in issues_targets if _get_label_key(t) in targets_to_fix_keys
             ]
-            new_target = None
-            if args.noninteractive:
-                print("Multiple targets for include '{}'. Skipping.".format(nf))
-            else:
-                print("Multiple targets for include '{}'. Options are:".format(nf))
-                for i in range(len(resolved_targets)):
-                    print("{}: {}".format(i, resolved_targets[i]))
-                new_target = input(
-                    "Please enter option number or target name (or enter to skip): "
-                )
-            if not new_target:
+        # Resolve all the target names we will need up-front, with as few queries as possible.
+        _resolve_target_names(issues_targets)
+        deps_issues_to_fix = []
+        for t in issues_targets:
+            resolved_target = _resolve_target_name(t)
+            if targets_to_fix and resolved_target not in targets_to_fix:
                 continue
-            try:
-                new_target = int(new_target)
-                buildozer_add.append(resolved_targets[new_target])
-            except ValueError:
-                buildozer_add.append(new_target)
-        if buildozer_add:
-            buildozer_process = subprocess.run(
-                [
-                    args.buildozer,
-                    "-k",
-                    "-quiet",
-                    "add deps {}".format(" ".join(buildozer_add)),
-                    resolved_target,
+            deps_issues_to_fix.append((resolved_target, deps_issues.get(t)))
+        needed_targets = []
+        targets_by_export = {}
+        for _, di in deps_issues_to_fix:
+            needed_targets.extend(di["unused"])
+            for nf in di["not_found"]:
+                if nf not in targets_by_export:
+                    targets_by_export[nf] = _find_export_providers(exports_index, nf)
+                needed_targets.extend(targets_by_export[nf][0])
+                needed_targets.extend(targets_by_export[nf][1])
+        _resolve_target_names(needed_targets)
+        _label_cache.save()
+        _profiler.count("records", len(deps_issues_to_fix))
+
+    # Plan all the edits first, buildozer then applies them all at once (see _run_buildozer_plan).
+    with _profiler.phase("plan_edits"):
+        edit_plan = []
+        for resolved_target, di in deps_issues_to_fix:
+            print("===== Fixing target '{}'".format(resolved_target))
+            buildozer_rm = []
+            for ut in di["unused"]:
+                rut = _resolve_target_name(ut)
+                buildozer_rm.append(rut)
+            if buildozer_rm:
+                edit_plan.append(
+                    ("remove deps {}".format(" ".join(buildozer_rm)), resolved_target)
+                )
+            buildozer_add = []
+            for nf in di["not_found"]:
+                providers, suggested_providers = targets_by_export.get(nf, ([], []))
+                if not providers and not suggested_providers:
+                    print("Could not find target for include '{}'!".format(nf))
+                    if not args.noninteractive:
+                        new_target = input(
+                            "Please enter target name (or enter to skip): "
+                        )
+                        if new_target:
+                            buildozer_add.append(new_target)
+                    continue
+                if len(providers) == 1:
+                    buildozer_add.append(_resolve_target_name(providers[0]))
+                    continue
+                resolved_targets = [
+                    _resolve_target_name(nt) for nt in providers or suggested_providers
                 ]
-            )
+                if providers:
+                    options_message = "Multiple targets for include '{}'.".format(nf)
+                else:
+                    options_message = (
+                        "No target exports include '{}' exactly, some match on a path "
+                        "suffix.".format(nf)
+                    )
+                new_target = None
+                if args.noninteractive:
+                    print("{} Skipping.".format(options_message))
+                    if not providers:
+                        for rt in resolved_targets:
+                            print("Suggestion: {}".format(rt))
+                else:
+                    print("{} Options are:".format(options_message))
+                    for i in range(len(resolved_targets)):
+                        print("{}: {}".format(i, resolved_targets[i]))
+                    new_target = input(
+                        "Please enter option number or target name (or enter to skip): "
+                    )
+                if not new_target:
+                    continue
+                try:
+                    new_target = int(new_target)
+                    buildozer_add.append(resolved_targets[new_target])
+                except ValueError:
+                    buildozer_add.append(new_target)
+            if buildozer_add:
+                edit_plan.append(
+                    (
+                        "add deps {}".format(" ".join(dict.fromkeys(buildozer_add))),
+                        resolved_target,
+                    )
+                )
+        _profiler.count("records", len(edit_plan))
+
+    if args.dry_run:
+        print("===== Planned buildozer commands:")
+        for command, target in edit_plan:
+            print("{}|{}".format(command, target))
+        sys.exit(0)
+
+    with _profiler.phase("buildozer"):
+        _run_buildozer_plan(args.buildozer, edit_plan, args.jobs)
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+import fix_deps
+
+
+class LabelCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        initial_cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.addCleanup(os.chdir, initial_cwd)
+        os.mkdir("pkg")
+        self._touch("pkg/BUILD.bazel", 1)
+        self._touch("MODULE.bazel", 1)
+        os.mkdir("bazel-out")
+        self.cache_file_name = os.path.join("bazel-out", "labels_cache.json")
+
+    def _touch(self, file_name, mtime_s):
+        with open(file_name, "a"):
+            pass
+        os.utime(file_name, ns=(mtime_s * 10**9, mtime_s * 10**9))
+
+    def _save_entries(self):
+        label_cache = fix_deps._LabelCache(self.cache_file_name)
+        label_cache.store("@@//pkg:t", "//pkg:t")
+        label_cache.store("@@foo//lib:l", "@foo//lib:l")
+        label_cache.save()
+
+    def test_saved_entries_are_found(self):
+        self._save_entries()
+        label_cache = fix_deps._LabelCache(self.cache_file_name)
+        self.assertEqual(label_cache.lookup("@@//pkg:t"), "//pkg:t")
+        self.assertEqual(label_cache.lookup("@@foo//lib:l"), "@foo//lib:l")
+        self.assertIsNone(label_cache.lookup("@@//pkg:other"))
+        self.assertFalse(os.path.exists(self.cache_file_name + ".tmp"))
+
+    def test_build_file_change_invalidates_its_package(self):
+        self._save_entries()
+        self._touch("pkg/BUILD.bazel", 2)
+        label_cache = fix_deps._LabelCache(self.cache_file_name)
+        self.assertIsNone(label_cache.lookup("@@//pkg:t"))
+        self.assertEqual(label_cache.lookup("@@foo//lib:l"), "@foo//lib:l")
+
+    def test_repo_mapping_change_invalidates_everything(self):
+        self._save_entries()
+        self._touch("MODULE.bazel", 2)
+        label_cache = fix_deps._LabelCache(self.cache_file_name)
+        self.assertIsNone(label_cache.lookup("@@//pkg:t"))
+        self.assertIsNone(label_cache.lookup("@@foo//lib:l"))
+
+    def test_corrupted_cache_is_ignored(self):
+        with open(self.cache_file_name, "w") as f:
+            f.write('{"version": ')
+        label_cache = fix_deps._LabelCache(self.cache_file_name)
+        self.assertIsNone(label_cache.lookup("@@//pkg:t"))
+
+    def test_save_without_bazel_out_keeps_going(self):
+        os.rmdir("bazel-out")
+        self._save_entries()
+        self.assertFalse(os.path.exists(self.cache_file_name))
+
+
+if __name__ == "__main__":
+    unittest.main()
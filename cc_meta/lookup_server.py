@@ -0,0 +1,232 @@
+"""
+This script serves lookups into the cc_meta databases, for editors and other tools.
+
+The databases written by the refresh tool are loaded once into in-memory indexes, and reloaded
+whenever the refresh tool writes them again, such that each lookup is a dictionary access instead
+of parsing target_exports.json. Requests and responses are json objects, one per line, over a
+Unix domain socket:
+
+    {"query": "providers", "key": "foo/bar.h"}  ->  {"result": ["@@//foo:bar"]}
+    {"query": "owners", "key": "foo/bar.cc"}    ->  {"result": ["@@//foo:bar"]}
+    {"query": "issues", "key": "//foo:bar"}     ->  {"result": {"not_found": [...], ...}}
+
+Run it without --query to serve, and with --query to send a single request and print the result.
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import cc_meta_records
+
+# Time between checks for new databases (see _LookupService).
+_RELOAD_CHECK_INTERVAL = 1.0
+
+
+def _get_label_key(label: str):
+    # The same target, whether its repository is spelled @@repo or @repo, and the main repository
+    # as @@, @ or nothing at all.
+    repo, _, label_key = label.partition("//")
+    if ":" not in label_key:
+        label_key = "{}:{}".format(label_key, label_key.rpartition("/")[2])
+    return "{}//{}".format(repo.lstrip("@"), label_key)
+
+
+class _LookupIndex:
+    """In-memory indexes of the databases, built once per refresh."""
+
+    def __init__(self, exports_file_name: str, owners_file_name: str, issues_file_name):
+        exports_by_target = cc_meta_records.load_records(exports_file_name)
+        self.exports_index = cc_meta_records.ExportsIndex(exports_by_target)
+
+        try:
+            with open(owners_file_name, "r") as f:
+                self.owners_by_file = json.load(f)
+        except OSError:
+            # Older refreshes did not write the owners, the exports have the same information.
+            self.owners_by_file = {}
+            for t, e in exports_by_target.items():
+                for owned_file in e.get("files", []):
+                    self.owners_by_file.setdefault(owned_file, []).append(t)
+
+        self.issues_by_label_key = {}
+        try:
+            for t, di in cc_meta_records.load_records(issues_file_name).items():
+                self.issues_by_label_key[_get_label_key(t)] = di
+        except OSError:
+            pass
+
+    def find_providers(self, incl_path: str):
+        """Find the targets exporting an include path, or else the ones matching a path suffix."""
+        providers = self.exports_index.find_exact(incl_path)
+        if providers:
+            return providers
+        return self.exports_index.find_by_suffix(incl_path)
+
+    def find_owners(self, file_name: str):
+        return sorted(self.owners_by_file.get(os.path.normpath(file_name), []))
+
+    def find_issues(self, target: str):
+        return self.issues_by_label_key.get(_get_label_key(target), {})
+
+
+class _LookupService:
+    """Answers lookups from the latest databases, reloading them when they change."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.lock = threading.Lock()
+        self.index = None
+        self.index_stamp = None
+        self.next_check_time = 0.0
+        self._reload_if_changed()
+
+    def _get_database_files(self):
+        return [
+            cc_meta_records.find_records_file(self.args.exports),
+            self.args.owners,
+            cc_meta_records.find_records_file(self.args.issues),
+        ]
+
+    def _reload_if_changed(self):
+        database_files = self._get_database_files()
+        stamp = []
+        for file_name in database_files:
+            try:
+                file_stat = os.stat(file_name)
+                stamp.append((file_name, file_stat.st_mtime_ns, file_stat.st_size))
+            except OSError:
+                stamp.append((file_name, None, None))
+        if stamp == self.index_stamp:
+            return
+        try:
+            new_index = _LookupIndex(*database_files)
+        except (OSError, ValueError) as e:
+            # The databases are missing or being written, keep the ones we have until next time.
+            print(">>> Could not load the databases: {}".format(e), file=sys.stderr)
+            return
+        # Lookups in flight keep the index they started with.
+        self.index = new_index
+        self.index_stamp = stamp
+        print(
+            ">>> Loaded databases ({} exports).".format(
+                len(new_index.exports_index.targets_by_export)
+            )
+        )
+
+    def lookup(self, request: dict):
+        now = time.monotonic()
+        if now >= self.next_check_time:
+            with self.lock:
+                if now >= self.next_check_time:
+                    self._reload_if_changed()
+                    self.next_check_time = now + _RELOAD_CHECK_INTERVAL
+        index = self.index
+        if index is None:
+            return {"error": "No databases loaded, run the refresh tool first."}
+        query = request.get("query")
+        key = request.get("key", "")
+        if query == "providers":
+            return {"result": index.find_providers(key)}
+        if query == "owners":
+            return {"result": index.find_owners(key)}
+        if query == "issues":
+            return {"result": index.find_issues(key)}
+        return {"error": "Unknown query '{}'.".format(query)}
+
+
+class _LookupRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for request_line in self.rfile:
+            if not request_line.strip():
+                continue
+            try:
+                response = self.server.lookup_service.lookup(json.loads(request_line))
+            except ValueError as e:
+                response = {"error": "Invalid request: {}".format(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class _LookupServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(args: argparse.Namespace):
+    lookup_service = _LookupService(args)
+    # Remove the socket when stopped by the editor or tool that started the server.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    with _LookupServer(args.socket, _LookupRequestHandler) as server:
+        server.lookup_service = lookup_service
+        print(">>> Serving lookups on {}".format(args.socket), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.socket)
+    return 0
+
+
+class LookupClient:
+    """A simple client of the lookup server, which keeps its connection for many lookups."""
+
+    def __init__(self, socket_path: str):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(socket_path)
+        self.responses = self.connection.makefile("rb")
+
+    def lookup(self, query: str, key: str):
+        self.connection.sendall(
+            json.dumps({"query": query, "key": key}).encode() + b"\n"
+        )
+        return json.loads(self.responses.readline())
+
+    def close(self):
+        self.responses.close()
+        self.connection.close()
+
+
+def _parse_args(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="CcMetaLookupServer",
+        description="Serve lookups of include providers, file owners and target issues.",
+    )
+    parser.add_argument("-s", "--socket", default=".cc_meta_lookup.sock")
+    parser.add_argument("-i", "--issues", default="dependency_issues.json")
+    parser.add_argument("-e", "--exports", default="target_exports.json")
+    parser.add_argument("-o", "--owners", default="target_owners.json")
+    parser.add_argument(
+        "-q",
+        "--query",
+        nargs=2,
+        metavar=("QUERY", "KEY"),
+        help="Send one lookup to the server and print its response, where QUERY is one of "
+        "'providers' (KEY is an include path), 'owners' (KEY is a file) or 'issues' (KEY is a "
+        "target).",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = _parse_args(sys.argv[1:])
+
+    # Under `bazel run`, the databases are in the workspace root, otherwise use the current directory.
+    if "BUILD_WORKSPACE_DIRECTORY" in os.environ:
+        os.chdir(os.environ["BUILD_WORKSPACE_DIRECTORY"])
+
+    if args.query:
+        client = LookupClient(args.socket)
+        print(json.dumps(client.lookup(*args.query), indent=2))
+        client.close()
+        sys.exit(0)
+
+    sys.exit(serve(args))
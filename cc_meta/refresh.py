@@ -4,67 +4,150 @@ This file is the template for the refresh_cc_meta rule.
 Interface (after template expansion):
 - `bazel run` to regenerate cc metadata for clangd and other tools.
     - No arguments are needed; info from the rule baked into the template expansion.
-        - Any arguments passed are interpreted as arguments needed for the builds being analyzed.
+        - Arguments prefixed with '--cc_meta_' are options of this tool (see --help).
+        - Any other arguments passed are interpreted as arguments needed for the builds being analyzed.
     - Requires being run under Bazel so we can access the workspace root environment variable.
 - Output: a compile_commands.json for files being compiled by Bazel
 - Output: a target_exports.json to list exported includes for each discovered target
 - Output: a dependency_issues.json to list dependency issues with each discovered target
+    - Or line-delimited target_exports.ndjson and dependency_issues.ndjson, with an index of the
+      byte offset of each target's record (see --cc_meta_ndjson)
+- Output: a target_owners.json to list the targets owning each source or header file
+- Output: a target_exports.sqlite to index the targets exporting each include path
 """
 
+import argparse
+import array
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
 import json
 import os
 import pathlib
+import select
+import shlex
+import shutil
+import sqlite3
+import struct
 import subprocess
 import sys
+import tempfile
+import time
+import urllib.parse
 
+import cc_meta_profiler
+import cc_meta_records
 
-def _get_target_list(target_patterns: list):
+# Use a faster json parser, if one is available.
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+
+_profiler = cc_meta_profiler.Profiler()
+
+
+def _get_target_list(target_patterns: list, bazel_flags: list):
     print(">>> Listing targets from: {}".format(" ".join(target_patterns)))
 
-    common_flags = [
+    # Query C++ rules below all target patterns at once, a single cquery means a single
+    # loading and analysis phase, no matter how many patterns are given.
+    target_list_query = "kind('cc_.* rule',deps({}))".format(
+        " + ".join(target_patterns)
+    )
+    target_list_cquery_args = [
+        "bazel",
+        "cquery",
+        target_list_query,
         # Shush logging. Just for readability.
         "--ui_event_filters=-info",
         "--noshow_progress",
-    ] + sys.argv[1:]
-
-    # Query C++ rules below each target pattern
-    target_list = set()
-    for target in target_patterns:
-        target_list_query = f"kind('cc_.* rule',deps({target}))"
-        target_list_cquery_args = [
-            "bazel",
-            "cquery",
-            target_list_query,
-        ] + common_flags
+    ] + bazel_flags
 
+    with _profiler.subprocess("bazel cquery"):
         target_list_cquery_process = subprocess.run(
             target_list_cquery_args,
             capture_output=True,
             encoding="utf-8",
         )
 
-        if target_list_cquery_process.returncode != 0:
-            print(target_list_cquery_process.stderr, file=sys.stderr)
-            sys.exit(target_list_cquery_process.returncode)
+    if target_list_cquery_process.returncode != 0:
+        print(target_list_cquery_process.stderr, file=sys.stderr)
+        sys.exit(target_list_cquery_process.returncode)
 
-        target_list.update(
-            set([s.split()[0] for s in target_list_cquery_process.stdout.splitlines()])
-        )
+    target_list = set(
+        [s.split()[0] for s in target_list_cquery_process.stdout.splitlines() if s]
+    )
 
     # Log clear completion messages
-    print(f">>> Found {len(target_list)} unique targets from {target}.")
+    print(f">>> Found {len(target_list)} unique targets.")
+    _profiler.count("records", len(target_list))
 
-    return list(target_list)
+    return sorted(target_list)
+
+
+@contextlib.contextmanager
+def _target_pattern_file(target_list: list):
+    """Write targets to a temporary file for bazel's --target_pattern_file option.
+
+    This keeps the bazel command line short, no matter how many targets were discovered.
+    """
+    with tempfile.NamedTemporaryFile(
+        mode="w", prefix="cc_meta_targets_", suffix=".txt", delete=False
+    ) as target_file:
+        target_file.write("\n".join(target_list) + "\n")
+    try:
+        yield target_file.name
+    finally:
+        os.remove(target_file.name)
 
 
 def _load_json_or_empty_list(filename):
     result = []
     if filename:
-        with open(filename, "r") as f:
-            result = json.load(f)
+        with open(filename, "rb") as f:
+            result = _json_loads(f.read())
     return result
 
 
+# Kinds of aspect output files merged into the databases, by file name suffix.
+_CC_META_OUTPUT_KINDS = {
+    "_cc_meta_compile_commands.json": "compile_commands",
+    "_cc_meta_all_imports.json": "all_imports",
+    "_cc_meta_exports.json": "exports",
+    "_cc_meta_deps_issues.json": "deps_issues",
+}
+
+
+def _get_output_kind(file_name: str):
+    for suffix, kind in _CC_META_OUTPUT_KINDS.items():
+        if file_name.endswith(suffix):
+            return kind
+    return None
+
+
+def _reduce_output(kind: str, contents: list, keep_deps_usage: bool = False):
+    """Reduce the contents of an output file to only what the merge needs."""
+    if kind == "compile_commands":
+        return [(tcmd["file"], tcmd["arguments"]) for tcmd in contents]
+    if kind == "all_imports":
+        return [(al["source_file"], al["imports"]) for al in contents]
+    if kind == "deps_issues" and not keep_deps_usage:
+        return [di for di in contents if di["not_found"] or di["unused"]]
+    return contents
+
+
+def _load_output_file(file_name: str, keep_deps_usage: bool = False):
+    kind = _get_output_kind(file_name)
+    return kind, _reduce_output(
+        kind, _load_json_or_empty_list(file_name), keep_deps_usage
+    )
+
+
 # Just a heuristic matching for preferring compile commands that compile a source file (not header).
 _SOURCE_EXTENSIONS = {
     ".c",
@@ -91,23 +174,695 @@ _SOURCE_EXTENSIONS = {
 }
 
 
-def _should_update_comp_cmd(prior_cmd: dict, new_cmd: dict):
-    prior_is_src = os.path.splitext(prior_cmd["compile_file"]) in _SOURCE_EXTENSIONS
-    new_is_src = os.path.splitext(new_cmd["compile_file"]) in _SOURCE_EXTENSIONS
+def _is_source_file(file_path: str):
+    return os.path.splitext(file_path)[1] in _SOURCE_EXTENSIONS
+
+
+def _get_owners(exports_dict: dict):
+    """Map each file to the names of the targets that own it."""
+    owners_dict = {}
+    for target_name, target_exports in exports_dict.items():
+        for owned_file in target_exports.get("files", []):
+            owners_dict.setdefault(owned_file, []).append(target_name)
+    return owners_dict
+
+
+class _PathIds(dict):
+    """Interns file paths to integer ids, new paths get the next id when first looked up."""
+
+    def __init__(self, on_new_path):
+        super().__init__()
+        self.on_new_path = on_new_path
+
+    def __missing__(self, file_path: str):
+        path_id = self[file_path] = len(self)
+        self.on_new_path(file_path)
+        return path_id
+
+
+class _CompileCommands:
+    """The combined compile commands, each entry only materialized while it is being written.
+
+    Entries are listed in the order their files were first seen, and share the arguments of the
+    compile command they use (see _CcMetaMerger).
+    """
+
+    def __init__(self, merger):
+        self.merger = merger
+        file_commands = merger.file_commands
+        # Entry index to path id, for the files with a compile command of their own or chosen
+        self.file_ids = array.array(
+            "q",
+            (
+                file_id
+                for file_id, choice_id in enumerate(merger.header_choices)
+                if file_commands[file_id if choice_id < 0 else choice_id] >= 0
+            ),
+        )
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def __getitem__(self, index: int):
+        merger = self.merger
+        file_id = self.file_ids[index]
+        choice_id = merger.header_choices[file_id]
+        command_id = merger.file_commands[file_id if choice_id < 0 else choice_id]
+        return {
+            "arguments": merger.arguments_table[command_id],
+            "file": merger.paths[file_id],
+            "directory": merger.top_dir,
+        }
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self.file_ids)))
+
+
+class _CcMetaMerger:
+    """Merges the per-target cc_meta output files into the combined databases.
+
+    Output files are added in their reduced form (see _reduce_output) in any order, as soon as they
+    are available. File paths are interned to integer ids, and each distinct arguments list is kept
+    once in a table, such that memory grows with the number of files and compile commands, not with
+    the number of includes. The compile command of each header is chosen as the imports are added
+    (see _choose_commands()), only the imports of files whose compile command was not added yet
+    are kept until the end (see finish()).
+    """
+
+    def __init__(self, top_dir: str, keep_deps_usage: bool = False):
+        self.top_dir = top_dir
+        self.keep_deps_usage = keep_deps_usage
+        self.path_ids = _PathIds(self._add_path)  # File path to id
+        self.paths = []  # Id to file path
+        self.dir_ids = _PathIds(lambda dir_path: None)  # Directory path to id
+        self.path_dirs = array.array("q")  # Path id to directory id
+        self.arguments_ids = {}  # Arguments tuple to id
+        self.arguments_table = []  # Id to arguments tuple
+        self.file_commands = array.array("q")  # Path id to arguments id (-1 if none)
+        # Path id to the rank of the chosen compile command and to the id of the file it comes
+        # from (-1 if none), for headers (see _choose_commands()).
+        self.header_ranks = array.array("q")
+        self.header_choices = array.array("q")
+        # (path id, array of import ids) without compile command yet
+        self.pending_imports = []
+        self.exports_dict = {}  # Target name to exports
+        self.deps_issues_dict = {}  # Target name to deps issues
+        self.deps_usage_dict = {}  # Target name to include paths used from each dep
+        self.header_report = None  # Aggregates the imports as they are added, if set
+        self.compile_commands = []  # Combined compile commands (see finish())
+        self.owners_dict = {}  # File to names of targets that own it (see finish())
+
+    def add_output(self, kind: str, contents: list):
+        if kind == "compile_commands":
+            self.add_compile_commands(contents)
+        elif kind == "all_imports":
+            self.add_all_imports(contents)
+        elif kind == "exports":
+            self.add_exports(contents)
+        elif kind == "deps_issues":
+            self.add_deps_issues(contents)
+
+    def _add_path(self, file_path: str):
+        self.paths.append(file_path)
+        self.path_dirs.append(self.dir_ids[file_path[: file_path.rfind("/") + 1]])
+        self.file_commands.append(-1)
+        self.header_ranks.append(-1)
+        self.header_choices.append(-1)
+
+    def add_compile_commands(self, target_compile_commands: list):
+        for tcmd_file, tcmd_arguments in target_compile_commands:
+            arguments = tuple(map(sys.intern, tcmd_arguments))
+            arguments_id = self.arguments_ids.get(arguments)
+            if arguments_id is None:
+                arguments_id = len(self.arguments_table)
+                self.arguments_ids[arguments] = arguments_id
+                self.arguments_table.append(arguments)
+            file_id = self.path_ids[tcmd_file]
+            self.file_commands[file_id] = arguments_id
+            if not _is_source_file(tcmd_file):
+                # A header parsed on its own can use its own compile command.
+                self._choose_commands(file_id, [file_id])
+
+    def add_all_imports(self, all_imports_list: list):
+        if self.header_report is not None:
+            self.header_report.add_all_imports(all_imports_list)
+        path_ids = self.path_ids
+        for comp_src_file, imp_files in all_imports_list:
+            comp_src_id = path_ids[comp_src_file]
+            imp_ids = array.array("q", map(path_ids.__getitem__, imp_files))
+            if self.file_commands[comp_src_id] < 0:
+                # Its compile command is in an output file that was not added yet.
+                self.pending_imports.append((comp_src_id, imp_ids))
+                continue
+            self._choose_commands(comp_src_id, imp_ids)
 
-    # Prefer a command that compiles a source file, instead of parsing a header.
-    if new_is_src and not prior_is_src:
+    def add_exports(self, target_exports_list: list):
+        self.exports_dict.update({te["target"]: te for te in target_exports_list})
+
+    def add_deps_issues(self, target_deps_issues_list: list):
+        if self.keep_deps_usage:
+            for di in target_deps_issues_list:
+                deps_usage = {}
+                for imp_path, imp_dep in di["matches"].items():
+                    if imp_dep != di["target"]:
+                        deps_usage.setdefault(imp_dep, []).append(imp_path)
+                self.deps_usage_dict[di["target"]] = deps_usage
+            target_deps_issues_list = [
+                di for di in target_deps_issues_list if di["not_found"] or di["unused"]
+            ]
+        self.deps_issues_dict.update(
+            {di["target"]: di for di in target_deps_issues_list}
+        )
+
+    def _choose_commands(self, comp_src_id: int, imp_ids):
+        """Offer the compile command of a file to the files it imports.
+
+        Candidates are all files with a compile command that include the header (including the
+        header itself if it is parsed on its own). They are ranked by: compiling a source file
+        (rather than parsing a header), being in the same directory as the header, and having
+        more (i.e., more specific) arguments. Ties go to the first file in sorted order, so that
+        the choice does not depend on the order in which targets completed.
+        """
+        paths = self.paths
+        path_dirs = self.path_dirs
+        header_ranks = self.header_ranks
+        header_choices = self.header_choices
+        comp_src_file = paths[comp_src_id]
+        src_dir_id = path_dirs[comp_src_id]
+        # Ranks are packed in an integer: is a source, is in the same directory, number of arguments.
+        src_rank = (_is_source_file(comp_src_file) << 41) | len(
+            self.arguments_table[self.file_commands[comp_src_id]]
+        )
+        same_dir_rank = src_rank | (1 << 40)
+        for imp_id in imp_ids:
+            imp_rank = same_dir_rank if path_dirs[imp_id] == src_dir_id else src_rank
+            prior_rank = header_ranks[imp_id]
+            if imp_rank < prior_rank or (
+                imp_rank == prior_rank
+                and comp_src_file >= paths[header_choices[imp_id]]
+            ):
+                continue
+            header_ranks[imp_id] = imp_rank
+            header_choices[imp_id] = comp_src_id
+
+    def get_header_sources(self):
+        """Map each header to the file whose compile command it uses."""
+        return {
+            self.paths[hdr_id]: self.paths[comp_id]
+            for hdr_id, comp_id in enumerate(self.header_choices)
+            if comp_id >= 0
+        }
+
+    def finish(self):
+        pending_imports, self.pending_imports = self.pending_imports, []
+        for comp_src_id, imp_ids in pending_imports:
+            if self.file_commands[comp_src_id] < 0:
+                print(
+                    "WARNING: Missing compile commands for {}!".format(
+                        self.paths[comp_src_id]
+                    ),
+                    file=sys.stderr,
+                )
+                continue
+            self._choose_commands(comp_src_id, imp_ids)
+
+        # Source files (not headers) with their own compile command always keep it.
+        for file_id, command_id in enumerate(self.file_commands):
+            if (
+                command_id >= 0
+                and self.header_choices[file_id] >= 0
+                and _is_source_file(self.paths[file_id])
+            ):
+                self.header_choices[file_id] = -1
+
+        self.compile_commands = _CompileCommands(self)
+        self.owners_dict = _get_owners(self.exports_dict)
+
+
+class _HeaderReport:
+    """Aggregates the transitive imports of all files into the cost of each header.
+
+    Imports are counted as they are added, with each path interned to an integer id, such that
+    memory grows with the number of distinct files and not with the number of imports. For each
+    header, this counts the translation units (source files) including it (fan-in), and if the
+    header has its own imports (headers owned by analyzed targets are scanned on their own), its
+    transitive includes and their total size. A source file in several targets is counted once.
+
+    The cost of a header estimates the bytes it makes the preprocessor read across all
+    compilations: its fan-in times the size of the header and its transitive includes.
+    """
+
+    def __init__(self, top_dir: str):
+        self.top_dir = top_dir
+        self.path_ids = {}
+        self.paths = []
+        self.file_sizes = array.array("q")  # Path id to size in bytes (-1 if not found)
+        # Path id to number of translation units including it
+        self.fan_ins = array.array("q")
+        # Path id to number of transitive includes and their total size (-1 if unknown)
+        self.transitive_counts = array.array("q")
+        self.transitive_sizes = array.array("q")
+        self.source_ids = set()  # Ids of the translation units already counted
+        self.translation_units = 0
+
+    def _intern(self, file_path: str):
+        path_id = self.path_ids.get(file_path)
+        if path_id is None:
+            path_id = len(self.paths)
+            self.path_ids[file_path] = path_id
+            self.paths.append(file_path)
+            try:
+                self.file_sizes.append(
+                    os.stat(os.path.join(self.top_dir, file_path)).st_size
+                )
+            except OSError:
+                self.file_sizes.append(-1)
+            self.fan_ins.append(0)
+            self.transitive_counts.append(-1)
+            self.transitive_sizes.append(-1)
+        return path_id
+
+    def add_all_imports(self, all_imports_list: list):
+        intern = self._intern
+        file_sizes = self.file_sizes
+        fan_ins = self.fan_ins
+        for comp_file, imp_files in all_imports_list:
+            comp_id = intern(comp_file)
+            imp_ids = {intern(imp_file) for imp_file in imp_files}
+            if _is_source_file(comp_file):
+                if comp_id in self.source_ids:
+                    continue
+                self.source_ids.add(comp_id)
+                self.translation_units += 1
+                for imp_id in imp_ids:
+                    fan_ins[imp_id] += 1
+                continue
+            imp_ids.add(comp_id)
+            self.transitive_counts[comp_id] = len(imp_ids) - 1
+            self.transitive_sizes[comp_id] = sum(
+                max(file_sizes[imp_id], 0) for imp_id in imp_ids
+            )
+
+    def get_ranked_headers(self):
+        """List the headers included by translation units, by decreasing cost."""
+        headers = []
+        for path_id, fan_in in enumerate(self.fan_ins):
+            if fan_in == 0:
+                continue
+            file_size = max(self.file_sizes[path_id], 0)
+            transitive_size = self.transitive_sizes[path_id]
+            if transitive_size < 0:
+                # Not parsed on its own, only the header itself is known.
+                transitive_size = file_size
+            headers.append(
+                {
+                    "header": self.paths[path_id],
+                    "fan_in": fan_in,
+                    "bytes": file_size,
+                    "transitive_includes": self.transitive_counts[path_id],
+                    "transitive_bytes": transitive_size,
+                    "cost": fan_in * transitive_size,
+                }
+            )
+        headers.sort(key=lambda h: (-h["cost"], -h["fan_in"], h["header"]))
+        return headers
+
+
+# Bump this whenever the cache (or the reduced outputs, see _reduce_output) change format.
+_MERGE_CACHE_VERSION = 3
+
+
+class _MergeCache:
+    """Cache of the reduced output files of the last refresh, keyed by file path and digest (or mtime and size).
+
+    The reduced outputs (see _reduce_output) are saved as json in an sqlite database (see
+    _get_merge_cache_file_name), such that a refresh only parses the output files that changed,
+    and can leave the existing databases as they are, without reading any output, if none did.
+    With keep_outputs (for --cc_meta_watch), the reduced outputs are also kept in memory.
+    """
+
+    def __init__(self, file_name: str, signature: list, keep_outputs: bool = False):
+        self.file_name = file_name
+        self.signature = signature
+        self.keep_outputs = keep_outputs
+        self.old_entries = {}  # File name to (file key, kind, reduced), in memory only.
+        self.new_entries = {}
+        self.old_keys = {}  # File name to file key, of the last refresh.
+        self.new_keys = {}
+        self.saved_keys = {}  # File name to file key, of the outputs in the cache file.
+        self.parsed_count = 0
+        # Unchanged output files may be skipped, until some output is found to have changed.
+        self.skip_unchanged = False
+        self.db = None
+        if not file_name or not os.path.exists(file_name):
+            return
+        try:
+            self.db = self._connect()
+            cache_info = self.db.execute(
+                "SELECT version, signature FROM cache_info"
+            ).fetchone()
+            if cache_info == (_MERGE_CACHE_VERSION, json.dumps(signature)):
+                self.saved_keys = dict(
+                    self.db.execute("SELECT file_name, file_key FROM outputs")
+                )
+            else:
+                self.db.execute("DELETE FROM outputs")
+            self.old_keys = dict(self.saved_keys)
+        except sqlite3.Error:
+            # A corrupted cache only means we have to parse everything, start a new one.
+            self._discard()
+
+    def _connect(self):
+        db = sqlite3.connect(self.file_name)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS cache_info (version INTEGER, signature TEXT)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS outputs (file_name TEXT PRIMARY KEY, "
+            "file_key TEXT NOT NULL, kind TEXT NOT NULL, reduced TEXT NOT NULL)"
+        )
+        return db
+
+    def _discard(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        try:
+            os.remove(self.file_name)
+        except OSError:
+            pass
+        self.saved_keys = {}
+        self.old_keys = {}
+
+    def _write(self, file_name: str, file_key: str, kind: str, reduced: list):
+        if not self.file_name:
+            return
+        try:
+            # The cache file is only created once bazel created bazel-out.
+            if self.db is None:
+                self.db = self._connect()
+            self.db.execute(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)",
+                (file_name, file_key, kind, json.dumps(reduced)),
+            )
+            self.saved_keys[file_name] = file_key
+        except sqlite3.Error as e:
+            print(
+                "WARNING: Could not update the refresh cache: {}".format(e),
+                file=sys.stderr,
+            )
+            self._discard()
+            self.file_name = ""
+
+    def lookup(self, file_name: str, file_key: str):
+        entry = self.old_entries.get(file_name)
+        if entry is None or entry[0] != file_key:
+            return None
+        self.new_entries[file_name] = entry
+        self.new_keys[file_name] = file_key
+        return entry[1], entry[2]
+
+    def load(self, file_name: str, file_key: str):
+        """Read the reduced output of an unchanged output file from the cache file, if it is there."""
+        if self.db is None or self.saved_keys.get(file_name) != file_key:
+            return None
+        try:
+            kind, reduced = self.db.execute(
+                "SELECT kind, reduced FROM outputs WHERE file_name = ?", (file_name,)
+            ).fetchone()
+            reduced = json.loads(reduced)
+        except (sqlite3.Error, ValueError, TypeError):
+            return None
+        if self.keep_outputs:
+            self.new_entries[file_name] = (file_key, kind, reduced)
+        self.new_keys[file_name] = file_key
+        return kind, reduced
+
+    def is_skippable(self, file_name: str, file_key: str):
+        if not self.skip_unchanged or self.old_keys.get(file_name) != file_key:
+            return False
+        self.new_keys[file_name] = file_key
         return True
-    if prior_is_src and not new_is_src:
-        return False
 
-    # Prefer a longer arguments list, more 'specialized'.
-    return len(new_cmd["arguments"]) > len(prior_cmd["arguments"])
+    def store(self, file_name: str, file_key: str, kind: str, reduced: list):
+        if self.keep_outputs:
+            self.new_entries[file_name] = (file_key, kind, reduced)
+        if self.old_keys.get(file_name) != file_key:
+            self.parsed_count += 1
+        if self.saved_keys.get(file_name) != file_key:
+            self._write(file_name, file_key, kind, reduced)
+        self.new_keys[file_name] = file_key
 
+    def replace_entries(self, entries: dict):
+        """Replace the outputs of the cache with entries (file name to (file key, kind, reduced))."""
+        for file_name, (file_key, kind, reduced) in entries.items():
+            if self.saved_keys.get(file_name) != file_key:
+                self._write(file_name, file_key, kind, reduced)
+        self.new_entries = entries
+        self.new_keys = {file_name: entry[0] for file_name, entry in entries.items()}
+
+    def is_unchanged(self):
+        return self.new_keys == self.old_keys
+
+    def save(self):
+        if self.db is None:
+            return
+        # All the changes since the last save are committed at once, such that an interrupted
+        # refresh never leaves a cache that does not match its keys.
+        try:
+            removed_file_names = [
+                file_name
+                for file_name in self.saved_keys
+                if file_name not in self.new_keys
+            ]
+            self.db.executemany(
+                "DELETE FROM outputs WHERE file_name = ?",
+                ((file_name,) for file_name in removed_file_names),
+            )
+            self.db.execute("DELETE FROM cache_info")
+            self.db.execute(
+                "INSERT INTO cache_info VALUES (?, ?)",
+                (_MERGE_CACHE_VERSION, json.dumps(self.signature)),
+            )
+            self.db.commit()
+            for file_name in removed_file_names:
+                del self.saved_keys[file_name]
+        except sqlite3.Error as e:
+            print(
+                "WARNING: Could not save the refresh cache: {}".format(e),
+                file=sys.stderr,
+            )
+
+
+def _output_file_key(file_name: str, file_digest: str):
+    if file_digest:
+        return file_digest
+    file_stat = os.stat(file_name)
+    return "{}:{}".format(file_stat.st_mtime_ns, file_stat.st_size)
+
+
+class _OutputFilesLoader:
+    """Parses output files on a pool of workers and merges them as they are parsed.
+
+    At most a few files per worker are parsed ahead of the merge, so that memory use stays bounded
+    no matter how many output files are produced by the build.
+    """
+
+    def __init__(
+        self, merger: _CcMetaMerger, jobs: int, use_processes: bool, cache: _MergeCache
+    ):
+        self.merger = merger
+        self.cache = cache
+        self.executor = None
+        if jobs > 1:
+            if use_processes:
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+            else:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.max_pending = 4 * jobs
+        self.pending = {}  # Future to (file name, file key)
+        self.skipped = []  # (file name, file key) of unchanged files, see _MergeCache.
+
+    def add_output_file(self, file_name: str, file_digest: str = ""):
+        if _get_output_kind(file_name) is None:
+            return
+        _profiler.count("records")
+        file_key = None
+        if self.cache is not None:
+            file_key = _output_file_key(file_name, file_digest)
+            cached_output = self.cache.lookup(file_name, file_key)
+            if cached_output is not None:
+                self.merger.add_output(*cached_output)
+                return
+            if self.cache.is_skippable(file_name, file_key):
+                self.skipped.append((file_name, file_key))
+                return
+            if self.skipped:
+                self._load_skipped()
+            cached_output = self.cache.load(file_name, file_key)
+            if cached_output is not None:
+                self.merger.add_output(*cached_output)
+                return
+        self._load(file_name, file_key)
+
+    def _load(self, file_name: str, file_key):
+        _profiler.count_file("bytes_read", file_name)
+        if self.executor is None:
+            self._merge_parsed(
+                file_name,
+                file_key,
+                _load_output_file(file_name, self.merger.keep_deps_usage),
+            )
+            return
+        if len(self.pending) >= self.max_pending:
+            self._merge_completed(concurrent.futures.FIRST_COMPLETED)
+        parsed_output = self.executor.submit(
+            _load_output_file, file_name, self.merger.keep_deps_usage
+        )
+        self.pending[parsed_output] = (
+            file_name,
+            file_key,
+        )
+
+    def _load_skipped(self):
+        # Something changed, so the databases are written again, from all the outputs, but the
+        # unchanged ones are read from the cache instead of being parsed again.
+        self.cache.skip_unchanged = False
+        skipped, self.skipped = self.skipped, []
+        for file_name, file_key in skipped:
+            cached_output = self.cache.load(file_name, file_key)
+            if cached_output is not None:
+                self.merger.add_output(*cached_output)
+            else:
+                self._load(file_name, file_key)
+
+    def _merge_parsed(self, file_name: str, file_key, parsed_output: tuple):
+        if self.cache is not None:
+            self.cache.store(file_name, file_key, *parsed_output)
+        self.merger.add_output(*parsed_output)
+
+    def _merge_completed(self, return_when):
+        done, _ = concurrent.futures.wait(self.pending, return_when=return_when)
+        for parsed_output in done:
+            self._merge_parsed(*self.pending.pop(parsed_output), parsed_output.result())
+
+    def close(self):
+        # Outputs may also have been removed since the last refresh.
+        if self.skipped and not self.cache.is_unchanged():
+            self._load_skipped()
+        if self.executor is None:
+            return
+        self._merge_completed(concurrent.futures.ALL_COMPLETED)
+        self.executor.shutdown()
 
-def _gather_cc_meta(target_list: list, top_dir: str):
-    print(">>> Analyzing cc-meta-info...")
 
+def _follow_build_events(bep_file_name: str, build_process: subprocess.Popen):
+    """Generate the build events written to a --build_event_json_file while bazel is running."""
+    with open(bep_file_name, "r") as bep_file:
+        event_line = ""
+        saw_exit = False
+        while True:
+            event_line += bep_file.readline()
+            if event_line.endswith("\n"):
+                event = json.loads(event_line)
+                event_line = ""
+                yield event
+                if event.get("lastMessage", False):
+                    return
+                continue
+            # Nothing new to read. Once bazel exited, we read one last time to get all that was flushed.
+            if saw_exit:
+                return
+            if build_process.poll() is not None:
+                saw_exit = True
+                continue
+            time.sleep(0.05)
+
+
+def _file_path_from_build_event(bep_file: dict, top_dir: str):
+    uri = bep_file.get("uri", "")
+    if uri.startswith("file://"):
+        return urllib.parse.unquote(urllib.parse.urlparse(uri).path)
+    # Not a local file uri (e.g., remote build), try the path relative to the execution root.
+    return os.path.join(top_dir, *bep_file.get("pathPrefix", []), bep_file["name"])
+
+
+def _expand_named_file_sets(file_set_ids: list, named_file_sets: dict, top_dir: str):
+    """Generate the file paths and digests of named sets of files (and their nested sets)."""
+    pending_ids = [fs["id"] for fs in file_set_ids]
+    visited_ids = set()
+    while pending_ids:
+        set_id = pending_ids.pop()
+        if set_id in visited_ids or set_id not in named_file_sets:
+            continue
+        visited_ids.add(set_id)
+        named_set = named_file_sets[set_id]
+        for bep_file in named_set.get("files", []):
+            yield _file_path_from_build_event(bep_file, top_dir), bep_file.get(
+                "digest", ""
+            )
+        pending_ids.extend([fs["id"] for fs in named_set.get("fileSets", [])])
+
+
+def _build_with_output_files(
+    build_flags: list, top_dir: str, on_output_file, output_group: str = "cc_meta"
+):
+    """Run a bazel build and call on_output_file(file_name, file_digest) for each cc_meta output.
+
+    Outputs are read from the build event protocol, while the build is running, so that they can
+    be processed as soon as each target completes.
+    """
+    named_file_sets = {}  # Named set id to namedSetOfFiles event payload.
+
+    # Bazel's warnings and errors go straight through to our stderr.
+    with tempfile.NamedTemporaryFile(
+        prefix="cc_meta_build_events_", suffix=".json"
+    ) as bep_file, _profiler.subprocess("bazel build"):
+        build_process = subprocess.Popen(
+            ["bazel", "build", "--build_event_json_file={}".format(bep_file.name)]
+            + build_flags,
+            stdout=subprocess.DEVNULL,
+        )
+
+        for event in _follow_build_events(bep_file.name, build_process):
+            event_id = event.get("id", {})
+            if "namedSet" in event_id:
+                named_file_sets[event_id["namedSet"]["id"]] = event.get(
+                    "namedSetOfFiles", {}
+                )
+            elif "targetCompleted" in event_id:
+                for target_output_group in event.get("completed", {}).get(
+                    "outputGroup", []
+                ):
+                    if target_output_group.get("name") != output_group:
+                        continue
+                    for out_file_name, out_file_digest in _expand_named_file_sets(
+                        target_output_group.get("fileSets", []),
+                        named_file_sets,
+                        top_dir,
+                    ):
+                        on_output_file(out_file_name, out_file_digest)
+
+        return build_process.wait()
+
+
+# Output group of the aspect for each refresh mode (see _cc_meta_output_groups in cc_meta.bzl).
+_OUTPUT_GROUPS = {
+    "full": "cc_meta",
+    "compile_commands": "cc_meta_compile_commands",
+    "deps": "cc_meta_deps",
+}
+
+
+def _build_and_load(
+    target_list: list,
+    top_dir: str,
+    bazel_flags: list,
+    refresh_args: argparse.Namespace,
+    merger: _CcMetaMerger,
+    cache: _MergeCache,
+):
+    """Build the aspect on a list of targets, loading its outputs into the merger (and cache)."""
     common_flags = [
         # Shush logging. Just for readability.
         "--ui_event_filters=-info",
@@ -115,106 +870,1052 @@ def _gather_cc_meta(target_list: list, top_dir: str):
         # Begin: template filled by Bazel
         {cc_meta_aspect},  # noqa
         # End:   template filled by Bazel
-        "--output_groups=cc_meta",
-        # Show all generated files
-        "--show_result=10000",
+        "--output_groups={}".format(_OUTPUT_GROUPS[refresh_args.cc_meta_mode]),
+        # Generated files are collected from the build events, don't list them.
+        "--show_result=0",
         # Keep going even if errors occur
         "-k",
         # Skip incompatible explicit targets listed (approximate cquery)
         "--skip_incompatible_explicit_targets",
-    ] + sys.argv[1:]
+    ] + bazel_flags
 
-    target_build_args = (
-        [
-            "bazel",
-            "build",
-        ]
-        + target_list
-        + common_flags
+    loader = _OutputFilesLoader(
+        merger, refresh_args.cc_meta_jobs, refresh_args.cc_meta_process_pool, cache
     )
 
-    target_build_process = subprocess.run(
-        target_build_args,
-        capture_output=True,
-    )
+    with _target_pattern_file(target_list) as target_file_name:
+        build_returncode = _build_with_output_files(
+            ["--target_pattern_file={}".format(target_file_name)] + common_flags,
+            top_dir,
+            loader.add_output_file,
+            _OUTPUT_GROUPS[refresh_args.cc_meta_mode],
+        )
+        loader.close()
 
-    if target_build_process.returncode != 0:
+    if build_returncode != 0:
         print("Failed to build all targets. Results will be partial.", file=sys.stderr)
 
-    compile_commands_by_file = {}
-    combined_all_imports_list = []
-    combined_exports_dict = {}  # Target name to exports
-    combined_deps_issues_dict = {}  # Target name to deps issues
-
-    for out_ln in target_build_process.stderr.splitlines():
-        out_ln_str = out_ln.decode()
-        if out_ln_str.startswith("WARNING") or out_ln_str.startswith("ERROR"):
-            print(out_ln_str, file=sys.stderr)
-        elif out_ln_str.endswith("_cc_meta_compile_commands.json"):
-            target_compile_commands = _load_json_or_empty_list(out_ln_str.lstrip())
-            for tcmd in target_compile_commands:
-                tcmd_file = tcmd["file"]
-                compile_commands_by_file.update(
-                    {
-                        tcmd_file: {
-                            "arguments": tcmd["arguments"],
-                            "file": tcmd_file,
-                            "compile_file": tcmd_file,
-                            "directory": top_dir,
-                        }
-                    }
+
+def _gather_cc_meta(
+    target_list: list,
+    top_dir: str,
+    bazel_flags: list,
+    refresh_args: argparse.Namespace,
+    cache: _MergeCache,
+    output_file_names: list,
+):
+    print(">>> Analyzing cc-meta-info...")
+
+    merger = _CcMetaMerger(top_dir, refresh_args.cc_meta_deps_usage)
+    if refresh_args.cc_meta_header_report:
+        merger.header_report = _HeaderReport(top_dir)
+    if cache is not None:
+        # Without the outputs of the unchanged files, there would be nothing to watch or report.
+        cache.skip_unchanged = (
+            not refresh_args.cc_meta_watch
+            and not refresh_args.cc_meta_header_report
+            and all(os.path.exists(f) for f in output_file_names)
+        )
+    with _profiler.phase("build_and_load"):
+        _build_and_load(target_list, top_dir, bazel_flags, refresh_args, merger, cache)
+
+    if merger.header_report is not None:
+        with _profiler.phase("write_header_report"):
+            _write_header_report(
+                merger.header_report, refresh_args.cc_meta_header_report
+            )
+
+    if cache is not None and cache.file_name:
+        print(
+            ">>> Parsed {} changed output files, {} were unchanged.".format(
+                cache.parsed_count, len(cache.new_keys) - cache.parsed_count
+            )
+        )
+        with _profiler.phase("save_merge_cache"):
+            cache.save()
+            _profiler.count_file("bytes_written", cache.file_name)
+        if cache.is_unchanged() and all(os.path.exists(f) for f in output_file_names):
+            return None
+
+    with _profiler.phase("merge"):
+        merger.finish()
+        _profiler.count("records", len(merger.compile_commands))
+
+    if refresh_args.cc_meta_header_sources:
+        with open(refresh_args.cc_meta_header_sources, "w") as output_file:
+            json.dump(
+                merger.get_header_sources(), output_file, indent=2, sort_keys=True
+            )
+
+    print(
+        "\r>>> Finished extracting cc-meta-info (got {} files indexed)".format(
+            len(merger.compile_commands)
+        )
+    )
+
+    return merger
+
+
+def _write_header_report(header_report: _HeaderReport, report_file_name: str):
+    ranked_headers = header_report.get_ranked_headers()
+    with _atomic_output_file(report_file_name) as output_file:
+        json.dump(
+            {
+                "translation_units": header_report.translation_units,
+                "headers": ranked_headers,
+            },
+            output_file,
+            indent=2,
+        )
+    _profiler.count_file("bytes_written", report_file_name)
+    _profiler.count("records", len(ranked_headers))
+    print(
+        ">>> Wrote the cost of {} headers included by {} translation units to {}".format(
+            len(ranked_headers), header_report.translation_units, report_file_name
+        )
+    )
+
+
+# Cache of the reduced output files, kept in bazel-out (see --cc_meta_incremental).
+_MERGE_CACHE_FILE_NAME = "cc_meta_refresh_cache.sqlite"
+
+
+def _get_merge_cache_file_name(top_dir: str):
+    # Not in the workspace, where anyone could commit or plant a cache file.
+    return os.path.join(top_dir, "bazel-out", _MERGE_CACHE_FILE_NAME)
+
+
+def _parse_refresh_args(argv: list):
+    """Split the options of this tool from the options forwarded to bazel.
+
+    Options of this tool are all prefixed with '--cc_meta_' so that they can never be confused
+    with bazel options, everything else is returned untouched to be passed on to bazel.
+    """
+    parser = argparse.ArgumentParser(
+        prog="RefreshCcMeta",
+        description="Refresh cc_meta databases (arguments not listed here are passed to bazel).",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--cc_meta_discovery",
+        choices=["cquery", "aspect"],
+        default="cquery",
+        help="How to find the targets to analyze: 'cquery' lists all C/C++ rules below the target "
+        "patterns with a single cquery, 'aspect' skips the cquery and applies the aspect directly "
+        "to the target patterns (faster, but only reaches C/C++ rules through 'deps').",
+    )
+    parser.add_argument(
+        "--cc_meta_mode",
+        choices=list(_OUTPUT_GROUPS),
+        default="full",
+        help="Which databases to refresh: 'compile_commands' only builds the compile commands "
+        "(no preprocessing, headers only get their own commands), 'deps' only checks the direct "
+        "includes for dependency issues, 'full' does both and uses the transitive includes of "
+        "sources to give compile commands to all headers (default). Exports and owners are always "
+        "refreshed, other databases are left as they are.",
+    )
+    parser.add_argument(
+        "--cc_meta_jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of workers parsing the aspect output files (default: number of CPUs).",
+    )
+    parser.add_argument(
+        "--cc_meta_process_pool",
+        action="store_true",
+        help="Parse the aspect output files in worker processes instead of threads.",
+    )
+    parser.add_argument(
+        "--cc_meta_incremental",
+        action="store_true",
+        help="Keep a cache of the reduced output files in bazel-out ({}), such that only the "
+        "output files that changed since the last refresh are parsed, and the databases are "
+        "left alone if none did.".format(_MERGE_CACHE_FILE_NAME),
+    )
+    parser.add_argument(
+        "--cc_meta_shard_depth",
+        type=int,
+        default=0,
+        help="Instead of a single compile_commands.json, write one compilation database per "
+        "directory, up to this many levels deep, in {}/ along with an index (default: 0, no "
+        "sharding).".format(_COMPILE_COMMANDS_SHARDS_DIR),
+    )
+    parser.add_argument(
+        "--cc_meta_command_strings",
+        action="store_true",
+        help="Write compile commands as 'command' strings instead of 'arguments' lists.",
+    )
+    parser.add_argument(
+        "--cc_meta_header_sources",
+        default="",
+        help="Write the file whose compile command was chosen for each header to this json file "
+        "(for debugging).",
+    )
+    parser.add_argument(
+        "--cc_meta_header_report",
+        default="",
+        help="Write the headers ranked by their estimated preprocessing cost (the number of "
+        "translation units including them times the size of their transitive includes) to this "
+        "json file.",
+    )
+    parser.add_argument(
+        "--cc_meta_profile",
+        default="",
+        help="Write the time spent in each phase of the refresh, with subprocesses, bytes read "
+        "and written and record counts, to this file as Chrome trace events, and print a "
+        "summary to stderr.",
+    )
+    parser.add_argument(
+        "--cc_meta_ndjson",
+        action="store_true",
+        help="Write target_exports and dependency_issues as line-delimited json (.ndjson), one "
+        "record per target, with an index of the byte offset of each record (.ndjson.index).",
+    )
+    parser.add_argument(
+        "--cc_meta_deps_usage",
+        action="store_true",
+        help="Also write target_deps_usage.json, the include paths that each target uses from "
+        "each of its deps (for deps_graph_report).",
+    )
+    parser.add_argument(
+        "--cc_meta_watch",
+        action="store_true",
+        help="After the refresh, keep watching the workspace for changes to sources, headers and "
+        "BUILD files, and refresh the databases for the affected targets (and their direct "
+        "dependents) only.",
+    )
+    parser.add_argument(
+        "--cc_meta_watch_polling",
+        action="store_true",
+        help="Find changes by scanning directories instead of using inotify (e.g., for network "
+        "file systems). Polling is also used when inotify is not available.",
+    )
+    parser.add_argument(
+        "--cc_meta_watch_interval",
+        type=float,
+        default=1.0,
+        help="Seconds between scans of the directories when polling for changes (default: 1).",
+    )
+    parser.add_argument(
+        "--cc_meta_scope",
+        action="append",
+        default=[],
+        help="Only refresh the targets owning this file (or with this label), and their direct "
+        "dependents, and merge the results into the existing databases. Can be repeated.",
+    )
+    refresh_args, bazel_flags = parser.parse_known_args(argv)
+    if refresh_args.cc_meta_scope and refresh_args.cc_meta_watch:
+        parser.error("--cc_meta_scope cannot be combined with --cc_meta_watch")
+    for scope_item in refresh_args.cc_meta_scope:
+        if _is_scope_label(scope_item):
+            try:
+                _split_label(scope_item)
+            except ValueError as e:
+                parser.error("--cc_meta_scope: {}".format(e))
+    if refresh_args.cc_meta_header_report and refresh_args.cc_meta_mode != "full":
+        parser.error("--cc_meta_header_report needs --cc_meta_mode=full")
+    if (
+        refresh_args.cc_meta_deps_usage
+        and refresh_args.cc_meta_mode == "compile_commands"
+    ):
+        parser.error(
+            "--cc_meta_deps_usage cannot be combined with --cc_meta_mode=compile_commands"
+        )
+    return refresh_args, bazel_flags
+
+
+@contextlib.contextmanager
+def _atomic_output_file(file_name: str):
+    """Open a temporary file to write, which replaces file_name once it is completely written."""
+    tmp_file_name = file_name + ".tmp"
+    with open(tmp_file_name, "w") as output_file:
+        yield output_file
+    os.replace(tmp_file_name, file_name)
+
+
+class _CompileCommandsWriter:
+    """Streams compile commands to compilation database files, one entry per line.
+
+    Header entries share the arguments list of the source that includes them, so each distinct
+    arguments list is serialized only once, no matter how many entries use it.
+    """
+
+    def __init__(self, as_command_strings: bool):
+        self.as_command_strings = as_command_strings
+        self.serialized_commands = {}  # Arguments tuple to serialized command
+
+    def serialize_entry(self, cmd: dict):
+        # Merged entries already share interned tuples (see _CcMetaMerger), this copies nothing.
+        arguments = tuple(cmd["arguments"])
+        serialized_command = self.serialized_commands.get(arguments)
+        if serialized_command is None:
+            if self.as_command_strings:
+                serialized_command = '"command": ' + json.dumps(shlex.join(arguments))
+            else:
+                serialized_command = '"arguments": ' + json.dumps(arguments)
+            self.serialized_commands[arguments] = serialized_command
+        return '{{{}, "file": {}, "directory": {}}}'.format(
+            serialized_command, json.dumps(cmd["file"]), json.dumps(cmd["directory"])
+        )
+
+    def write(self, file_name: str, comp_cmds: list):
+        # Swap the new database in at the end, such that tools never read a partially written one.
+        with _atomic_output_file(file_name) as output_file:
+            output_file.write("[\n")
+            for i, cmd in enumerate(comp_cmds):
+                if i > 0:
+                    output_file.write(",\n")
+                output_file.write(self.serialize_entry(cmd))
+            output_file.write("\n]\n")
+
+
+# Directory of compilation database shards and their index (see --cc_meta_shard_depth).
+_COMPILE_COMMANDS_SHARDS_DIR = "compile_commands.d"
+_COMPILE_COMMANDS_SHARDS_INDEX = os.path.join(
+    _COMPILE_COMMANDS_SHARDS_DIR, "index.json"
+)
+
+
+def _get_shard_key(file_path: str, shard_depth: int):
+    file_dir_parts = pathlib.PurePath(file_path.lstrip("/")).parent.parts
+    return "/".join(file_dir_parts[:shard_depth]) or "."
+
+
+def _write_compile_commands_shards(
+    comp_cmds: list, writer: _CompileCommandsWriter, shard_depth: int
+):
+    """Write one compilation database per directory (up to shard_depth levels), plus an index.
+
+    Entries are grouped by their index in comp_cmds, and materialized while their shard is written.
+    """
+    cmd_indices_by_shard = {}
+    for cmd_index, cmd in enumerate(comp_cmds):
+        cmd_indices_by_shard.setdefault(
+            _get_shard_key(cmd["file"], shard_depth), array.array("q")
+        ).append(cmd_index)
+
+    # Write the new shards aside, and swap them in at the end, so stale shards are never left behind.
+    tmp_shards_dir = _COMPILE_COMMANDS_SHARDS_DIR + ".tmp"
+    shutil.rmtree(tmp_shards_dir, ignore_errors=True)
+    shards_index = {}
+    for shard_key, shard_cmd_indices in sorted(cmd_indices_by_shard.items()):
+        shard_file_name = os.path.normpath(
+            os.path.join(shard_key, "compile_commands.json")
+        )
+        os.makedirs(os.path.join(tmp_shards_dir, shard_key), exist_ok=True)
+        writer.write(
+            os.path.join(tmp_shards_dir, shard_file_name),
+            map(comp_cmds.__getitem__, shard_cmd_indices),
+        )
+        shards_index[shard_key] = {
+            "compile_commands": shard_file_name,
+            "entries": len(shard_cmd_indices),
+        }
+    with open(os.path.join(tmp_shards_dir, "index.json"), "w") as output_file:
+        json.dump(shards_index, output_file, indent=2, sort_keys=True)
+    shutil.rmtree(_COMPILE_COMMANDS_SHARDS_DIR, ignore_errors=True)
+    os.rename(tmp_shards_dir, _COMPILE_COMMANDS_SHARDS_DIR)
+
+
+def _write_exports_index(file_name: str, exports_dict: dict):
+    """Write an sqlite index of the targets exporting each include path.
+
+    Tools can look up the providers of a few include paths without parsing target_exports.json.
+    Paths are also stored with their components reversed (e.g., "bar.h/foo" for "foo/bar.h"),
+    so that include paths written with a different prefix can be found by a range query.
+    """
+    tmp_file_name = file_name + ".tmp"
+    if os.path.exists(tmp_file_name):
+        os.remove(tmp_file_name)
+    index_db = sqlite3.connect(tmp_file_name)
+    index_db.execute(
+        "CREATE TABLE exports "
+        "(include_path TEXT NOT NULL, reversed_path TEXT NOT NULL, target TEXT NOT NULL)"
+    )
+    index_db.executemany(
+        "INSERT INTO exports VALUES (?, ?, ?)",
+        (
+            (incl_path, cc_meta_records.reverse_path(incl_path), target_name)
+            for target_name, target_exports in exports_dict.items()
+            for incl_path in set(target_exports["exports"])
+        ),
+    )
+    index_db.execute("CREATE INDEX exports_by_include_path ON exports (include_path)")
+    index_db.execute("CREATE INDEX exports_by_reversed_path ON exports (reversed_path)")
+    index_db.commit()
+    index_db.close()
+    os.replace(tmp_file_name, file_name)
+
+
+def _get_records_file_name(database: str, as_ndjson: bool):
+    return database + (".ndjson" if as_ndjson else ".json")
+
+
+def _write_ndjson_records(file_name: str, records_dict: dict):
+    """Write one json record per line, and an index of the byte offset of each target's record.
+
+    With the index (file_name + ".index"), tools can read the records of a few targets without
+    parsing the whole file.
+    """
+    record_offsets = {}
+    offset = 0
+    with _atomic_output_file(file_name) as output_file:
+        for target_name, record in records_dict.items():
+            # The records are ascii (json escapes the rest), so characters are bytes.
+            record_line = json.dumps(record, separators=(",", ":")) + "\n"
+            output_file.write(record_line)
+            record_offsets[target_name] = offset
+            offset += len(record_line)
+    with _atomic_output_file(file_name + ".index") as index_file:
+        json.dump(record_offsets, index_file)
+
+
+def _load_target_records(database: str):
+    """Read all records of a database by target, in whichever format it was last written."""
+    records_file_name = cc_meta_records.find_records_file(
+        _get_records_file_name(database, False)
+    )
+    try:
+        records_dict = cc_meta_records.load_records(records_file_name, _json_loads)
+    except OSError:
+        return {}
+    _profiler.count_file("bytes_read", records_file_name)
+    return records_dict
+
+
+def _write_compile_commands(comp_cmds: list, refresh_args: argparse.Namespace):
+    # Chain output into compile_commands.json (or its shards)
+    with _profiler.phase("write_compile_commands"):
+        comp_cmds_writer = _CompileCommandsWriter(refresh_args.cc_meta_command_strings)
+        if refresh_args.cc_meta_shard_depth > 0:
+            _write_compile_commands_shards(
+                comp_cmds, comp_cmds_writer, refresh_args.cc_meta_shard_depth
+            )
+            if refresh_args.cc_meta_profile:
+                for shards_dir, _, shard_files in os.walk(_COMPILE_COMMANDS_SHARDS_DIR):
+                    for shard_file in shard_files:
+                        _profiler.count_file(
+                            "bytes_written", os.path.join(shards_dir, shard_file)
+                        )
+            # Don't leave the database of the other layout behind, tools would pick it up.
+            if os.path.exists("compile_commands.json"):
+                os.remove("compile_commands.json")
+        else:
+            comp_cmds_writer.write("compile_commands.json", comp_cmds)
+            _profiler.count_file("bytes_written", "compile_commands.json")
+            shutil.rmtree(_COMPILE_COMMANDS_SHARDS_DIR, ignore_errors=True)
+        _profiler.count("records", len(comp_cmds))
+
+
+def _write_cc_meta_outputs(merger: _CcMetaMerger, refresh_args: argparse.Namespace):
+    """Write the databases from the merged outputs, each one replacing the previous one at once.
+
+    Databases that the refresh mode does not produce (see --cc_meta_mode) are left as they are.
+    """
+    if refresh_args.cc_meta_mode != "deps":
+        _write_compile_commands(merger.compile_commands, refresh_args)
+
+    databases = [("target_exports", merger.exports_dict)]
+    if refresh_args.cc_meta_mode != "compile_commands":
+        databases.append(("dependency_issues", merger.deps_issues_dict))
+    for database, output_dict in databases:
+        output_file_name = _get_records_file_name(database, refresh_args.cc_meta_ndjson)
+        with _profiler.phase("write_" + output_file_name):
+            if refresh_args.cc_meta_ndjson:
+                _write_ndjson_records(output_file_name, output_dict)
+            else:
+                with _atomic_output_file(output_file_name) as output_file:
+                    json.dump(output_dict, output_file, indent=2, check_circular=False)
+            _profiler.count_file("bytes_written", output_file_name)
+            _profiler.count("records", len(output_dict))
+        # Don't leave the database of the other format behind, tools would pick it up.
+        stale_file_name = _get_records_file_name(
+            database, not refresh_args.cc_meta_ndjson
+        )
+        for stale_output_file_name in [stale_file_name, stale_file_name + ".index"]:
+            if os.path.exists(stale_output_file_name):
+                os.remove(stale_output_file_name)
+
+    output_dicts = [("target_owners.json", merger.owners_dict)]
+    if refresh_args.cc_meta_deps_usage:
+        output_dicts.append(("target_deps_usage.json", merger.deps_usage_dict))
+    for output_file_name, output_dict in output_dicts:
+        with _profiler.phase("write_" + output_file_name):
+            with _atomic_output_file(output_file_name) as output_file:
+                json.dump(output_dict, output_file, indent=2, check_circular=False)
+            _profiler.count_file("bytes_written", output_file_name)
+            _profiler.count("records", len(output_dict))
+
+    with _profiler.phase("write_target_exports.sqlite"):
+        _write_exports_index("target_exports.sqlite", merger.exports_dict)
+        _profiler.count_file("bytes_written", "target_exports.sqlite")
+
+
+# Names of the files declaring the targets of a package.
+_BUILD_FILE_NAMES = ["BUILD.bazel", "BUILD"]
+
+# Time without any new change before a batch of changes is refreshed (see --cc_meta_watch).
+_WATCH_SETTLE_TIME = 0.3
+
+
+def _get_target_package(target_name: str):
+    # Only targets of the main repository ("@@//package:name") have their files in the workspace.
+    if not target_name.startswith("@@//"):
+        return None
+    return target_name[len("@@//") :].partition(":")[0]
+
+
+def _is_workspace_file(file_name: str):
+    return not (
+        os.path.isabs(file_name)
+        or file_name.startswith("bazel-out/")
+        or file_name.startswith("external/")
+    )
+
+
+def _get_watched_dirs(merger: _CcMetaMerger):
+    """List the workspace directories with files owned by targets, or with their BUILD files."""
+    watched_dirs = set()
+    for owned_file in merger.owners_dict:
+        if _is_workspace_file(owned_file):
+            watched_dirs.add(os.path.dirname(owned_file) or ".")
+    for target_name in merger.exports_dict:
+        target_package = _get_target_package(target_name)
+        if target_package is not None:
+            watched_dirs.add(target_package or ".")
+    return {d for d in watched_dirs if os.path.isdir(d)}
+
+
+class _PollingWatcher:
+    """Finds changed files by scanning the watched directories at regular intervals."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.dir_entries = {}  # Directory to {file name: (mtime, size)}
+
+    def _scan_dir(self, dir_name: str):
+        dir_entries = {}
+        try:
+            with os.scandir(dir_name) as dir_iter:
+                for entry in dir_iter:
+                    if entry.is_file():
+                        entry_stat = entry.stat()
+                        dir_entries[entry.name] = (
+                            entry_stat.st_mtime_ns,
+                            entry_stat.st_size,
+                        )
+        except OSError:
+            pass
+        return dir_entries
+
+    def watch_dirs(self, dir_names: set):
+        for dir_name in dir_names:
+            if dir_name not in self.dir_entries:
+                self.dir_entries[dir_name] = self._scan_dir(dir_name)
+
+    def wait(self, timeout):
+        """Return the paths of the files that changed, waiting up to timeout seconds (or forever)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(
+                self.interval
+                if deadline is None
+                else max(0.0, min(self.interval, deadline - time.monotonic()))
+            )
+            changed_files = set()
+            for dir_name, old_entries in self.dir_entries.items():
+                new_entries = self._scan_dir(dir_name)
+                for file_name in old_entries.keys() | new_entries.keys():
+                    if old_entries.get(file_name) != new_entries.get(file_name):
+                        changed_files.add(
+                            os.path.normpath(os.path.join(dir_name, file_name))
+                        )
+                self.dir_entries[dir_name] = new_entries
+            if changed_files or (deadline is not None and time.monotonic() >= deadline):
+                return changed_files
+
+
+class _InotifyWatcher:
+    """Finds changed files with inotify (Linux), watching each directory on its own."""
+
+    # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    _EVENT_MASK = 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs_by_descriptor = {}
+        self.watched_dirs = set()
+
+    def watch_dirs(self, dir_names: set):
+        for dir_name in dir_names - self.watched_dirs:
+            watch_descriptor = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(dir_name), self._EVENT_MASK
+            )
+            if watch_descriptor < 0:
+                print(
+                    "WARNING: Cannot watch '{}' for changes: {}".format(
+                        dir_name, os.strerror(ctypes.get_errno())
+                    ),
+                    file=sys.stderr,
                 )
-        elif out_ln_str.endswith("_cc_meta_all_imports.json"):
-            all_imports_list = _load_json_or_empty_list(out_ln_str.lstrip())
-            combined_all_imports_list.extend(all_imports_list)
-        elif out_ln_str.endswith("_cc_meta_exports.json"):
-            target_exports_list = _load_json_or_empty_list(out_ln_str.lstrip())
-            combined_exports_dict.update(
-                {te["target"]: te for te in target_exports_list}
+                continue
+            self.dirs_by_descriptor[watch_descriptor] = dir_name
+            self.watched_dirs.add(dir_name)
+
+    def wait(self, timeout):
+        """Return the paths of the files that changed, waiting up to timeout seconds (or forever)."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        events = os.read(self.fd, 1 << 16)
+        changed_files = set()
+        offset = 0
+        while offset + self._EVENT_HEADER.size <= len(events):
+            watch_descriptor, _, _, name_size = self._EVENT_HEADER.unpack_from(
+                events, offset
             )
-        elif out_ln_str.endswith("_cc_meta_deps_issues.json"):
-            target_deps_issues_list = _load_json_or_empty_list(out_ln_str.lstrip())
-            combined_deps_issues_dict.update(
-                {
-                    di["target"]: di
-                    for di in target_deps_issues_list
-                    if di["not_found"] or di["unused"]
-                }
+            offset += self._EVENT_HEADER.size
+            file_name = events[offset : offset + name_size].rstrip(b"\0")
+            offset += name_size
+            dir_name = self.dirs_by_descriptor.get(watch_descriptor)
+            if dir_name is not None and file_name:
+                changed_files.add(
+                    os.path.normpath(os.path.join(dir_name, os.fsdecode(file_name)))
+                )
+        return changed_files
+
+
+def _make_file_watcher(refresh_args: argparse.Namespace):
+    if not refresh_args.cc_meta_watch_polling:
+        try:
+            return _InotifyWatcher()
+        except (AttributeError, OSError, TypeError):
+            # No inotify on this platform (or no more instances allowed), scan for changes instead.
+            print(">>> inotify is not available, polling for changes instead.")
+    return _PollingWatcher(refresh_args.cc_meta_watch_interval)
+
+
+def _find_targets_to_refresh(
+    changed_files: set, exports_dict: dict, owners_dict: dict, changed_targets=()
+):
+    """Find the targets to analyze again after changes to some files, and their direct dependents.
+
+    Changed sources and headers map to the targets that own them, and changed BUILD files to all
+    the targets of their package, with a 'package:all' pattern which also picks up new targets.
+    Returns the target patterns to build and the known targets that they cover.
+    """
+    target_patterns = set()
+    changed_targets = set(changed_targets)
+    changed_packages = set()
+    for changed_file in changed_files:
+        if os.path.basename(changed_file) in _BUILD_FILE_NAMES:
+            changed_package = os.path.dirname(changed_file)
+            changed_packages.add(changed_package)
+            target_patterns.add("@@//{}:all".format(changed_package))
+        else:
+            changed_targets.update(owners_dict.get(changed_file, []))
+    if changed_packages:
+        for target_name in exports_dict:
+            if _get_target_package(target_name) in changed_packages:
+                changed_targets.add(target_name)
+
+    # Dependents check their includes against the exports of the changed targets.
+    for target_name, target_exports in exports_dict.items():
+        if not changed_targets.isdisjoint(target_exports.get("deps", [])):
+            target_patterns.add(target_name)
+    target_patterns.update(changed_targets)
+    covered_targets = {t for t in target_patterns if t in exports_dict}
+    return sorted(target_patterns), covered_targets
+
+
+def _get_output_prefix(file_name: str):
+    # All the output files of a target share a prefix, e.g., "foo_cc_meta_exports.json" -> "foo".
+    for suffix in _CC_META_OUTPUT_KINDS:
+        if file_name.endswith(suffix):
+            return file_name[: -len(suffix)]
+    return file_name
+
+
+def _replace_target_outputs(outputs: dict, new_outputs: dict, covered_targets: set):
+    """Replace the reduced outputs of the covered targets with new ones.
+
+    Covered targets that did not produce new outputs no longer exist (or no longer build), their
+    outputs are dropped.
+    """
+    stale_prefixes = set()
+    for file_name, (_, kind, reduced) in outputs.items():
+        if kind == "exports" and any(te["target"] in covered_targets for te in reduced):
+            stale_prefixes.add(_get_output_prefix(file_name))
+    updated_outputs = {
+        file_name: entry
+        for file_name, entry in outputs.items()
+        if _get_output_prefix(file_name) not in stale_prefixes
+    }
+    updated_outputs.update(new_outputs)
+    return updated_outputs
+
+
+class _OutputsSink:
+    """Takes the place of the merger when the outputs are only collected (in a _MergeCache)."""
+
+    def __init__(self, keep_deps_usage: bool):
+        self.keep_deps_usage = keep_deps_usage
+
+    def add_output(self, kind: str, contents: list):
+        pass
+
+
+def _merge_outputs(outputs: dict, top_dir: str, keep_deps_usage: bool):
+    merger = _CcMetaMerger(top_dir, keep_deps_usage)
+    for _, kind, reduced in outputs.values():
+        merger.add_output(kind, reduced)
+    merger.finish()
+    return merger
+
+
+def _watch_cc_meta(
+    top_dir: str,
+    bazel_flags: list,
+    refresh_args: argparse.Namespace,
+    cache: _MergeCache,
+    merger: _CcMetaMerger,
+):
+    """Refresh the databases for the targets affected by each change to the workspace, until stopped.
+
+    The reduced outputs of all targets are kept in memory (in the cache), such that each change
+    only builds and parses the outputs of the targets it affects. The databases are then merged
+    again from all the reduced outputs and rewritten, such that headers get the same compile
+    commands as in a full refresh.
+    """
+    watcher = _make_file_watcher(refresh_args)
+    outputs = cache.new_entries
+    if merger is None:
+        merger = _merge_outputs(outputs, top_dir, refresh_args.cc_meta_deps_usage)
+    print(">>> Watching for changes (Ctrl-C to stop)...")
+    try:
+        while True:
+            watcher.watch_dirs(_get_watched_dirs(merger))
+            changed_files = watcher.wait(None)
+            # Editors and version control touch several files at once, wait for things to settle.
+            while True:
+                more_changed_files = watcher.wait(_WATCH_SETTLE_TIME)
+                if not more_changed_files:
+                    break
+                changed_files.update(more_changed_files)
+
+            target_patterns, covered_targets = _find_targets_to_refresh(
+                changed_files, merger.exports_dict, merger.owners_dict
+            )
+            if not target_patterns:
+                continue
+            print(
+                ">>> {} files changed, refreshing {} targets...".format(
+                    len(changed_files), len(target_patterns)
+                )
             )
 
-    for al in combined_all_imports_list:
-        comp_src_file = al["source_file"]
-        if comp_src_file not in compile_commands_by_file:
+            with _profiler.phase("watch_build_and_load"):
+                # Outputs that did not change are found in the cache and not parsed again. They
+                # are only collected here, all the outputs are merged below.
+                round_cache = _MergeCache("", cache.signature, keep_outputs=True)
+                round_cache.old_entries = outputs
+                _build_and_load(
+                    target_patterns,
+                    top_dir,
+                    bazel_flags,
+                    refresh_args,
+                    _OutputsSink(refresh_args.cc_meta_deps_usage),
+                    round_cache,
+                )
+                outputs = _replace_target_outputs(
+                    outputs, round_cache.new_entries, covered_targets
+                )
+
+            with _profiler.phase("watch_merge"):
+                merger = _merge_outputs(
+                    outputs, top_dir, refresh_args.cc_meta_deps_usage
+                )
+                _profiler.count("records", len(merger.compile_commands))
+
+            _write_cc_meta_outputs(merger, refresh_args)
+            cache.replace_entries(outputs)
+            cache.save()
             print(
-                "WARNING: Missing compile commands for {}!".format(comp_src_file),
-                file=sys.stderr,
+                ">>> Refreshed {} output files ({} files indexed).".format(
+                    round_cache.parsed_count, len(merger.compile_commands)
+                )
             )
+    except KeyboardInterrupt:
+        print(">>> Stopped watching for changes.")
+
+
+# Target names of the patterns matching all the targets of a package (see `bazel help target-syntax`).
+_ALL_TARGETS_NAMES = ["all", "*", "all-targets"]
+
+
+def _split_label(label: str):
+    """Split a label or target pattern into its repository, package and name, or raise ValueError."""
+    repo, separator, package_and_name = label.partition("//")
+    package, colon, name = package_and_name.partition(":")
+    package_parts = package.split("/") if package else []
+    if (
+        not separator
+        or (repo and (not repo.startswith("@") or "/" in repo or ":" in repo))
+        or (colon and (not name or ":" in name))
+        or any(p in ["", ".", ".."] for p in package_parts)
+        or "..." in package_parts[:-1]
+        or ("..." in package_parts and colon and name not in _ALL_TARGETS_NAMES)
+    ):
+        raise ValueError("Invalid label or target pattern '{}'".format(label))
+    return repo, package, name if colon else None
+
+
+def _is_target_pattern(label: str):
+    _, package, name = _split_label(label)
+    return package.split("/")[-1] == "..." or name in _ALL_TARGETS_NAMES
+
+
+def _get_qualified_label(label: str):
+    # cc_meta refers to targets of the main repository as @@//package:name (see cc_meta.bzl).
+    repo, package, name = _split_label(label)
+    if repo in ["", "@"]:
+        repo = "@@"
+    if name is None:
+        name = package.rpartition("/")[2]
+    return "{}//{}:{}".format(repo, package, name)
+
+
+def _matches_target_pattern(target_name: str, pattern: str):
+    """Whether a known target of the main repository matches a target pattern."""
+    repo, package, name = _split_label(pattern)
+    target_package = _get_target_package(target_name)
+    if repo not in ["", "@", "@@"] or target_package is None:
+        return False
+    if package.split("/")[-1] == "...":
+        package_prefix = package[: -len("...")]
+        return target_package.startswith(package_prefix) or (
+            target_package == package_prefix.rstrip("/")
+        )
+    return target_package == package
+
+
+def _query_owning_targets(file_names: list):
+    """Ask bazel for the targets owning files that are not in the databases (e.g., new files)."""
+    if not file_names:
+        return []
+    # Put the query in a file, the set of files could be too long for the command line.
+    with tempfile.NamedTemporaryFile(
+        mode="w", prefix="cc_meta_query_", suffix=".txt"
+    ) as query_file:
+        query_file.write(
+            "same_pkg_direct_rdeps(set({}))".format(
+                " ".join(['"{}"'.format(f) for f in file_names])
+            )
+        )
+        query_file.flush()
+        with _profiler.subprocess("bazel query"):
+            owners_query_process = subprocess.run(
+                [
+                    "bazel",
+                    "query",
+                    "--query_file={}".format(query_file.name),
+                    "--keep_going",
+                    "--ui_event_filters=-info",
+                    "--noshow_progress",
+                ],
+                capture_output=True,
+                encoding="utf-8",
+            )
+    # Exit code 3 means some files could not be found, the rest is valid.
+    if owners_query_process.returncode not in [0, 3]:
+        print(owners_query_process.stderr, file=sys.stderr)
+        return []
+    return [
+        _get_qualified_label(t.strip())
+        for t in owners_query_process.stdout.splitlines()
+        if t.strip()
+    ]
+
+
+def _find_scope_targets(scope: list, exports_dict: dict, owners_dict: dict):
+    """Find the targets to analyze for a scope of files and labels (see --cc_meta_scope)."""
+    scope_files = set()
+    scope_targets = set()
+    scope_patterns = set()
+    unknown_files = []
+    for scope_item in scope:
+        if _is_scope_label(scope_item) and _is_target_pattern(scope_item):
+            # Patterns are built as they are, and cover the known targets that they match.
+            scope_patterns.add(scope_item)
+            scope_targets.update(
+                t for t in exports_dict if _matches_target_pattern(t, scope_item)
+            )
+            continue
+        if _is_scope_label(scope_item):
+            scope_targets.add(_get_qualified_label(scope_item))
             continue
-        comp_cmd = compile_commands_by_file[comp_src_file]
-        for imp_file in al["imports"]:
-            new_cmd = {
-                "arguments": comp_cmd["arguments"],
-                "file": imp_file,
-                "compile_file": comp_cmd["compile_file"],
-                "directory": top_dir,
+        scope_file = os.path.normpath(
+            os.path.relpath(scope_item) if os.path.isabs(scope_item) else scope_item
+        )
+        if (
+            scope_file in owners_dict
+            or os.path.basename(scope_file) in _BUILD_FILE_NAMES
+        ):
+            scope_files.add(scope_file)
+        else:
+            unknown_files.append(scope_file)
+    scope_targets.update(_query_owning_targets(unknown_files))
+    target_patterns, covered_targets = _find_targets_to_refresh(
+        scope_files, exports_dict, owners_dict, scope_targets
+    )
+    return sorted(scope_patterns.union(target_patterns)), covered_targets
+
+
+def _is_scope_label(scope_item: str):
+    return scope_item.startswith("//") or scope_item.startswith("@")
+
+
+def _load_json_or_empty_dict(file_name: str):
+    try:
+        with open(file_name, "rb") as f:
+            return _json_loads(f.read())
+    except OSError:
+        return {}
+
+
+def _load_existing_compile_commands(refresh_args: argparse.Namespace):
+    """Read the entries of the existing compilation database (or its shards).
+
+    The database is read in whichever layout the last refresh wrote, which may not be the one
+    this refresh writes (see --cc_meta_shard_depth).
+    """
+    as_shards = os.path.exists(_COMPILE_COMMANDS_SHARDS_INDEX)
+    if as_shards and os.path.exists("compile_commands.json"):
+        # Both layouts are there (e.g., one of them was written by hand), update ours.
+        as_shards = refresh_args.cc_meta_shard_depth > 0
+    if as_shards:
+        shards_index = _load_json_or_empty_dict(_COMPILE_COMMANDS_SHARDS_INDEX)
+        db_file_names = [
+            os.path.join(_COMPILE_COMMANDS_SHARDS_DIR, shard["compile_commands"])
+            for shard in shards_index.values()
+        ]
+    else:
+        db_file_names = ["compile_commands.json"]
+    for db_file_name in db_file_names:
+        _profiler.count_file("bytes_read", db_file_name)
+        for cmd in _load_json_or_empty_dict(db_file_name) or []:
+            yield {
+                "arguments": cmd.get("arguments") or shlex.split(cmd["command"]),
+                "file": cmd["file"],
+                "directory": cmd["directory"],
             }
-            if (imp_file not in compile_commands_by_file) or _should_update_comp_cmd(
-                compile_commands_by_file[imp_file], new_cmd
-            ):
-                compile_commands_by_file.update({imp_file: new_cmd})
 
-    combined_compile_commands = []
-    for cmd in compile_commands_by_file.values():
-        del cmd["compile_file"]
-        combined_compile_commands.append(cmd)
 
+def _merge_into_existing_outputs(
+    merger: _CcMetaMerger,
+    existing_exports: dict,
+    covered_targets: set,
+    refresh_args: argparse.Namespace,
+):
+    """Merge the outputs of a scoped refresh into the existing databases, by target.
+
+    Entries of the refreshed targets are replaced, or removed if the target is gone. Files owned
+    by the refreshed targets get their compile command from the new outputs, other files keep
+    theirs, and the new outputs only fill in files that had none.
+    """
+    refreshed_targets = covered_targets | merger.exports_dict.keys()
+    refreshed_files = set()
+    for target_name in refreshed_targets:
+        for target_exports in [
+            existing_exports.get(target_name, {}),
+            merger.exports_dict.get(target_name, {}),
+        ]:
+            refreshed_files.update(target_exports.get("files", []))
+
+    if refresh_args.cc_meta_mode != "deps":
+        new_compile_commands = {cmd["file"]: cmd for cmd in merger.compile_commands}
+        compile_commands = []
+        for cmd in _load_existing_compile_commands(refresh_args):
+            if cmd["file"] in refreshed_files:
+                continue
+            new_compile_commands.pop(cmd["file"], None)
+            compile_commands.append(cmd)
+        compile_commands.extend(new_compile_commands.values())
+        merger.compile_commands = compile_commands
+
+    exports_dict = {
+        t: te for t, te in existing_exports.items() if t not in refreshed_targets
+    }
+    exports_dict.update(merger.exports_dict)
+    merger.exports_dict = exports_dict
+    merger.owners_dict = _get_owners(exports_dict)
+
+    if refresh_args.cc_meta_mode != "compile_commands":
+        deps_issues_dict = {
+            t: di
+            for t, di in _load_target_records("dependency_issues").items()
+            if t not in refreshed_targets
+        }
+        deps_issues_dict.update(merger.deps_issues_dict)
+        merger.deps_issues_dict = deps_issues_dict
+
+    if merger.keep_deps_usage:
+        deps_usage_dict = {
+            t: du
+            for t, du in _load_json_or_empty_dict("target_deps_usage.json").items()
+            if t not in refreshed_targets
+        }
+        deps_usage_dict.update(merger.deps_usage_dict)
+        merger.deps_usage_dict = deps_usage_dict
+
+
+def _refresh_scope(
+    scope: list, top_dir: str, bazel_flags: list, refresh_args: argparse.Namespace
+):
+    """Refresh the databases for the targets owning a set of files or labels, and their dependents.
+
+    Returns the exit status, or None if there are no databases to merge into yet.
+    """
+    if not any(
+        os.path.exists(_get_records_file_name("target_exports", as_ndjson))
+        for as_ndjson in [False, True]
+    ):
+        print(">>> No existing cc_meta databases to merge into, refreshing everything.")
+        return None
+
+    with _profiler.phase("scope_targets"):
+        existing_exports = _load_target_records("target_exports")
+        target_patterns, covered_targets = _find_scope_targets(
+            scope, existing_exports, _get_owners(existing_exports)
+        )
+        _profiler.count("records", len(target_patterns))
+    if not target_patterns:
+        print(">>> No targets found for the given scope, nothing to refresh.")
+        return 0
     print(
-        "\r>>> Finished extracting cc-meta-info (got {} files indexed)".format(
-            len(compile_commands_by_file)
+        ">>> Refreshing {} targets owning (or depending on) the given scope...".format(
+            len(target_patterns)
         )
     )
 
-    return combined_compile_commands, combined_exports_dict, combined_deps_issues_dict
+    merger = _CcMetaMerger(top_dir, refresh_args.cc_meta_deps_usage)
+    with _profiler.phase("build_and_load"):
+        _build_and_load(
+            target_patterns, top_dir, bazel_flags, refresh_args, merger, None
+        )
+
+    with _profiler.phase("merge"):
+        merger.finish()
+        _merge_into_existing_outputs(
+            merger, existing_exports, covered_targets, refresh_args
+        )
+        _profiler.count("records", len(merger.compile_commands))
+    _write_cc_meta_outputs(merger, refresh_args)
+    return 0
 
 
 def _ensure_cwd_is_workspace_root():
@@ -244,10 +1945,11 @@ def _get_workspace_exec_root(ws_root):
     # since that would be rewired correctly if the cache directory is moved (e.g., bazel clean).
 
     # First, attempt to get the bazel-<workspace-name> path (symlink to cache dir).
-    info_ws_process = subprocess.run(
-        ["bazel", "info", "workspace"],
-        capture_output=True,
-    )
+    with _profiler.subprocess("bazel info"):
+        info_ws_process = subprocess.run(
+            ["bazel", "info", "workspace"],
+            capture_output=True,
+        )
 
     if info_ws_process.returncode == 0 and info_ws_process.stdout:
         ws_name = pathlib.Path(info_ws_process.stdout.decode().strip()).name
@@ -272,10 +1974,11 @@ def _get_workspace_exec_root(ws_root):
         )
 
     # Second, attempt to get the bazel cache execroot directly.
-    info_er_process = subprocess.run(
-        ["bazel", "info", "execution_root"],
-        capture_output=True,
-    )
+    with _profiler.subprocess("bazel info"):
+        info_er_process = subprocess.run(
+            ["bazel", "info", "execution_root"],
+            capture_output=True,
+        )
 
     if info_er_process.returncode == 0 and info_er_process.stdout:
         ws_abs_exec_root = pathlib.Path(info_er_process.stdout.decode().strip())
@@ -302,9 +2005,15 @@ def _get_workspace_exec_root(ws_root):
 
 
 if __name__ == "__main__":
+    refresh_args, bazel_flags = _parse_refresh_args(sys.argv[1:])
+
     workspace_root = _ensure_cwd_is_workspace_root()
 
-    workspace_execroot = _get_workspace_exec_root(workspace_root)
+    if refresh_args.cc_meta_profile:
+        _profiler.enable(refresh_args.cc_meta_profile)
+
+    with _profiler.phase("workspace_info"):
+        workspace_execroot = _get_workspace_exec_root(workspace_root)
 
     target_patterns = [
         # Begin: template filled by Bazel
@@ -312,23 +2021,82 @@ if __name__ == "__main__":
         # End:   template filled by Bazel
     ]
 
-    comp_cmds, exports, deps_issues = _gather_cc_meta(
-        _get_target_list(target_patterns), str(workspace_execroot)
+    if refresh_args.cc_meta_scope:
+        scope_status = _refresh_scope(
+            refresh_args.cc_meta_scope,
+            str(workspace_execroot),
+            bazel_flags,
+            refresh_args,
+        )
+        if scope_status is not None:
+            sys.exit(scope_status)
+
+    if refresh_args.cc_meta_discovery == "aspect":
+        target_list = target_patterns
+    else:
+        with _profiler.phase("target_list"):
+            target_list = _get_target_list(target_patterns, bazel_flags)
+
+    output_file_names = [
+        _get_records_file_name("target_exports", refresh_args.cc_meta_ndjson),
+        "target_owners.json",
+        "target_exports.sqlite",
+    ]
+    if refresh_args.cc_meta_mode != "compile_commands":
+        output_file_names.append(
+            _get_records_file_name("dependency_issues", refresh_args.cc_meta_ndjson)
+        )
+    if refresh_args.cc_meta_deps_usage:
+        output_file_names.append("target_deps_usage.json")
+    if refresh_args.cc_meta_mode != "deps":
+        if refresh_args.cc_meta_shard_depth > 0:
+            output_file_names.append(_COMPILE_COMMANDS_SHARDS_INDEX)
+        else:
+            output_file_names.append("compile_commands.json")
+
+    merge_cache = None
+    if refresh_args.cc_meta_incremental or refresh_args.cc_meta_watch:
+        with _profiler.phase("load_merge_cache"):
+            merge_cache_file_name = ""
+            if refresh_args.cc_meta_incremental:
+                merge_cache_file_name = _get_merge_cache_file_name(
+                    str(workspace_execroot)
+                )
+                _profiler.count_file("bytes_read", merge_cache_file_name)
+            # The watch mode needs the outputs of all targets, even without a persistent cache.
+            merge_cache = _MergeCache(
+                merge_cache_file_name,
+                [
+                    str(workspace_execroot),
+                    refresh_args.cc_meta_shard_depth,
+                    refresh_args.cc_meta_command_strings,
+                    refresh_args.cc_meta_deps_usage,
+                    refresh_args.cc_meta_mode,
+                ],
+                keep_outputs=refresh_args.cc_meta_watch,
+            )
+
+    merger = _gather_cc_meta(
+        target_list,
+        str(workspace_execroot),
+        bazel_flags,
+        refresh_args,
+        merge_cache,
+        output_file_names,
     )
 
-    if not comp_cmds:
+    if merger is None:
+        print(">>> No output files changed, cc_meta databases are up-to-date.")
+    elif not merger.compile_commands and refresh_args.cc_meta_mode != "deps":
         print(
             ">>> Not writing to compile_commands.json; no sources were found.",
             file=sys.stderr,
         )
         sys.exit(1)
+    else:
+        _write_cc_meta_outputs(merger, refresh_args)
 
-    # Chain output into compile_commands.json
-    with open("compile_commands.json", "w") as output_file:
-        json.dump(comp_cmds, output_file, indent=2, check_circular=False)
-
-    with open("target_exports.json", "w") as output_file:
-        json.dump(exports, output_file, indent=2, check_circular=False)
-
-    with open("dependency_issues.json", "w") as output_file:
-        json.dump(deps_issues, output_file, indent=2, check_circular=False)
+    if refresh_args.cc_meta_watch:
+        _watch_cc_meta(
+            str(workspace_execroot), bazel_flags, refresh_args, merge_cache, merger
+        )
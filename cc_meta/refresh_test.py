@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import tempfile
+import unittest
+
+import refresh
+
+
+def _merge(compile_commands, all_imports):
+    merger = refresh._CcMetaMerger("/workspace")
+    merger.add_compile_commands(compile_commands)
+    merger.add_all_imports(all_imports)
+    merger.finish()
+    return merger
+
+
+class HeaderCommandRankingTest(unittest.TestCase):
+    def test_source_over_header_parsed_on_its_own(self):
+        merger = _merge(
+            [
+                ("lib/x.h", ["cc", "-x", "c++-header", "-DA", "-DB", "lib/x.h"]),
+                ("other/b.cc", ["cc", "other/b.cc"]),
+            ],
+            [("lib/x.h", ["lib/x.h"]), ("other/b.cc", ["lib/x.h"])],
+        )
+        self.assertEqual(merger.get_header_sources(), {"lib/x.h": "other/b.cc"})
+
+    def test_same_directory_over_more_arguments(self):
+        merger = _merge(
+            [
+                ("lib/a.cc", ["cc", "lib/a.cc"]),
+                ("other/b.cc", ["cc", "-DA", "-DB", "-DC", "other/b.cc"]),
+            ],
+            [("lib/a.cc", ["lib/x.h"]), ("other/b.cc", ["lib/x.h"])],
+        )
+        self.assertEqual(merger.get_header_sources(), {"lib/x.h": "lib/a.cc"})
+
+    def test_more_arguments_over_fewer(self):
+        merger = _merge(
+            [
+                ("p/a.cc", ["cc", "p/a.cc"]),
+                ("q/b.cc", ["cc", "-DA", "q/b.cc"]),
+            ],
+            [("p/a.cc", ["lib/x.h"]), ("q/b.cc", ["lib/x.h"])],
+        )
+        self.assertEqual(merger.get_header_sources(), {"lib/x.h": "q/b.cc"})
+
+    def test_ties_do_not_depend_on_the_order_of_outputs(self):
+        compile_commands = [
+            ("q/b.cc", ["cc", "q/b.cc"]),
+            ("p/a.cc", ["cc", "p/a.cc"]),
+        ]
+        all_imports = [("q/b.cc", ["lib/x.h"]), ("p/a.cc", ["lib/x.h"])]
+        for outputs_order in [1, -1]:
+            merger = refresh._CcMetaMerger("/workspace")
+            # Imports added before their compile commands are chosen from in finish().
+            merger.add_all_imports(all_imports[::outputs_order])
+            merger.add_compile_commands(compile_commands[::outputs_order])
+            merger.finish()
+            self.assertEqual(merger.get_header_sources(), {"lib/x.h": "p/a.cc"})
+
+    def test_sources_keep_their_own_command(self):
+        merger = _merge(
+            [
+                ("lib/a.cc", ["cc", "lib/a.cc"]),
+                ("lib/b.cc", ["cc", "-DA", "-DB", "lib/b.cc"]),
+            ],
+            # A source included by another source (e.g., a unity build).
+            [("lib/b.cc", ["lib/a.cc", "lib/x.h"])],
+        )
+        compile_commands = {cmd["file"]: cmd for cmd in merger.compile_commands}
+        self.assertEqual(compile_commands["lib/a.cc"]["arguments"], ("cc", "lib/a.cc"))
+        self.assertEqual(
+            compile_commands["lib/x.h"]["arguments"],
+            ("cc", "-DA", "-DB", "lib/b.cc"),
+        )
+        self.assertEqual(compile_commands["lib/x.h"]["directory"], "/workspace")
+
+
+class ScopeLabelTest(unittest.TestCase):
+    def test_split_label(self):
+        self.assertEqual(refresh._split_label("//pkg:t"), ("", "pkg", "t"))
+        self.assertEqual(refresh._split_label("@@//pkg/sub"), ("@@", "pkg/sub", None))
+        self.assertEqual(refresh._split_label("@repo//:t"), ("@repo", "", "t"))
+        self.assertEqual(refresh._split_label("//pkg/..."), ("", "pkg/...", None))
+        self.assertEqual(refresh._split_label("//pkg/...:all"), ("", "pkg/...", "all"))
+
+    def test_split_invalid_label(self):
+        for label in [
+            "pkg:t",
+            "//pkg:",
+            "//pkg:a:b",
+            "//pkg//sub:t",
+            "//../pkg:t",
+            "//pkg/.../sub",
+            "//pkg/...:t",
+            "repo//pkg:t",
+            "@a/b//pkg:t",
+        ]:
+            with self.assertRaises(ValueError, msg=label):
+                refresh._split_label(label)
+
+    def test_qualified_label(self):
+        self.assertEqual(refresh._get_qualified_label("//pkg"), "@@//pkg:pkg")
+        self.assertEqual(refresh._get_qualified_label("@//pkg:t"), "@@//pkg:t")
+        self.assertEqual(refresh._get_qualified_label("@repo//x:y"), "@repo//x:y")
+
+    def test_target_patterns(self):
+        self.assertTrue(refresh._is_target_pattern("//pkg/..."))
+        self.assertTrue(refresh._is_target_pattern("//pkg:*"))
+        self.assertFalse(refresh._is_target_pattern("//pkg:t"))
+        self.assertTrue(refresh._matches_target_pattern("@@//pkg/sub:t", "//pkg/..."))
+        self.assertTrue(refresh._matches_target_pattern("@@//pkg:t", "//pkg/..."))
+        self.assertFalse(refresh._matches_target_pattern("@@//pkg2:t", "//pkg/..."))
+        self.assertFalse(refresh._matches_target_pattern("@@//pkg/sub:t", "//pkg:all"))
+        self.assertFalse(refresh._matches_target_pattern("@repo//pkg:t", "//pkg:all"))
+
+
+# a <- b <- c: b depends on a, and c on b.
+_EXPORTS = {
+    "@@//a:a": {"target": "@@//a:a", "files": ["a/a.cc", "a/a.h"], "deps": []},
+    "@@//b:b": {"target": "@@//b:b", "files": ["b/b.cc"], "deps": ["@@//a:a"]},
+    "@@//c:c": {"target": "@@//c:c", "files": ["c/c.cc"], "deps": ["@@//b:b"]},
+}
+
+
+class ScopeTargetsTest(unittest.TestCase):
+    def setUp(self):
+        self.owners = refresh._get_owners(_EXPORTS)
+
+    def test_changed_file_refreshes_owners_and_direct_dependents(self):
+        target_patterns, covered_targets = refresh._find_targets_to_refresh(
+            {"a/a.h"}, _EXPORTS, self.owners
+        )
+        self.assertEqual(target_patterns, ["@@//a:a", "@@//b:b"])
+        self.assertEqual(covered_targets, {"@@//a:a", "@@//b:b"})
+
+    def test_changed_build_file_refreshes_its_package(self):
+        target_patterns, covered_targets = refresh._find_targets_to_refresh(
+            {"b/BUILD.bazel"}, _EXPORTS, self.owners
+        )
+        self.assertEqual(target_patterns, ["@@//b:all", "@@//b:b", "@@//c:c"])
+        self.assertEqual(covered_targets, {"@@//b:b", "@@//c:c"})
+
+    def test_scope_of_labels_and_patterns(self):
+        target_patterns, covered_targets = refresh._find_scope_targets(
+            ["//c", "@@//a/..."], _EXPORTS, self.owners
+        )
+        self.assertEqual(
+            target_patterns, ["@@//a/...", "@@//a:a", "@@//b:b", "@@//c:c"]
+        )
+        self.assertEqual(covered_targets, {"@@//a:a", "@@//b:b", "@@//c:c"})
+
+
+def _write_json(file_name, contents):
+    with open(file_name, "w") as f:
+        json.dump(contents, f)
+
+
+class MergeIntoExistingOutputsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        initial_cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.addCleanup(os.chdir, initial_cwd)
+        _write_json(
+            "compile_commands.json",
+            [
+                {"arguments": ["cc", "-DOLD", path], "file": path, "directory": "/ws"}
+                for path in ["a/a.cc", "a/a.h", "b/b.cc", "c/c.cc"]
+            ],
+        )
+        _write_json(
+            "dependency_issues.json",
+            {
+                t: {"target": t, "not_found": ["x.h"], "unused": []}
+                for t in ["@@//a:a", "@@//b:b", "@@//c:c"]
+            },
+        )
+
+    def _merge_scope(self, compile_commands, exports, deps_issues, covered_targets):
+        merger = refresh._CcMetaMerger("/ws")
+        merger.add_compile_commands(compile_commands)
+        merger.add_exports(exports)
+        merger.add_deps_issues(deps_issues)
+        merger.finish()
+        refresh._merge_into_existing_outputs(
+            merger,
+            _EXPORTS,
+            covered_targets,
+            argparse.Namespace(cc_meta_mode="full", cc_meta_shard_depth=0),
+        )
+        return merger
+
+    def test_refreshed_targets_replace_their_entries(self):
+        merger = self._merge_scope(
+            [("b/b.cc", ["cc", "-DNEW", "b/b.cc"]), ("b/new.cc", ["cc", "b/new.cc"])],
+            [dict(_EXPORTS["@@//b:b"], files=["b/b.cc", "b/new.cc"])],
+            [{"target": "@@//b:b", "not_found": [], "unused": ["@@//a:a"]}],
+            {"@@//b:b"},
+        )
+        arguments_by_file = {
+            cmd["file"]: list(cmd["arguments"]) for cmd in merger.compile_commands
+        }
+        self.assertEqual(
+            arguments_by_file,
+            {
+                "a/a.cc": ["cc", "-DOLD", "a/a.cc"],
+                "a/a.h": ["cc", "-DOLD", "a/a.h"],
+                "b/b.cc": ["cc", "-DNEW", "b/b.cc"],
+                "b/new.cc": ["cc", "b/new.cc"],
+                "c/c.cc": ["cc", "-DOLD", "c/c.cc"],
+            },
+        )
+        self.assertEqual(merger.owners_dict["b/new.cc"], ["@@//b:b"])
+        self.assertEqual(merger.deps_issues_dict["@@//b:b"]["unused"], ["@@//a:a"])
+        self.assertEqual(merger.deps_issues_dict["@@//c:c"]["not_found"], ["x.h"])
+
+    def test_removed_targets_lose_their_entries(self):
+        merger = self._merge_scope([], [], [], {"@@//c:c"})
+        self.assertNotIn("@@//c:c", merger.exports_dict)
+        self.assertNotIn("@@//c:c", merger.deps_issues_dict)
+        self.assertNotIn("c/c.cc", [cmd["file"] for cmd in merger.compile_commands])
+        self.assertIn("@@//a:a", merger.exports_dict)
+
+    def test_existing_shards_are_merged_into(self):
+        refresh._write_compile_commands_shards(
+            refresh._load_json_or_empty_dict("compile_commands.json"),
+            refresh._CompileCommandsWriter(False),
+            1,
+        )
+        os.remove("compile_commands.json")
+        merger = self._merge_scope([], [], [], {"@@//c:c"})
+        self.assertEqual(
+            sorted(cmd["file"] for cmd in merger.compile_commands),
+            ["a/a.cc", "a/a.h", "b/b.cc"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,11 @@
+#!/bin/bash
+# Run a command with stdout to /dev/null and stderr to the file given as first argument,
+# the captured stderr is shown only if the command fails.
+stderr_file="$1"
+shift
+"$@" >/dev/null 2>"${stderr_file}"
+status=$?
+if [ ${status} -ne 0 ]; then
+    cat "${stderr_file}" >&2
+fi
+exit ${status}
@@ -0,0 +1,56 @@
+"""Bazel macro to generate a synthetic deep graph of C++ libraries"""
+
+load("@bazel_skylib//rules:write_file.bzl", "write_file")
+load("@rules_cc//cc:defs.bzl", "cc_library")
+
+def cc_deep_graph(name, depth, width = 1, **kwargs):
+    """
+    Generate `depth` levels of `width` libraries, each depending on all libraries of the level below.
+
+    Every library has a generated header, including all the headers of the level below, and a
+    generated source file. The top library, named `name`, depends on the libraries of the last level.
+    This is meant to measure the cost of the cc_meta aspect on deep graphs (see measure_analysis.sh).
+
+    Args:
+        name: Name of the top library.
+        depth: Number of levels of libraries.
+        width: Number of libraries per level.
+        **kwargs: remaining arguments for all generated rules
+    """
+    below = []
+    for level in range(depth):
+        current = []
+        for index in range(width):
+            lib_name = "{}_{}_{}".format(name, level, index)
+            write_file(
+                name = lib_name + "_h",
+                out = lib_name + ".h",
+                content = ["#pragma once"] + ['#include "{}/{}.h"'.format(native.package_name(), b) for b in below] + [
+                    "int {}();".format(lib_name),
+                ],
+                **kwargs
+            )
+            write_file(
+                name = lib_name + "_cc",
+                out = lib_name + ".cc",
+                content = [
+                    '#include "{}/{}.h"'.format(native.package_name(), lib_name),
+                    "int {}() {{ return {}; }}".format(lib_name, level),
+                ],
+                **kwargs
+            )
+            cc_library(
+                name = lib_name,
+                srcs = [lib_name + ".cc"],
+                hdrs = [lib_name + ".h"],
+                deps = [":" + b for b in below],
+                **kwargs
+            )
+            current.append(lib_name)
+        below = current
+
+    cc_library(
+        name = name,
+        deps = [":" + b for b in below],
+        **kwargs
+    )
@@ -0,0 +1,38 @@
+#!/bin/bash
+
+# Measure the analysis time and retained heap of the cc_meta aspect on the synthetic deep graph.
+# Run it before and after a change to the aspect, and compare the numbers, e.g.:
+#   ./examples/deep_graph/measure_analysis.sh //:defs.bzl%default_cc_meta_aspect /tmp/before
+# The output group can be given as third argument (cc_meta, cc_meta_deps or cc_meta_compile_commands)
+# to also build it and count the actions it runs, e.g., none with cc_meta_compile_commands.
+
+set -euo pipefail
+
+aspect="${1:-//:defs.bzl%default_cc_meta_aspect}"
+out_dir="${2:-$(mktemp -d)}"
+output_group="${3:-}"
+mkdir -p "${out_dir}"
+
+# Start from a fresh server such that nothing is reused from previous analyses.
+bazel shutdown
+bazel build --nobuild \
+    --aspects="${aspect}" \
+    --output_groups="${output_group:-cc_meta}" \
+    --memory_profile="${out_dir}/memory_profile.txt" \
+    --profile="${out_dir}/profile.json.gz" \
+    //examples/deep_graph:all
+
+echo "Analysis phase (from ${out_dir}/profile.json.gz):"
+bazel analyze-profile "${out_dir}/profile.json.gz" | grep -i "analysis" || true
+echo "Retained heap (from ${out_dir}/memory_profile.txt):"
+cat "${out_dir}/memory_profile.txt"
+
+if [[ -n "${output_group}" ]]; then
+    echo "Actions run for the ${output_group} output group:"
+    bazel build \
+        --aspects="${aspect}" \
+        --output_groups="${output_group}" \
+        --execution_log_json_file="${out_dir}/execution_log.json" \
+        //examples/deep_graph:all
+    grep -o '"mnemonic": "[A-Za-z]*"' "${out_dir}/execution_log.json" | sort | uniq -c || true
+fi
@@ -4,7 +4,12 @@
 # Due to the ways in which one might want to customize the invocations below,
 # we can't really provide a one-size-fits-all script.
 
-# First refresh the databases.
-bazel run //examples/default_good:refresh
+# First refresh the databases for the files provided by pre-commit hook (and the
+# targets depending on them), merging into the databases of the last full refresh.
+scope_args=()
+for file in "$@"; do
+    scope_args+=("--cc_meta_scope=${file}")
+done
+bazel run //examples/default_good:refresh -- "${scope_args[@]}"
 # Then, run the fix_deps script with files provided by pre-commit hook.
 bazel run @bazel_cc_meta//cc_meta:fix_deps -- -n "$@"